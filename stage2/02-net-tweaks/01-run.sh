@@ -5,9 +5,13 @@ install -v -m 644 files/interfaces.wlan         "${ROOTFS_DIR}/etc/network/inter
 
 install -v -m 755 files/bridge_switch.sh        "${ROOTFS_DIR}/sbin/bridge_switch.sh"
 install -v -m 755 files/emulator.py             "${ROOTFS_DIR}/sbin/emulator.py"
+install -v -m 644 files/rtnl.py                 "${ROOTFS_DIR}/sbin/rtnl.py"
+install -v -m 755 files/piemd.py                "${ROOTFS_DIR}/sbin/piemd.py"
+install -v -m 755 files/piemstats.py            "${ROOTFS_DIR}/sbin/piemstats.py"
 install -v -d                                   "${ROOTFS_DIR}/etc/piem"
 install -v -m 644 files/piem-config.json        "${ROOTFS_DIR}/etc/piem/config.json"
 install -v -m 644 files/piem.service            "${ROOTFS_DIR}/etc/systemd/system/"
+install -v -m 644 files/piemstats.service       "${ROOTFS_DIR}/etc/systemd/system/"
 
 install -v -m 600 files/hostapd.conf            "${ROOTFS_DIR}/etc/hostapd/hostapd.conf"
 
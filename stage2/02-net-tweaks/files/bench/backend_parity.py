@@ -0,0 +1,167 @@
+#!/usr/bin/python
+'''
+kernel state left by the netlink backend against the shell one
+
+Runs the same emulator.py commands, init, the add, change and remove of single rules
+with loss models, ports and a payload type, a batch adding, changing and removing
+--rules rules, and uninit, once with "backend": "shell" and once with
+"backend": "netlink", each time in a fresh namespace holding a veth pair and the
+ifb devices, see control_plane.NetnsTarget. After each command the qdiscs, classes
+and filters of the devices are dumped with "tc -j" and the dumps of the two backends
+compared, but for the handles the kernel picks. Exits with 1 when a command fails with one backend only or a dump differs,
+printing the difference. Needs root and a kernel with sch_netem.
+
+    sudo python bench/backend_parity.py --classifier hashed --rules 1000
+'''
+import argparse
+import difflib
+import json
+import os
+import re
+import subprocess
+import sys
+import control_plane
+import emulator as em
+
+STEPS = (
+    ('init', ['init']),
+    ('add uplink', ['add', '--ip', '10.0.0.1', '--direction', 'uplink', '--bw', '2000', '--delay', '50',
+                    '--jitter', '5', '--loss', '2', '--burst', '4']),
+    ('add downlink', ['add', '--ip', '10.0.0.2', '--direction', 'downlink', '--bw', '1000', '--delay', '20',
+                      '--loss', '1', '--protocol', 'udp', '--srcport', '5004', '--ptype', '96']),
+    ('change uplink', ['change', '--ip', '10.0.0.1', '--direction', 'uplink', '--bw', '500', '--delay', '80',
+                       '--loss', '5']),
+    ('change downlink', ['change', '--ip', '10.0.0.2', '--direction', 'downlink', '--bw', '3000', '--delay', '20',
+                         '--jitter', '10', '--protocol', 'udp', '--srcport', '5004', '--ptype', '96']),
+    ('remove uplink', ['remove', '--ip', '10.0.0.1', '--direction', 'uplink']),
+    ('batch', None),
+    ('uninit', ['uninit'])
+)
+# handles the kernel gives qdiscs added without one, from a counter of the whole host
+AUTO_HANDLE = re.compile(r'(?<![0-9a-f:])(?!ffff)[89a-f][0-9a-f]{3}:')
+# counters tc shows without -s, which the traffic of the namespace moves
+COUNTERS = ('direct_packets_stat',)
+
+def tc_json(target, args):
+    '''
+    the objects tc shows as json, or the lines of its text where it has no json output,
+    as for htb classes in some versions
+    '''
+    output = subprocess.check_output(target.command(['tc', '-j'] + args)).decode()
+    try:
+        return json.loads(output) if output.strip() else []
+    except ValueError:
+        return [line.strip() for line in output.splitlines() if line.strip()]
+
+def dump(target):
+    '''
+    {dev: {'qdisc': [...], 'class': [...], 'filter': {qdisc handle: [...]}}} of the
+    veth pair and the ifb devices
+    '''
+    bridge = target.bridge
+    state = {}
+    for dev in [bridge.ingress, bridge.egress] + ['ifb%d' % i for i in range(bridge.numifbs)]:
+        qdiscs = tc_json(target, ['qdisc', 'show', 'dev', dev])
+        filters = {}
+        for q in qdiscs:
+            for key in COUNTERS:
+                q.get('options', {}).pop(key, None)
+            found = tc_json(target, ['filter', 'show', 'dev', dev, 'parent', q['handle']])
+            if found:
+                filters[q['handle']] = found
+        state[dev] = {
+            'qdisc': qdiscs,
+            'class': tc_json(target, ['class', 'show', 'dev', dev]),
+            'filter': filters
+        }
+    return state
+
+def has_netem(target):
+    dev = target.bridge.ingress
+    with open(os.devnull, 'w') as devnull:
+        ok = subprocess.call(target.command(['tc', 'qdisc', 'add', 'dev', dev, 'root', 'netem']),
+                             stderr=devnull) == 0
+    if ok:
+        subprocess.check_call(target.command(['tc', 'qdisc', 'del', 'dev', dev, 'root']))
+    return ok
+
+def play(config, count):
+    '''
+    [(step, ok, dump)] of the steps run with the configuration, None without netem
+    '''
+    results = []
+    with control_plane.NetnsTarget(config) as target:
+        if not has_netem(target):
+            return None
+        for name, args in STEPS:
+            if args is None:
+                output = target.run('batch', str(count))[1]
+                ok = json.loads(output.strip().splitlines()[-1])['ok']
+            else:
+                output = target.run('emulator', *args)[1]
+                ok = 'failed' not in output and 'Traceback' not in output
+            if not ok:
+                print('%s %s failed:\n%s' % (config['backend'], name, output[-2000:]))
+            results.append((name, ok, dump(target)))
+    return results
+
+def normalize(state):
+    '''
+    the dump with the handles the kernel picked replaced, and the qdiscs, which tc lists
+    in the order of their handles, sorted
+    '''
+    state = json.loads(AUTO_HANDLE.sub('auto:', json.dumps(state)))
+    for dev in state.values():
+        dev['qdisc'].sort(key=lambda q: json.dumps(q, sort_keys=True))
+    return state
+
+def diff(shell, netlink):
+    a = json.dumps(normalize(shell), indent=1, sort_keys=True).splitlines()
+    b = json.dumps(normalize(netlink), indent=1, sort_keys=True).splitlines()
+    return list(difflib.unified_diff(a, b, 'shell', 'netlink', lineterm=''))
+
+def main():
+    arg_parser = argparse.ArgumentParser()
+    arg_parser.add_argument('--rules', '-n', type=int, help='rules of the batch step', default=1000)
+    arg_parser.add_argument('--topology', choices=['dedicated', 'shared'], default='shared',
+                            help='topology of the configuration, dedicated runs up to %d rules' % em.MAX_NUM_IFBS)
+    arg_parser.add_argument('--classifier', choices=['linear', 'hashed', 'flower'], default='linear')
+    arg_parser.add_argument('--lines', type=int, help='lines of difference printed per step', default=40)
+    args = arg_parser.parse_args()
+
+    count = args.rules
+    if args.topology == 'dedicated':
+        count = min(count, em.MAX_NUM_IFBS - 2)
+    if count < 1:
+        arg_parser.error('the number of rules must be positive')
+    config = {
+        # the single rules come on top of the ones the batch step leaves
+        'numifbs': min(em.MAX_NUM_IFBS, count + 2),
+        'classifier': args.classifier,
+        'topology': args.topology,
+        'numrules': count + 2
+    }
+
+    runs = {}
+    for backend in ('shell', 'netlink'):
+        runs[backend] = play(dict(config, backend=backend), count)
+        if runs[backend] is None:
+            print('the kernel has no sch_netem, skipped')
+            return
+
+    failed = False
+    for (name, shell_ok, shell), (_, netlink_ok, netlink) in zip(runs['shell'], runs['netlink']):
+        lines = diff(shell, netlink)
+        same = shell_ok == netlink_ok and not lines
+        print('%-16s shell %-6s netlink %-6s %s' % (name, 'ok' if shell_ok else 'failed',
+                                                   'ok' if netlink_ok else 'failed', 'same' if same else 'DIFFERENT'))
+        for line in lines[:args.lines]:
+            print('    %s' % line)
+        if len(lines) > args.lines:
+            print('    ... %d more lines' % (len(lines) - args.lines))
+        failed = failed or not same
+    if failed:
+        sys.exit(1)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,94 @@
+#!/usr/bin/python
+'''
+packet rate through a hook carrying the filters of N clients, per classifier
+
+Installs the uplink ingress filters emulator.py installs for N clients on the
+rx end of a veth pair, once per classifier, and sends udp from the address of
+the last installed client, the worst case for the linear chain. Reports the
+packets per second the rx namespace received and the softirq time per packet,
+the median of the runs. With --ptype the filters also match the RTP payload
+type, which the flower classifier leaves to a cls_bpf program. Needs root.
+
+    sudo python bench/classifier_rate.py --rules 5 250 --duration 5
+'''
+import argparse
+import socket
+import struct
+import time
+import netns
+import emulator as em
+
+CLASSIFIERS = ('linear', 'hashed', 'flower')
+PTYPE = 96
+
+def client_addrs(count):
+    # the sender, 10.0.0.250, is the last one
+    return ['10.0.0.%d' % i for i in range(251 - count, 251)]
+
+def install(topo, classifier, count, ptype):
+    em.gConfig = {'ingress': topo.rx_dev, 'egress': topo.rx_dev, 'classifier': classifier}
+    batch = em.Batch()
+    batch.add(em.QdiscOp('add', topo.rx_dev, 'ingress'))
+    em.build_filter_tables(batch, topo.rx_dev, 'ffff:', 'uplink')
+    for handle, ip in enumerate(client_addrs(count), em.HANDLE_MIN):
+        f = em.Filter('uplink', ip, ptype=PTYPE if ptype else None, protocol='udp' if ptype else 'all')
+        r = em.Rule(f, 0, 0, 0, 0, 0, 'uplink', handle=handle)
+        p = r._get_tc_params()
+        batch.add(r._filter_op('add', p, p['in_inf'], 'ffff:'))
+    topo.batch(topo.rx, 'tc', batch.ops)
+
+def softirq_seconds():
+    '''
+    time all the cpus spent in softirqs, from /proc/stat in USER_HZ ticks
+    '''
+    with open('/proc/stat') as f:
+        fields = f.readline().split()
+    return int(fields[7]) / 100.0
+
+def send(dst, duration):
+    sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    # an RTP header, for the filters matching the payload type
+    payload = struct.pack('BB', 0x80, PTYPE) + b'\0' * 62
+    start = time.time()
+    while time.time() < start + duration:
+        for _ in range(1000):
+            sock.sendto(payload, (dst, 9))
+    return time.time() - start
+
+def measure(classifier, count, duration, ptype):
+    '''
+    (packets per second received, softirq ns per packet)
+    '''
+    with netns.Topology() as topo:
+        install(topo, classifier, count, ptype)
+        before = netns.snmp_counter(topo, topo.rx, 'Udp', 'NoPorts')
+        softirq = softirq_seconds()
+        elapsed = float(topo.python(topo.tx, __file__, ['--send', topo.rx_addr, '--duration', str(duration)]))
+        softirq = softirq_seconds() - softirq
+        received = netns.snmp_counter(topo, topo.rx, 'Udp', 'NoPorts') - before
+    return received / elapsed, softirq * 1e9 / received if received else 0
+
+def main():
+    arg_parser = argparse.ArgumentParser()
+    arg_parser.add_argument('--rules', '-n', type=int, nargs='+', help='numbers of clients, up to 250', default=[5, 250])
+    arg_parser.add_argument('--duration', '-d', type=float, help='seconds of traffic per run', default=5)
+    arg_parser.add_argument('--runs', '-r', type=int, help='runs per case', default=3)
+    arg_parser.add_argument('--classifier', '-c', nargs='+', choices=CLASSIFIERS, help='classifiers to compare',
+                            default=list(CLASSIFIERS))
+    arg_parser.add_argument('--ptype', action='store_true', help='match the RTP payload type too', default=False)
+    arg_parser.add_argument('--send', help=argparse.SUPPRESS)
+    args = arg_parser.parse_args()
+
+    if args.send is not None:
+        print(send(args.send, args.duration))
+        return
+
+    print('%-10s %6s %12s %16s' % ('classifier', 'rules', 'pps', 'softirq ns/pkt'))
+    for count in args.rules:
+        for classifier in args.classifier:
+            results = sorted(measure(classifier, count, args.duration, args.ptype) for _ in range(args.runs))
+            rate, cost = results[len(results) // 2]
+            print('%-10s %6d %12.0f %16.0f' % (classifier, count, rate, cost))
+
+if __name__ == "__main__":
+    main()
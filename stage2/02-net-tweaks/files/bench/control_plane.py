@@ -0,0 +1,407 @@
+#!/usr/bin/python
+'''
+control-plane latency of emulator.py and dynem.py
+
+Runs the commands a process at a time, the way they are used, against two targets:
+fake, where tc, ip and modprobe are shims on PATH which record what they are given
+and succeed, so only the python side is measured, and netns, a private namespace
+with a veth pair for the bridge and the ifb devices, so the kernel side is measured
+too. For each number of rules it times init, the add, change and remove of all the
+rules in one batch, the startup of a list with the rules saved, and the add, change
+and remove of one more rule, then plays dynamics with dynem.py and reports how long
+it takes to start and how late its steps are. The results are written as json, and
+compared with the ones of an earlier run with --baseline, exiting with 1 when a
+metric got worse by more than --tolerance. The netns target needs root.
+
+    sudo python bench/control_plane.py --rules 1 10 100 500 --output cp.json
+    python bench/control_plane.py --target fake --baseline cp.json
+'''
+import argparse
+import json
+import os
+import platform
+import re
+import shutil
+import signal
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import netns
+import emulator as em
+
+SHIM = '''#!/bin/sh
+# records the call and the batch read from stdin, and succeeds
+echo "call $(basename "$0") $*" >> "%s"
+case "$*" in
+*-batch*) sed 's/^/op /' >> "%s" ;;
+esac
+case " $* " in
+*" -j "*) echo '[]' ;;
+esac
+'''
+APPLY_LINE = re.compile(r'^apply (\d+) updates at ([\d.]+) seconds')
+LATENESS_LINE = re.compile(r'lateness over (\d+) steps: p50 ([\d.]+) ms, p99 ([\d.]+) ms, max ([\d.]+) ms')
+# changes below these are noise, whatever the tolerance
+NOISE_S = 0.001
+NOISE_MS = 1.0
+
+def client_addrs(count):
+    return ['10.1.%d.%d' % (i // 250, i % 250 + 1) for i in range(count)]
+
+def client_rules(count, bw=8000, delay=10):
+    return [em.Rule(em.Filter('uplink', ip), bw, 0, 100, 0, delay, 'uplink') for ip in client_addrs(count)]
+
+class Target(object):
+
+    '''
+    a state directory with the configuration and rules the commands use, and the shims
+    put first on their PATH
+    '''
+
+    name = None
+    shims = ('modprobe',)
+
+    def __init__(self, config):
+        self.config = config
+
+    def __enter__(self):
+        self.dir = tempfile.mkdtemp(prefix='piem-bench-')
+        self.log = os.path.join(self.dir, 'calls.log')
+        bindir = os.path.join(self.dir, 'bin')
+        os.mkdir(bindir)
+        for tool in self.shims:
+            path = os.path.join(bindir, tool)
+            with open(path, 'w') as f:
+                f.write(SHIM % (self.log, self.log))
+            os.chmod(path, 0o755)
+        self.env = dict(os.environ, PATH=bindir + os.pathsep + os.environ.get('PATH', ''))
+        ingress, egress = self.setup()
+        with open(os.path.join(self.dir, 'config.json'), 'w') as f:
+            json.dump(dict(self.config, ingress=ingress, egress=egress), f, indent=4)
+        return self
+
+    def __exit__(self, *exc):
+        self.teardown()
+        shutil.rmtree(self.dir)
+
+    def setup(self):
+        '''
+        returns the ingress and egress interfaces
+        '''
+        raise NotImplementedError
+
+    def teardown(self):
+        pass
+
+    def command(self, args):
+        return list(args)
+
+    def tool(self, tool, args):
+        '''
+        command line running tool, emulator, dynem or batch, on the state directory
+        '''
+        return self.command([sys.executable, '-u', os.path.abspath(__file__), '--run', tool, self.dir] + list(args))
+
+    def run(self, tool, *args):
+        '''
+        seconds the command took and its output
+        '''
+        start = time.time()
+        p = subprocess.Popen(self.tool(tool, args), stdout=subprocess.PIPE, stderr=subprocess.STDOUT, env=self.env)
+        output = p.communicate()[0].decode(errors='replace')
+        return time.time() - start, output
+
+    def records(self):
+        '''
+        (processes, ops) the shims recorded so far, None when tc and ip are the real ones
+        '''
+        return None
+
+class FakeTarget(Target):
+
+    name = 'fake'
+    shims = ('modprobe', 'tc', 'ip')
+
+    def setup(self):
+        open(self.log, 'w').close()
+        # the netlink backend would talk to the kernel of the host
+        self.config = dict(self.config, backend='shell')
+        return 'wlan0', 'eth0'
+
+    def records(self):
+        calls = ops = 0
+        with open(self.log, 'r') as f:
+            for line in f:
+                if line.startswith('call '):
+                    calls += 1
+                elif line.startswith('op '):
+                    ops += 1
+        return calls, ops
+
+class NetnsTarget(Target):
+
+    name = 'netns'
+
+    def setup(self):
+        shared = self.config.get('topology') == 'shared'
+        self.bridge = netns.Bridge(numifbs=len(em.SHARED_IFBS) if shared else self.config['numifbs'])
+        self.bridge.__enter__()
+        return self.bridge.ingress, self.bridge.egress
+
+    def teardown(self):
+        self.bridge.teardown()
+
+    def command(self, args):
+        return self.bridge.command(args)
+
+TARGETS = {'fake': FakeTarget, 'netns': NetnsTarget}
+
+def run_tool(tool, state, argv):
+    '''
+    runs emulator.py or dynem.py on the configuration and rules of the state directory,
+    or batch, which times the add, change and remove of argv[0] rules in this process
+    '''
+    em.CONFIG_PATH = os.path.join(state, 'config.json')
+    em.RULE_PATH = os.path.join(state, 'piem.rules')
+    em.SOCKET_PATH = os.path.join(state, 'piemd.sock')
+    sys.argv = [tool + '.py'] + argv
+    if tool == 'dynem':
+        import dynem
+        dynem.main()
+    elif tool == 'emulator':
+        em.main()
+    else:
+        count = int(argv[0])
+        em.gConfig = em.load_config(em.CONFIG_PATH)
+        rules = client_rules(count)
+        result = {'ok': True}
+        for cmd, rs in (('add', rules), ('change', client_rules(count, 4000, 20)), ('remove', rules)):
+            start = time.time()
+            ok = em.run_command(cmd, rs)
+            result[cmd] = time.time() - start
+            result['ok'] = result['ok'] and bool(ok)
+        # leaves room for the one rule the single commands add
+        em.run_command('add', rules[:-1])
+        print(json.dumps(result))
+
+def percentiles(samples):
+    samples = sorted(samples)
+    return {
+        'p50_ms': samples[len(samples) // 2] * 1000,
+        'max_ms': samples[-1] * 1000
+    }
+
+def rule_args(ip, bw, delay):
+    return ['--ip', ip, '--direction', 'uplink', '--bw', str(bw), '--delay', str(delay)]
+
+def measure_rules(target, count, runs):
+    '''
+    timings of the rule commands with count rules
+    '''
+    result = {}
+    result['init_s'] = target.run('emulator', 'init')[0]
+    output = target.run('batch', str(count))[1]
+    times = json.loads(output.strip().splitlines()[-1])
+    result['ok'] = times['ok']
+    for cmd in ('add', 'change', 'remove'):
+        result['batch_%s_s' % cmd] = times[cmd]
+        result['batch_%s_per_s' % cmd] = count / times[cmd] if times[cmd] else 0
+
+    result['startup'] = percentiles([target.run('emulator', 'list')[0] for _ in range(runs)])
+    ip = client_addrs(count)[-1]
+    samples = dict((cmd, []) for cmd in ('add', 'change', 'remove'))
+    records = {}
+    for _ in range(runs):
+        for cmd, args in (('add', rule_args(ip, 8000, 10)), ('change', rule_args(ip, 4000, 20)),
+                          ('remove', ['--ip', ip, '--direction', 'uplink'])):
+            before = target.records()
+            samples[cmd].append(target.run('emulator', cmd, *args)[0])
+            if before is not None:
+                after = target.records()
+                records[cmd] = {'processes': after[0] - before[0], 'ops': after[1] - before[1]}
+    result['single'] = dict((cmd, percentiles(samples[cmd])) for cmd in samples)
+    for cmd in records:
+        result['single'][cmd].update(records[cmd])
+    target.run('emulator', 'uninit')
+    return result
+
+def measure_dynem(target, clients, step, duration):
+    '''
+    startup of dynem.py playing clients configurations switching rate every step
+    seconds, and the lateness of its steps over duration seconds
+    '''
+    cfgdir = os.path.join(target.dir, 'dynamics')
+    if not os.path.isdir(cfgdir):
+        os.mkdir(cfgdir)
+    for i, ip in enumerate(client_addrs(clients)):
+        with open(os.path.join(cfgdir, '%04d.json' % i), 'w') as f:
+            json.dump({
+                'emfilter': {'ip': ip, 'direction': 'uplink'},
+                'dynamics': [
+                    {'bw': 4000, 'interval': 0, 'duration': step},
+                    {'bw': 8000, 'interval': 0, 'duration': step}
+                ]
+            }, f)
+    target.run('emulator', 'init')
+
+    first = []
+    lines = []
+    def read(p, start):
+        for line in iter(p.stdout.readline, b''):
+            line = line.decode(errors='replace')
+            m = APPLY_LINE.match(line)
+            if m and not first:
+                # the first step is due right after the rules are added
+                first.append(time.time() - start - float(m.group(2)))
+            lines.append(line)
+
+    start = time.time()
+    p = subprocess.Popen(target.tool('dynem', ['-f', cfgdir]), stdout=subprocess.PIPE, stderr=subprocess.STDOUT,
+                         env=target.env)
+    reader = threading.Thread(target=read, args=(p, start))
+    reader.start()
+    deadline = time.time() + duration + 60
+    while not first and p.poll() is None and time.time() < deadline:
+        time.sleep(0.01)
+    if first:
+        time.sleep(duration)
+    p.send_signal(signal.SIGINT)
+    p.wait()
+    reader.join()
+    target.run('emulator', 'uninit')
+
+    m = LATENESS_LINE.search(''.join(lines))
+    if not first or m is None:
+        print('dynem.py did not run its steps:\n%s' % ''.join(lines[-20:]))
+        return None
+    return {
+        'clients': clients,
+        'step_s': step,
+        'startup_s': first[0],
+        'steps': int(m.group(1)),
+        'lateness_p50_ms': float(m.group(2)),
+        'lateness_p99_ms': float(m.group(3)),
+        'lateness_max_ms': float(m.group(4))
+    }
+
+def flatten(d, prefix=''):
+    for key, value in d.items():
+        if isinstance(value, dict):
+            for item in flatten(value, prefix + key + '.'):
+                yield item
+        elif isinstance(value, (int, float)) and not isinstance(value, bool):
+            yield prefix + key, value
+
+def compare(baseline, results, tolerance):
+    '''
+    [(metric, baseline, now)] of the metrics worse than the baseline by more than
+    tolerance, times ending in _s or _ms, rates ending in _per_s
+    '''
+    before = dict(flatten(baseline['targets']))
+    worse = []
+    for key, value in sorted(flatten(results['targets'])):
+        old = before.get(key)
+        if old is None:
+            continue
+        if key.endswith('_per_s'):
+            if value < old * (1 - tolerance):
+                worse.append((key, old, value))
+        elif key.endswith('_s') or key.endswith('_ms'):
+            noise = NOISE_MS if key.endswith('_ms') else NOISE_S
+            if value > old * (1 + tolerance) and value - old > noise:
+                worse.append((key, old, value))
+    return worse
+
+def report(results):
+    lines = ['%-6s %6s %8s %9s %9s %9s %10s %8s %9s %9s' % (
+        'target', 'rules', 'init ms', 'add/s', 'change/s', 'remove/s', 'startup ms', 'add ms', 'change ms', 'remove ms')]
+    for name, target in results['targets'].items():
+        for count in sorted(target['rules'], key=int):
+            r = target['rules'][count]
+            lines.append('%-6s %6s %8.1f %9.0f %9.0f %9.0f %10.1f %8.1f %9.1f %9.1f%s' % (
+                name, count, r['init_s'] * 1000, r['batch_add_per_s'], r['batch_change_per_s'],
+                r['batch_remove_per_s'], r['startup']['p50_ms'], r['single']['add']['p50_ms'],
+                r['single']['change']['p50_ms'], r['single']['remove']['p50_ms'], '' if r['ok'] else '  failed'))
+    for name, target in results['targets'].items():
+        d = target.get('dynem')
+        if d:
+            lines.append('%s dynem.py, %d clients every %g s: startup %.1f ms, lateness over %d steps p50 %.1f ms, '
+                         'p99 %.1f ms, max %.1f ms' % (name, d['clients'], d['step_s'], d['startup_s'] * 1000,
+                         d['steps'], d['lateness_p50_ms'], d['lateness_p99_ms'], d['lateness_max_ms']))
+    return '\n'.join(lines)
+
+def main():
+    if len(sys.argv) > 3 and sys.argv[1] == '--run':
+        run_tool(sys.argv[2], sys.argv[3], sys.argv[4:])
+        return
+
+    arg_parser = argparse.ArgumentParser()
+    arg_parser.add_argument('--target', '-t', nargs='+', choices=sorted(TARGETS), help='targets to run against',
+                            default=['fake', 'netns'])
+    arg_parser.add_argument('--rules', '-n', type=int, nargs='+', help='numbers of rules', default=[1, 10, 100, 500])
+    arg_parser.add_argument('--runs', '-r', type=int, help='runs of each single rule command', default=5)
+    arg_parser.add_argument('--topology', choices=['dedicated', 'shared'], default='shared',
+                            help='topology of the configuration, dedicated runs up to %d rules' % em.MAX_NUM_IFBS)
+    arg_parser.add_argument('--backend', choices=['shell', 'netlink'], default='shell',
+                            help='backend of the configuration, the fake target always uses the shell one')
+    arg_parser.add_argument('--classifier', choices=['linear', 'hashed'], default='linear')
+    arg_parser.add_argument('--clients', type=int, help='configurations dynem.py plays', default=10)
+    arg_parser.add_argument('--step', type=float, help='seconds between the dynem.py steps', default=0.1)
+    arg_parser.add_argument('--duration', '-d', type=float, help='seconds dynem.py runs, 0 to skip it', default=10)
+    arg_parser.add_argument('--output', '-o', help='json file to write the results to', default='control_plane.json')
+    arg_parser.add_argument('--baseline', '-b', help='json results of an earlier run to compare with')
+    arg_parser.add_argument('--tolerance', type=float, help='fraction a metric may get worse by', default=0.2)
+    args = arg_parser.parse_args()
+
+    counts = sorted(set(args.rules))
+    if args.topology == 'dedicated':
+        skipped = [c for c in counts if c > em.MAX_NUM_IFBS]
+        if skipped:
+            print('skip %s rules, the dedicated topology has room for %d' % (
+                ', '.join(str(c) for c in skipped), em.MAX_NUM_IFBS))
+        counts = [c for c in counts if c <= em.MAX_NUM_IFBS]
+        clients = min(args.clients, em.MAX_NUM_IFBS)
+    else:
+        clients = args.clients
+    if min(counts + [clients]) < 1:
+        arg_parser.error('the numbers of rules and clients must be positive')
+    config = {
+        'numifbs': min(em.MAX_NUM_IFBS, max(counts + [clients])),
+        'backend': args.backend,
+        'classifier': args.classifier,
+        'topology': args.topology,
+        'numrules': max(counts + [clients])
+    }
+
+    results = {
+        'time': time.strftime('%Y-%m-%dT%H:%M:%S'),
+        'host': platform.node(),
+        'python': platform.python_version(),
+        'config': config,
+        'targets': {}
+    }
+    for name in args.target:
+        with TARGETS[name](config) as target:
+            r = {'rules': {}}
+            for count in counts:
+                r['rules'][str(count)] = measure_rules(target, count, args.runs)
+            if args.duration > 0:
+                r['dynem'] = measure_dynem(target, clients, args.step, args.duration)
+            results['targets'][name] = r
+
+    print(report(results))
+    with open(args.output, 'w') as f:
+        json.dump(results, f, indent=4)
+
+    if args.baseline:
+        with open(args.baseline, 'r') as f:
+            worse = compare(json.load(f), results, args.tolerance)
+        for key, old, value in worse:
+            print('regression %s: %.4g -> %.4g' % (key, old, value))
+        if worse:
+            sys.exit(1)
+
+if __name__ == "__main__":
+    main()
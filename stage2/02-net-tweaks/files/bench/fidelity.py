@@ -0,0 +1,498 @@
+#!/usr/bin/python
+'''
+achieved against configured bandwidth, delay and loss of a rule
+
+Builds the bridge emulator.py runs on between a client and a server namespace, see
+netns.Path, installs the rule for two client addresses and sends numbered,
+timestamped messages through each: a udp probe flow under the rate limit, whose
+one-way delay, loss ratio and loss bursts are compared with the configured delay,
+jitter, loss and burst, and a load flow over the rate limit, udp or tcp, whose
+throughput is compared with the configured bw. The namespaces share the clock, so
+the delay of a message is its receive time minus the send time it carries.
+
+With --dynamics, dynem.py plays a configuration on both addresses instead, and each
+step reports how long the delay and the throughput take to settle within --tolerance
+of their new values, and the loss over the step. Needs root.
+
+    sudo python bench/fidelity.py --bw 2000 --delay 200 --loss 2 --burst 4
+    sudo python bench/fidelity.py --dynamics unstable-wifi.cfg --duration 60
+'''
+import argparse
+import json
+import os
+import re
+import signal
+import socket
+import struct
+import subprocess
+import sys
+import threading
+import time
+import netns
+import control_plane
+import dynem
+
+HEADER = struct.Struct('!Id')
+# (seq, send time) logged by the sender, (seq, send time, receive time, size) by the receiver
+SENT = struct.Struct('!Id')
+RECEIVED = struct.Struct('!Iddi')
+# ethernet, ip and udp headers of a datagram, which htb counts in the rate
+UDP_OVERHEAD = 42
+SERVER = '10.0.0.2'
+FLOWS = (('probe', '10.0.0.1', 5001), ('load', '10.0.0.3', 5002))
+# seconds of the load flow left out while the queue fills up
+WARMUP = 1.0
+# ms a delay is allowed off whatever the tolerance
+DELAY_FLOOR_MS = 2.0
+APPLY_LINE = re.compile(r'^apply (\d+) updates at ([\d.]+) seconds')
+
+def send(proto, src, dst, port, rate, size, duration, log):
+    '''
+    sends messages of size bytes from src to dst:port for duration seconds, paced at rate
+    kbit/s on the wire for udp, as fast as the connection takes them for tcp, and logs
+    the sequence number and send time of each
+    '''
+    if proto == 'udp':
+        sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        sock.bind((src, 0))
+        interval = (size + UDP_OVERHEAD) * 8 / (rate * 1000.0)
+    else:
+        sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        sock.bind((src, 0))
+        sock.connect((dst, port))
+        interval = 0
+    pad = b'\0' * (size - HEADER.size)
+    seq = 0
+    with open(log, 'wb') as f:
+        start = time.time()
+        while True:
+            now = time.time()
+            if now >= start + duration:
+                break
+            due = start + seq * interval
+            if due > now:
+                time.sleep(due - now)
+                now = time.time()
+            msg = HEADER.pack(seq, now) + pad
+            try:
+                if proto == 'udp':
+                    sock.sendto(msg, (dst, port))
+                else:
+                    sock.sendall(msg)
+            except socket.error:
+                # not sent, so not lost on the way either
+                continue
+            f.write(SENT.pack(seq, now))
+            seq += 1
+    sock.close()
+    print(seq)
+
+def receive(proto, addr, port, size, log):
+    '''
+    logs the messages received on addr:port until interrupted
+    '''
+    if proto == 'udp':
+        sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, 4 << 20)
+        sock.bind((addr, port))
+    else:
+        server = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        server.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        server.bind((addr, port))
+        server.listen(1)
+    print('ready')
+    sys.stdout.flush()
+    with open(log, 'wb') as f:
+        try:
+            if proto == 'udp':
+                while True:
+                    data = sock.recv(65536)
+                    seq, sent = HEADER.unpack_from(data)
+                    f.write(RECEIVED.pack(seq, sent, time.time(), len(data)))
+            conn, _ = server.accept()
+            buf = b''
+            while True:
+                data = conn.recv(65536)
+                if not data:
+                    break
+                now = time.time()
+                buf += data
+                while len(buf) >= size:
+                    seq, sent = HEADER.unpack_from(buf)
+                    f.write(RECEIVED.pack(seq, sent, now, size))
+                    buf = buf[size:]
+        except KeyboardInterrupt:
+            pass
+
+def read_records(path, record):
+    with open(path, 'rb') as f:
+        data = f.read()
+    return [record.unpack_from(data, i) for i in range(0, len(data) - record.size + 1, record.size)]
+
+class PathTarget(control_plane.Target):
+
+    '''
+    emulator.py on the bridge of a netns.Path holding the client addresses of FLOWS
+    '''
+
+    name = 'path'
+
+    def setup(self):
+        self.path = netns.Path(clients=[addr for _, addr, _ in FLOWS], server=SERVER, numifbs=len(FLOWS))
+        self.path.__enter__()
+        return self.path.ingress, self.path.egress
+
+    def teardown(self):
+        self.path.teardown()
+
+    def command(self, args):
+        return self.path.command(self.path.bridge, args)
+
+    def spawn(self, ns, args):
+        return subprocess.Popen(self.path.command(ns, [sys.executable, '-u', os.path.abspath(__file__)] + args),
+                                stdout=subprocess.PIPE)
+
+def run_flows(target, direction, proto, rates, sizes, duration, grace, started=None):
+    '''
+    sends the flows of FLOWS at rates for duration seconds, calls started() once they
+    are going, and returns {flow: (sent records, received records)}
+    '''
+    path = target.path
+    uplink = direction == 'uplink'
+    send_ns, recv_ns = (path.client, path.server) if uplink else (path.server, path.client)
+    receivers, senders = {}, {}
+    for name, addr, port in FLOWS:
+        flow_proto = 'udp' if name == 'probe' else proto
+        log = os.path.join(target.dir, name + '.received')
+        receivers[name] = target.spawn(recv_ns, ['--receive', flow_proto, SERVER if uplink else addr, str(port),
+                                                 str(sizes[name]), log])
+        receivers[name].stdout.readline()
+    for name, addr, port in FLOWS:
+        flow_proto = 'udp' if name == 'probe' else proto
+        src, dst = (addr, SERVER) if uplink else (SERVER, addr)
+        log = os.path.join(target.dir, name + '.sent')
+        senders[name] = target.spawn(send_ns, ['--send', flow_proto, src, dst, str(port), str(rates[name]),
+                                               str(sizes[name]), str(duration), log])
+    if started is not None:
+        started()
+    for p in senders.values():
+        p.communicate()
+    time.sleep(grace)
+    for p in receivers.values():
+        p.send_signal(signal.SIGINT)
+        p.communicate()
+    return dict((name, (read_records(os.path.join(target.dir, name + '.sent'), SENT),
+                        read_records(os.path.join(target.dir, name + '.received'), RECEIVED)))
+                for name, _, _ in FLOWS)
+
+def median(values):
+    return sorted(values)[len(values) // 2] if values else None
+
+def delay_stats(received):
+    '''
+    one-way delay distribution in ms, jitter as half the spread between p1 and p99
+    '''
+    d = sorted((r - s) * 1000 for _, s, r, _ in received)
+    if not d:
+        return None
+    pick = lambda p: d[min(len(d) - 1, int(p / 100.0 * len(d)))]
+    mean = sum(d) / len(d)
+    return {
+        'p50_ms': pick(50),
+        'p95_ms': pick(95),
+        'p99_ms': pick(99),
+        'mean_ms': mean,
+        'stdev_ms': (sum((x - mean) ** 2 for x in d) / len(d)) ** 0.5,
+        'jitter_ms': (pick(99) - pick(1)) / 2
+    }
+
+def loss_stats(sent, received):
+    '''
+    loss ratio in % of the messages sent, and the number and mean length of the runs of
+    consecutive lost ones
+    '''
+    got = set(seq for seq, _, _, _ in received)
+    bursts = []
+    run = 0
+    for seq, _ in sent:
+        if seq in got:
+            if run:
+                bursts.append(run)
+            run = 0
+        else:
+            run += 1
+    if run:
+        bursts.append(run)
+    lost = sum(bursts)
+    return {
+        'sent': len(sent),
+        'lost': lost,
+        'loss_percent': lost * 100.0 / len(sent) if sent else 0,
+        'bursts': len(bursts),
+        'burst_mean': float(lost) / len(bursts) if bursts else 0
+    }
+
+def throughput(received, start, end, overhead):
+    '''
+    kbit/s received between start and end, counting overhead bytes per message
+    '''
+    if end <= start:
+        return None
+    bits = sum((size + overhead) * 8 for _, _, r, size in received if start <= r < end)
+    return bits / (end - start) / 1000.0
+
+def settle(samples, start, end, width, reduce, target, tolerance):
+    '''
+    seconds from start until the (time, value) samples, reduced per window of width
+    seconds, stay within tolerance of target up to end, None if the last window is off
+    '''
+    windows = [[] for _ in range(int((end - start) / width))]
+    for t, v in samples:
+        i = int((t - start) // width)
+        if 0 <= i < len(windows):
+            windows[i].append(v)
+    settled = None
+    for i, w in enumerate(windows):
+        value = reduce(w)
+        if value is None:
+            continue
+        if abs(value - target) > tolerance:
+            settled = None
+        elif settled is None:
+            settled = i * width
+    return settled
+
+def install(target, cmd, *args):
+    output = target.run('emulator', cmd, *args)[1]
+    failed = [l for l in output.splitlines() if l.startswith('failed:')]
+    for line in failed:
+        print('emulator.py %s %s' % (cmd, line))
+    return not failed
+
+def measure_rule(args):
+    rule_args = ['--direction', args.direction, '--bw', str(args.bw), '--delay', str(args.delay),
+                 '--jitter', str(args.jitter), '--loss', str(args.loss), '--qdelay', str(args.qdelay)]
+    if args.burst is not None:
+        rule_args += ['--burst', str(args.burst)]
+    rates = {'probe': args.probe_load * args.bw, 'load': args.load * args.bw}
+    sizes = {'probe': args.probe_size, 'load': args.size}
+    grace = (args.delay + args.jitter + args.qdelay) / 1000.0 + 1
+    with PathTarget(target_config(args)) as target:
+        installed = install(target, 'init')
+        for _, addr, _ in FLOWS:
+            installed = install(target, 'add', '--ip', addr, *rule_args) and installed
+        flows = run_flows(target, args.direction, args.proto, rates, sizes, args.duration, grace)
+        target.run('emulator', 'uninit')
+
+    probe_sent, probe_received = flows['probe']
+    load_sent, load_received = flows['load']
+    measured = loss_stats(probe_sent, probe_received)
+    measured['delay'] = delay_stats(probe_received)
+    if load_received and load_sent:
+        overhead = UDP_OVERHEAD if args.proto == 'udp' else 0
+        measured['throughput_kbps'] = throughput(load_received, load_received[0][2] + WARMUP, load_sent[-1][1],
+                                                 overhead)
+    else:
+        measured['throughput_kbps'] = None
+    return {
+        'installed': installed,
+        'configured': {
+            'bw': args.bw,
+            'delay': args.delay,
+            'jitter': args.jitter,
+            'loss': args.loss,
+            'burst': args.burst,
+            'qdelay': args.qdelay
+        },
+        'load': {'proto': args.proto, 'kbps': rates['load'], 'size': args.size},
+        'probe': {'kbps': rates['probe'], 'size': args.probe_size},
+        'measured': measured
+    }
+
+def measure_dynamics(args):
+    config = dynem.parse_config(args.dynamics)
+    if config is None or not dynem.validate_config(dict(config, emfilter={'ip': FLOWS[0][1], 'direction': 'uplink'})):
+        print('invalid dynamics %s' % args.dynamics)
+        sys.exit(1)
+    timeline = dynem.Timeline(dict(config, emfilter={'ip': FLOWS[0][1], 'direction': args.direction}))
+    steps = [(0, timeline.rule)]
+    for offset, rule in timeline.updates():
+        if offset >= args.duration * 1000:
+            break
+        steps.append((offset, rule))
+    rules = [rule for _, rule in steps]
+    rates = {'probe': args.probe_load * min(r.bw for r in rules), 'load': args.load * max(r.bw for r in rules)}
+    sizes = {'probe': args.probe_size, 'load': args.size}
+    grace = max(r.delay + r.jitter + r.qdelay for r in rules) / 1000.0 + 1
+
+    with PathTarget(target_config(args)) as target:
+        cfgdir = os.path.join(target.dir, 'dynamics')
+        os.mkdir(cfgdir)
+        for name, addr, _ in FLOWS:
+            with open(os.path.join(cfgdir, name + '.json'), 'w') as f:
+                json.dump(dict(config, emfilter={'ip': addr, 'direction': args.direction}), f)
+        installed = install(target, 'init')
+
+        applied = []
+        player = []
+        def read(p):
+            for line in iter(p.stdout.readline, b''):
+                line = line.decode(errors='replace')
+                m = APPLY_LINE.match(line)
+                if m:
+                    applied.append(time.time() - float(m.group(2)))
+                elif line.startswith('failed:'):
+                    print('dynem.py %s' % line.rstrip())
+        def start_player():
+            p = subprocess.Popen(target.tool('dynem', ['-f', cfgdir]), stdout=subprocess.PIPE,
+                                 stderr=subprocess.STDOUT, env=target.env)
+            reader = threading.Thread(target=read, args=(p,))
+            reader.start()
+            player.extend((p, reader))
+        # the player starts after the flows, so the first step has traffic from its start
+        flows = run_flows(target, args.direction, args.proto, rates, sizes, args.duration, grace, start_player)
+        p, reader = player
+        p.send_signal(signal.SIGINT)
+        p.wait()
+        reader.join()
+        target.run('emulator', 'uninit')
+
+    if not applied:
+        print('no dynamics step within --duration')
+        sys.exit(1)
+    # the steps are due on the clock of the player, which the first one gives
+    start = min(applied)
+    probe_sent, probe_received = flows['probe']
+    load_sent, load_received = flows['load']
+    end = min(probe_sent[-1][1], load_sent[-1][1])
+    overhead = UDP_OVERHEAD if args.proto == 'udp' else 0
+    width = args.window
+    rate = lambda w: sum(w) * 8 / width / 1000.0
+    delays = [(s, (r - s) * 1000) for _, s, r, _ in probe_received]
+    sizes_at = [(r, size + overhead) for _, _, r, size in load_received]
+
+    results = []
+    prev = None
+    for i, (offset, rule) in enumerate(steps):
+        t0 = start + offset / 1000.0
+        t1 = start + steps[i + 1][0] / 1000.0 if i + 1 < len(steps) else end
+        if t0 >= end:
+            break
+        t1 = min(t1, end)
+        middle = (t0 + t1) / 2
+        step = {
+            'offset_s': offset / 1000.0,
+            'bw': rule.bw,
+            'delay': rule.delay,
+            'jitter': rule.jitter,
+            'loss': rule.loss,
+            'burst': rule.burst,
+            'delay_p50_ms': median([d for s, d in delays if middle <= s < t1]),
+            'throughput_kbps': throughput(load_received, middle, t1, overhead),
+            'loss_percent': loss_stats([x for x in probe_sent if t0 <= x[1] < t1],
+                                       [x for x in probe_received if t0 <= x[1] < t1])['loss_percent'],
+            'delay_settle_ms': None,
+            'throughput_settle_ms': None
+        }
+        if prev is None or rule.delay != prev.delay or rule.jitter != prev.jitter:
+            tolerance = max(DELAY_FLOOR_MS, args.tolerance * rule.delay) + rule.jitter
+            s = settle(delays, t0, t1, width, median, rule.delay, tolerance)
+            step['delay_settle_ms'] = None if s is None else s * 1000
+        if prev is None or rule.bw != prev.bw:
+            s = settle(sizes_at, t0, t1, width, rate, rule.bw, args.tolerance * rule.bw)
+            step['throughput_settle_ms'] = None if s is None else s * 1000
+        results.append(step)
+        prev = rule
+    return {
+        'installed': installed,
+        'dynamics': args.dynamics,
+        'load': {'proto': args.proto, 'kbps': rates['load'], 'size': args.size},
+        'probe': {'kbps': rates['probe'], 'size': args.probe_size},
+        'window_s': width,
+        'tolerance': args.tolerance,
+        'steps': results
+    }
+
+def target_config(args):
+    return {'numifbs': len(FLOWS), 'backend': args.backend, 'topology': args.topology, 'numrules': len(FLOWS)}
+
+def fmt(value, spec='%.1f'):
+    return '-' if value is None else spec % value
+
+def report_rule(result):
+    c, m = result['configured'], result['measured']
+    d = m['delay'] or {}
+    error = lambda v, ref: '' if v is None or not ref else '  (%+.1f%%)' % ((v - ref) * 100.0 / ref)
+    lines = [
+        '%-20s %10s %10s' % ('', 'configured', 'measured'),
+        '%-20s %10d %10s%s' % ('throughput kbit/s', c['bw'], fmt(m['throughput_kbps']),
+                               error(m['throughput_kbps'], c['bw'])),
+        '%-20s %10d %10s%s' % ('delay p50 ms', c['delay'], fmt(d.get('p50_ms')), error(d.get('p50_ms'), c['delay'])),
+        '%-20s %10s %10s' % ('delay p95/p99 ms', '', '%s/%s' % (fmt(d.get('p95_ms')), fmt(d.get('p99_ms')))),
+        '%-20s %10d %10s' % ('jitter ms', c['jitter'], fmt(d.get('jitter_ms'))),
+        '%-20s %10d %10s' % ('loss %', c['loss'], fmt(m['loss_percent'], '%.2f')),
+        '%-20s %10s %10s  (%d bursts of %d sent)' % ('loss burst', fmt(c['burst'], '%d'), fmt(m['burst_mean'], '%.2f'),
+                                                   m['bursts'], m['sent'])
+    ]
+    return '\n'.join(lines)
+
+def report_dynamics(result):
+    lines = ['%8s %7s %6s %5s %9s %9s %7s %12s %15s' % (
+        'offset s', 'bw', 'delay', 'loss', 'kbit/s', 'delay ms', 'loss %', 'bw settle ms', 'delay settle ms')]
+    for s in result['steps']:
+        lines.append('%8.1f %7d %6d %5d %9s %9s %7s %12s %15s' % (
+            s['offset_s'], s['bw'], s['delay'], s['loss'], fmt(s['throughput_kbps']), fmt(s['delay_p50_ms']),
+            fmt(s['loss_percent'], '%.2f'), fmt(s['throughput_settle_ms'], '%.0f'),
+            fmt(s['delay_settle_ms'], '%.0f')))
+    return '\n'.join(lines)
+
+def main():
+    if len(sys.argv) > 1 and sys.argv[1] == '--send':
+        proto, src, dst, port, rate, size, duration, log = sys.argv[2:10]
+        send(proto, src, dst, int(port), float(rate), int(size), float(duration), log)
+        return
+    if len(sys.argv) > 1 and sys.argv[1] == '--receive':
+        proto, addr, port, size, log = sys.argv[2:7]
+        receive(proto, addr, int(port), int(size), log)
+        return
+
+    arg_parser = argparse.ArgumentParser()
+    arg_parser.add_argument('--bw', '-b', type=int, help='rate limit in kbps', default=2000)
+    arg_parser.add_argument('--delay', type=int, help='delay in ms', default=200)
+    arg_parser.add_argument('--jitter', '-j', type=int, help='jitter in ms', default=0)
+    arg_parser.add_argument('--loss', '-l', type=int, help='loss ratio in percentage', default=2)
+    arg_parser.add_argument('--burst', type=int, help='burst length in packets', default=4)
+    arg_parser.add_argument('--qdelay', '-q', type=int, help='maxinum queuing delay in ms', default=100)
+    arg_parser.add_argument('--direction', '-c', choices=['uplink', 'downlink'], default='uplink')
+    arg_parser.add_argument('--dynamics', help='dynem.py configuration to play instead of the rule, its filter is ignored')
+    arg_parser.add_argument('--duration', '-d', type=float, help='seconds of traffic', default=20)
+    arg_parser.add_argument('--proto', choices=['udp', 'tcp'], help='protocol of the load flow', default='udp')
+    arg_parser.add_argument('--load', type=float, help='rate of the udp load flow over the rate limit', default=1.5)
+    arg_parser.add_argument('--size', type=int, help='bytes of the load flow messages', default=1400)
+    arg_parser.add_argument('--probe-load', type=float, help='rate of the probe flow over the rate limit', default=0.5)
+    arg_parser.add_argument('--probe-size', type=int, help='bytes of the probe flow messages', default=100)
+    arg_parser.add_argument('--window', '-w', type=float, help='seconds the dynamics steps are measured over', default=0.2)
+    arg_parser.add_argument('--tolerance', type=float, help='fraction a settled value may be off', default=0.1)
+    arg_parser.add_argument('--topology', choices=['dedicated', 'shared'], default='dedicated')
+    arg_parser.add_argument('--backend', choices=['shell', 'netlink'], default='shell')
+    arg_parser.add_argument('--output', '-o', help='json file to write the results to', default='fidelity.json')
+    args = arg_parser.parse_args()
+
+    if min(args.size, args.probe_size) < HEADER.size:
+        arg_parser.error('messages take at least %d bytes' % HEADER.size)
+    if args.duration <= WARMUP:
+        arg_parser.error('--duration must be over %g seconds' % WARMUP)
+
+    if args.dynamics:
+        result = measure_dynamics(args)
+        print(report_dynamics(result))
+    else:
+        result = measure_rule(args)
+        print(report_rule(result))
+    if not result['installed']:
+        print('some rules failed to install, the numbers are not the configured ones')
+    with open(args.output, 'w') as f:
+        json.dump(result, f, indent=4)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,172 @@
+'''
+throwaway network namespaces for the benchmarks
+
+A Topology is two namespaces, tx and rx, joined by one veth pair, so the
+benchmarks can install rules and push traffic without touching the host
+interfaces. A Bridge is one namespace holding both ends of a veth pair and the
+ifb devices, where emulator.py itself can run, and a Path puts client and
+server namespaces on each side of such a bridge. Needs root and iproute2.
+'''
+import os
+import subprocess
+import sys
+
+# so the benchmarks can import emulator.py from the directory above
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir))
+
+class Topology(object):
+
+    def __init__(self, prefix='piem-bench', tx_addr='10.0.0.250', rx_addr='10.0.0.254'):
+        self.tx = prefix + '-tx'
+        self.rx = prefix + '-rx'
+        self.tx_dev = 'veth-tx'
+        self.rx_dev = 'veth-rx'
+        self.tx_addr = tx_addr
+        self.rx_addr = rx_addr
+
+    def __enter__(self):
+        self.teardown()
+        for ns in (self.tx, self.rx):
+            subprocess.check_call(['ip', 'netns', 'add', ns])
+        subprocess.check_call(['ip', 'link', 'add', self.tx_dev, 'netns', self.tx,
+                               'type', 'veth', 'peer', 'name', self.rx_dev, 'netns', self.rx])
+        for ns, dev, addr in ((self.tx, self.tx_dev, self.tx_addr), (self.rx, self.rx_dev, self.rx_addr)):
+            self.check_call(ns, ['ip', 'addr', 'add', addr + '/24', 'dev', dev])
+            self.check_call(ns, ['ip', 'link', 'set', dev, 'up'])
+            self.check_call(ns, ['ip', 'link', 'set', 'lo', 'up'])
+        return self
+
+    def __exit__(self, *exc):
+        self.teardown()
+
+    def teardown(self):
+        with open(os.devnull, 'w') as devnull:
+            for ns in (self.tx, self.rx):
+                subprocess.call(['ip', 'netns', 'del', ns], stderr=devnull)
+
+    def command(self, ns, args):
+        return ['ip', 'netns', 'exec', ns] + list(args)
+
+    def check_call(self, ns, args):
+        subprocess.check_call(self.command(ns, args))
+
+    def check_output(self, ns, args):
+        return subprocess.check_output(self.command(ns, args)).decode()
+
+    def batch(self, ns, tool, ops):
+        '''
+        runs emulator ops with "tool -batch -" inside ns
+        '''
+        p = subprocess.Popen(self.command(ns, [tool, '-batch', '-']), stdin=subprocess.PIPE)
+        p.communicate(''.join('%s\n' % op for op in ops).encode())
+        if p.returncode != 0:
+            raise RuntimeError('%s batch failed in %s' % (tool, ns))
+
+    def python(self, ns, script, args):
+        '''
+        output of a python script run inside ns with the interpreter running this one
+        '''
+        return self.check_output(ns, [sys.executable, script] + list(args))
+
+class Bridge(object):
+
+    '''
+    the interfaces emulator.py expects, a veth pair standing for ingress and egress and
+    numifbs ifb devices, in namespace name, created there since modprobe only makes
+    them in the host namespace
+    '''
+
+    def __init__(self, name='piem-bench-br', numifbs=2):
+        self.ns = name
+        self.ingress = 'veth-in'
+        self.egress = 'veth-out'
+        self.numifbs = numifbs
+
+    def __enter__(self):
+        self.teardown()
+        subprocess.check_call(['ip', 'netns', 'add', self.ns])
+        self.check_call(['ip', 'link', 'add', self.ingress, 'type', 'veth', 'peer', 'name', self.egress])
+        devs = [self.ingress, self.egress, 'lo']
+        for i in range(self.numifbs):
+            self.check_call(['ip', 'link', 'add', 'ifb%d' % i, 'type', 'ifb'])
+            devs.append('ifb%d' % i)
+        for dev in devs:
+            self.check_call(['ip', 'link', 'set', dev, 'up'])
+        return self
+
+    def __exit__(self, *exc):
+        self.teardown()
+
+    def teardown(self):
+        with open(os.devnull, 'w') as devnull:
+            subprocess.call(['ip', 'netns', 'del', self.ns], stderr=devnull)
+
+    def command(self, args):
+        return ['ip', 'netns', 'exec', self.ns] + list(args)
+
+    def check_call(self, args):
+        subprocess.check_call(self.command(args))
+
+class Path(object):
+
+    '''
+    client and server namespaces joined through a bridge in a third one, where
+    emulator.py runs on ingress, the port facing the clients, and egress, the one facing
+    the server, with numifbs ifb devices
+    '''
+
+    def __init__(self, prefix='piem-bench', clients=('10.0.0.1',), server='10.0.0.2', numifbs=2):
+        self.client = prefix + '-client'
+        self.server = prefix + '-server'
+        self.bridge = prefix + '-bridge'
+        self.client_dev = 'veth-c'
+        self.server_dev = 'veth-s'
+        self.ingress = 'veth-in'
+        self.egress = 'veth-out'
+        self.clients = list(clients)
+        self.server_addr = server
+        self.numifbs = numifbs
+
+    def __enter__(self):
+        self.teardown()
+        for ns in (self.client, self.server, self.bridge):
+            subprocess.check_call(['ip', 'netns', 'add', ns])
+        subprocess.check_call(['ip', 'link', 'add', self.client_dev, 'netns', self.client,
+                               'type', 'veth', 'peer', 'name', self.ingress, 'netns', self.bridge])
+        subprocess.check_call(['ip', 'link', 'add', self.server_dev, 'netns', self.server,
+                               'type', 'veth', 'peer', 'name', self.egress, 'netns', self.bridge])
+        self.check_call(self.bridge, ['ip', 'link', 'add', 'br0', 'type', 'bridge'])
+        devs = ['lo', 'br0', self.ingress, self.egress]
+        for dev in (self.ingress, self.egress):
+            self.check_call(self.bridge, ['ip', 'link', 'set', dev, 'master', 'br0'])
+        for i in range(self.numifbs):
+            self.check_call(self.bridge, ['ip', 'link', 'add', 'ifb%d' % i, 'type', 'ifb'])
+            devs.append('ifb%d' % i)
+        for dev in devs:
+            self.check_call(self.bridge, ['ip', 'link', 'set', dev, 'up'])
+        for ns, dev, addrs in ((self.client, self.client_dev, self.clients),
+                               (self.server, self.server_dev, [self.server_addr])):
+            for addr in addrs:
+                self.check_call(ns, ['ip', 'addr', 'add', addr + '/24', 'dev', dev])
+            self.check_call(ns, ['ip', 'link', 'set', dev, 'up'])
+            self.check_call(ns, ['ip', 'link', 'set', 'lo', 'up'])
+        return self
+
+    def __exit__(self, *exc):
+        self.teardown()
+
+    def teardown(self):
+        with open(os.devnull, 'w') as devnull:
+            for ns in (self.client, self.server, self.bridge):
+                subprocess.call(['ip', 'netns', 'del', ns], stderr=devnull)
+
+    def command(self, ns, args):
+        return ['ip', 'netns', 'exec', ns] + list(args)
+
+    def check_call(self, ns, args):
+        subprocess.check_call(self.command(ns, args))
+
+def snmp_counter(topo, ns, proto, name):
+    lines = [l.split() for l in topo.check_output(ns, ['cat', '/proc/net/snmp']).splitlines()
+             if l.startswith(proto + ':')]
+    return int(lines[1][lines[0].index(name)])
@@ -0,0 +1,134 @@
+#!/usr/bin/python
+'''
+blocks the traffic of addresses, or their flows with a remote port, in the ipsets of fw.sh
+
+"fw.sh init" creates the sets and the two iptables rules dropping what they match,
+once, and blocking is then adding an element to a set, which the kernel looks up in
+a hash whatever the number of elements:
+
+    piem-block-all   hash:net       addresses all of whose traffic is dropped
+    piem-block-port  hash:net,port  address and protocol:remote port
+    piem-block       list:set       of the two, matched by
+        iptables -I FORWARD -m set --match-set piem-block src,dst -j DROP
+        iptables -I FORWARD -m set --match-set piem-block dst,src -j DROP
+
+The elements are added and deleted over nfnetlink with rtnl.Ipset, a few microseconds
+each, or with "ipset -exist restore" when the socket can't be opened:
+
+    b = Blocker()
+    b.block([em.Filter('uplink', '192.168.1.5', dstport=5004, protocol='udp')])
+    b.unblock([em.Filter('uplink', '192.168.1.5', dstport=5004, protocol='udp')])
+'''
+import socket
+import subprocess
+import emulator as em
+
+ALL_SET = 'piem-block-all'
+PORT_SET = 'piem-block-port'
+PROTOCOL_NAMES = dict((v, k) for k, v in em.IP_PROTOCOLS.items())
+
+class SetOp(em.Op):
+
+    '''
+    adds, deletes or tests one element of an ipset
+    '''
+
+    tool = 'ipset'
+
+    def __init__(self, verb, setname, ip, proto=None, port=None):
+        em.Op.__init__(self, verb, None)
+        self.setname = setname
+        self.ip = ip
+        self.proto = proto
+        self.port = port
+
+    def element(self):
+        '''
+        the element as the ipset command takes it
+        '''
+        if self.port is None:
+            return self.ip
+        return '%s,%s:%d' % (self.ip, PROTOCOL_NAMES[self.proto], self.port)
+
+    def __str__(self):
+        return '%s %s %s' % (self.verb, self.setname, self.element())
+
+def set_op(verb, emfilter):
+    '''
+    the op on the element of a filter, its flows with the remote port when it has tcp or
+    udp and that port, the destination one of uplink and the source one of downlink, all
+    the traffic of its address when it has neither. Either blocks both directions.
+    Raises ValueError for the filters the sets can't hold, which blocking the whole
+    address would widen: tcp or udp without a port, a port without them, the local
+    port, tos and ptype
+    '''
+    port, local = emfilter.dstport, emfilter.srcport
+    if emfilter.direction != 'uplink':
+        port, local = local, port
+    if emfilter.tos is not None or emfilter.ptype is not None:
+        raise ValueError('%s %s: tos and ptype can\'t be blocked' % (emfilter.direction, emfilter.ip))
+    if local is not None:
+        raise ValueError('%s %s: only the remote port can be blocked, dstport of uplink and srcport of downlink' % (
+            emfilter.direction, emfilter.ip))
+    if port is None:
+        if emfilter.protocol in em.IP_PROTOCOLS:
+            raise ValueError('%s %s: blocking %s needs its remote port' % (
+                emfilter.direction, emfilter.ip, emfilter.protocol))
+        return SetOp(verb, ALL_SET, emfilter.ip)
+    if emfilter.protocol not in em.IP_PROTOCOLS:
+        raise ValueError('%s %s: blocking a port needs protocol tcp or udp' % (emfilter.direction, emfilter.ip))
+    return SetOp(verb, PORT_SET, emfilter.ip, em.IP_PROTOCOLS[emfilter.protocol], port)
+
+def _run_restore(ops):
+    content = ''.join('%s\n' % op for op in ops)
+    try:
+        p = subprocess.Popen(['ipset', '-exist', 'restore'], stdin=subprocess.PIPE,
+                             stdout=subprocess.PIPE, stderr=subprocess.STDOUT)
+    except OSError as e:
+        return [(None, 'ipset: %s' % e)]
+    output = p.communicate(content.encode())[0].decode(errors='replace')
+    return [(None, output)] if p.returncode != 0 else []
+
+class Blocker(object):
+
+    '''
+    adds and removes the elements of filters, creating the sets with fw.sh first
+    '''
+
+    def __init__(self):
+        em.exec_shell('fw.sh init')
+        self.netlink = None
+        try:
+            import rtnl
+            self.netlink = rtnl.Ipset()
+        except (ImportError, OSError, socket.error) as e:
+            print('ipset netlink not available, fall back to the ipset command: %s' % e)
+
+    def run(self, ops):
+        for op in ops:
+            print('ipset %s' % op)
+        if em.DRY_RUN or not ops:
+            return True
+        with em.span('ipset', ops=len(ops)):
+            errors = self.netlink.run(ops) if self.netlink is not None else _run_restore(ops)
+        for op, message in errors:
+            print('failed: ipset %s\n%s' % ('' if op is None else op, message))
+        return not errors
+
+    def apply(self, block=(), unblock=()):
+        '''
+        unblocks and blocks filters in one go
+        '''
+        return self.run([set_op('del', f) for f in unblock] + [set_op('add', f) for f in block])
+
+    def block(self, filters):
+        return self.apply(block=filters)
+
+    def unblock(self, filters):
+        return self.apply(unblock=filters)
+
+    def is_blocked(self, emfilter):
+        op = set_op('test', emfilter)
+        if self.netlink is None:
+            return subprocess.call(['ipset', '-q', 'test', op.setname, op.element()]) == 0
+        return not self.netlink.run([op])
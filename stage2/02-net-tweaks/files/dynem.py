@@ -1,10 +1,13 @@
 #!/usr/bin/python
 import argparse
+import heapq
 import json
+import os
 import signal
 import sys
 import time
 import emulator as em
+import timeline as tl
 
 '''
 emulate timeseries network dynamics loading from file with format below:
@@ -53,21 +56,86 @@ The bandwidth is 2 mbps normally, and will
 4. loop back above phases.
 
 For those network parameters not specified in the 'dynamics' section, it will remain the same as before.
+
+A step with "blocked": true drops the traffic of the filter both ways for its duration, like an
+outage, by adding it to the ipsets of fw.sh, see blocker.py. "blocked" in the rule blocks it
+from the start.
+
+Instead of "dynamics", "generators" can set the parameters at random every "step" seconds,
+from a seeded Markov chain, a bounded random walk or Gilbert-Elliott outages, see dyngen.py.
+
+"interval" and "duration" are in seconds and can have fractions down to a millisecond, like 0.25.
+The steps are scheduled against absolute deadlines, so the time taken by the updates doesn't
+accumulate over a long trace, and how late each step starts is summarized on exit.
 '''
 
+# CLOCK_MONOTONIC on python 2 as well, so stepping the wall clock doesn't move deadlines
+monotonic = em.monotonic
+
+# pattern names of the sls parameters met so far
+gPatterns = {}
+
+def to_ms(seconds):
+    '''
+    interval/duration in seconds, fractions are kept to millisecond resolution
+    '''
+    return int(round(float(seconds) * 1000))
+
+class Scheduler(object):
+
+    '''
+    waits for absolute deadlines (milliseconds since start) on the monotonic clock, so the
+    time an update takes doesn't delay the ones after it, and records how late each step
+    is woken up in a histogram of 0.1 ms buckets to keep memory flat on long traces
+    '''
+
+    BUCKET_MS = 0.1
+
+    def __init__(self):
+        self.start = monotonic()
+        self.lateness = {}
+        self.steps = 0
+
+    def wait_until(self, offset_ms):
+        deadline = self.start + offset_ms / 1000.0
+        now = monotonic()
+        if deadline > now:
+            time.sleep(deadline - now)
+            now = monotonic()
+        bucket = int((now - deadline) * 1000 / self.BUCKET_MS)
+        self.lateness[bucket] = self.lateness.get(bucket, 0) + 1
+        self.steps += 1
+
+    def percentile(self, p):
+        rank = p / 100.0 * self.steps
+        count = 0
+        for bucket in sorted(self.lateness):
+            count += self.lateness[bucket]
+            if count >= rank:
+                return bucket * self.BUCKET_MS
+        return 0
+
+    def summary(self):
+        if self.steps == 0:
+            return 'no steps run'
+        return 'lateness over %d steps: p50 %.1f ms, p99 %.1f ms, max %.1f ms' % (
+            self.steps, self.percentile(50), self.percentile(99), max(self.lateness) * self.BUCKET_MS)
+
 def parse_config(cfg):
     try:
         with open(cfg, 'r') as f:
             content = f.read()
             try:
-                config = json.loads(content)
+                return json.loads(content)
             except ValueError as error:
                 print("invalid json: %s" % error)
-            return config
     except IOError:
         print('error reading file') 
 
-def validate_config(cfg):
+def validate_rule(cfg):
+    if cfg is None:
+        return False
+
     if 'emfilter' not in cfg:
         print('error, no filter specified!')
         return False
@@ -80,10 +148,36 @@ def validate_config(cfg):
         print('error, no direction specified!')
         return False
 
+    try:
+        em.Filter.from_dict(cfg['emfilter'])
+    except ValueError as e:
+        print('error, invalid filter: %s' % e)
+        return False
+
+    return True
+
+def validate_config(cfg):
+    if not validate_rule(cfg):
+        return False
+
+    if 'generators' in cfg:
+        try:
+            # numpy is only needed by the configurations with generators
+            import dyngen
+            dyngen.Generator(cfg)
+        except (ImportError, KeyError, TypeError, ValueError) as e:
+            print('error, invalid generators: %s' % e)
+            return False
+        return True
+
     if 'dynamics' not in cfg:
         print('error, no dynamics specified!')
         return False
 
+    if len(cfg['dynamics']) == 0:
+        print('error, empty dynamics')
+        return False
+
     for item in cfg['dynamics']:
         if 'duration' not in item:
             print('error, no duration specified')
@@ -92,9 +186,38 @@ def validate_config(cfg):
             print('error, no interval specified')
             return False
 
+    if sum(to_ms(item['interval']) + to_ms(item['duration']) for item in cfg['dynamics']) <= 0:
+        print('error, dynamics take no time')
+        return False
+
+    if cfg.get('blocked', False) or any(item.get('blocked', False) for item in cfg['dynamics']):
+        import blocker as bl
+        try:
+            bl.set_op('add', em.Filter.from_dict(cfg['emfilter']))
+        except ValueError as e:
+            print('error, blocked: %s' % e)
+            return False
+
     return True
 
-def run(config):
+def resolve_sls(sls):
+    '''
+    the pattern name of an sls value, parameters like {"loss": 5, "burst": 3} get theirs
+    from the pattern cache of slsgen.py
+    '''
+    if not isinstance(sls, dict):
+        return sls
+    key = json.dumps(sls, sort_keys=True)
+    if key not in gPatterns:
+        # numpy is only needed by the configurations generating patterns
+        import slsgen
+        gPatterns[key] = slsgen.PatternCache().get(sls)
+    return gPatterns[key]
+
+def base_rule(config):
+    '''
+    the rule of a configuration before its dynamics
+    '''
     dire = config['emfilter']['direction']
     ip = config['emfilter']['ip']
     tos = config['emfilter'].get('tos', None)
@@ -108,59 +231,274 @@ def run(config):
     jitter = config.get('jitter', 0)
     delay = config.get('delay', 10)
     burst = config.get('burst', None)
-    sls = config.get('sls', None)
+    sls = resolve_sls(config.get('sls', None))
 
     f = em.Filter(dire, ip, tos, srcport, dstport, ptype, protocol)
-    r = em.Rule(f, bw, loss, qdelay, jitter, delay, dire, burst, sls)
-    em.add_rule(r)
-
-    rlist = []
-    for dyn in config['dynamics']:
-        dyn_bw = dyn.get('bw', bw)
-        dyn_loss = dyn.get('loss', loss)
-        dyn_qdelay = dyn.get('qdelay', qdelay)
-        dyn_jitter = dyn.get('jitter', jitter)
-        dyn_delay = dyn.get('delay', delay)
-        dyn_burst = dyn.get('burst', burst)
-        dyn_sls = dyn.get('sls', sls)
-        dyn_r = em.Rule(f, dyn_bw, dyn_loss, dyn_qdelay, dyn_jitter, dyn_delay, dire, dyn_burst, dyn_sls)
-        rlist.append({'rule': dyn_r, 'interval': dyn['interval'], 'duration': dyn['duration']})
- 
-    if len(rlist) == 0:
-        print('error, empty rule')
-        return
-    
-    idx = 0
-    signal.signal(signal.SIGINT, signal.default_int_handler)
-    while True:
-        try:
-            next_rule = rlist[idx]['rule']
-            wait_sec = rlist[idx]['interval']
-            last_sec = rlist[idx]['duration']
+    rule = em.Rule(f, bw, loss, qdelay, jitter, delay, dire, burst, sls)
+    rule.blocked = bool(config.get('blocked', False))
+    return rule
+
+def blocked(rule):
+    '''
+    whether a rule of a timeline blocks its traffic, None for the rules of binary and
+    generated timelines, which leave it as the base rule has it
+    '''
+    return getattr(rule, 'blocked', None)
+
+class Timeline(object):
+
+    '''
+    the rule of one configuration and the updates its dynamics make to it
+    '''
+
+    def __init__(self, config):
+        self.rule = base_rule(config)
+        f, dire = self.rule.emfilter, self.rule.direction
+        bw, loss, qdelay, jitter, delay, burst, sls = (self.rule.bw, self.rule.loss, self.rule.qdelay,
+            self.rule.jitter, self.rule.delay, self.rule.burst, self.rule.sls)
+
+        self.rlist = []
+        for dyn in config['dynamics']:
+            dyn_bw = dyn.get('bw', bw)
+            dyn_loss = dyn.get('loss', loss)
+            dyn_qdelay = dyn.get('qdelay', qdelay)
+            dyn_jitter = dyn.get('jitter', jitter)
+            dyn_delay = dyn.get('delay', delay)
+            dyn_burst = dyn.get('burst', burst)
+            dyn_sls = resolve_sls(dyn.get('sls', sls))
+            dyn_r = em.Rule(f, dyn_bw, dyn_loss, dyn_qdelay, dyn_jitter, dyn_delay, dire, dyn_burst, dyn_sls)
+            dyn_r.blocked = bool(dyn.get('blocked', self.rule.blocked))
+            self.rlist.append({'rule': dyn_r, 'interval': to_ms(dyn['interval']), 'duration': to_ms(dyn['duration'])})
+
+        self.compile()
+
+    def compile(self):
+        '''
+        precomputes one loop of the dynamics as (offset in ms, rule) steps, dropping the
+        steps which leave the tc parameters as they are, the first loop starts from the
+        base rule and the following ones from the state the previous loop ended in
+        '''
+        steps = []
+        offset = 0
+        for idx, dyn in enumerate(self.rlist):
+            offset += dyn['interval']
+            steps.append((offset, dyn['rule']))
+            offset += dyn['duration']
+
+            if self.rlist[(idx + 1) % len(self.rlist)]['interval'] != 0:
+                steps.append((offset, self.rule))
+        self.period = offset
+
+        self.blocking = any(blocked(rule) for _, rule in steps)
+
+        def prune(prev):
+            pruned = []
+            for offset, rule in steps:
+                if rule.changed_components(prev) or blocked(rule) != blocked(prev):
+                    pruned.append((offset, rule))
+                prev = rule
+            return pruned
+
+        self.first = prune(self.rule)
+        self.steady = prune(steps[-1][1])
+        print('%s %s: %d steps per loop, %d without any change skipped' % (
+            self.rule.emfilter.ip, self.rule.direction, len(steps), len(steps) - len(self.steady)))
+
+    def updates(self):
+        '''
+        yields (offset in ms, rule) for ever, looping over the compiled dynamics, ends
+        right away if the dynamics never change anything
+        '''
+        for step in self.first:
+            yield step
+        if not self.steady:
+            return
+        start = 0
+        while True:
+            start += self.period
+            for offset, rule in self.steady:
+                yield start + offset, rule
 
-            print('sleep for %s seconds ...' % wait_sec)
-            time.sleep(wait_sec)
-            em.change_rule(next_rule)
+class MappedTimeline(object):
 
-            print('unstable for %s seconds ...' % last_sec)
-            time.sleep(last_sec)
+    '''
+    the rule of a binary timeline and its updates, read from the mapped file one record
+    at a time as they fall due, so neither startup time nor memory grow with its length
+    '''
 
-            idx += 1
-            if idx >= len(rlist):
-                idx = 0
+    def __init__(self, timeline):
+        self.timeline = timeline
+        self.rule = base_rule(timeline.config)
+        print('%s %s: %d steps per loop, mapped' % (self.rule.emfilter.ip, self.rule.direction, len(timeline)))
 
-            if rlist[idx]['interval'] != 0:
-                print('rollback')
-                em.change_rule(r)
+    def updates(self):
+        '''
+        yields (offset in ms, rule) for ever like Timeline.updates(), the records which
+        leave the tc parameters as they are skipped, ends once a whole loop changes nothing
+        '''
+        f, dire, sls = self.rule.emfilter, self.rule.direction, self.rule.sls
+        prev = self.rule
+        start = 0
+        while True:
+            changed = False
+            for offset, bw, loss, delay, jitter, qdelay, burst in self.timeline:
+                rule = em.Rule(f, bw, loss, qdelay, jitter, delay, dire, burst, sls)
+                if rule.changed_components(prev):
+                    changed = True
+                    prev = rule
+                    yield start + offset, rule
+            if not changed or self.timeline.period == 0:
+                return
+            start += self.timeline.period
+
+class GeneratedTimeline(object):
+
+    '''
+    the rule of a configuration with generators and its updates, computed a chunk of
+    steps at a time, the next chunk while waiting for the last step of the one before
+    '''
+
+    def __init__(self, config):
+        import dyngen
+        self.rule = base_rule(config)
+        self.generator = dyngen.Generator(config)
+        print('%s %s: generated every %d ms, seed %s' % (self.rule.emfilter.ip, self.rule.direction,
+                                                         self.generator.step_ms, config.get('seed', 0)))
+
+    def updates(self):
+        '''
+        yields (offset in ms, rule) for ever like Timeline.updates(), the steps which
+        leave the tc parameters as they are skipped
+        '''
+        f, dire, burst, sls = self.rule.emfilter, self.rule.direction, self.rule.burst, self.rule.sls
+        prev = self.rule
+        for offset, p in self.generator.steps():
+            rule = em.Rule(f, p['bw'], p['loss'], p['qdelay'], p['jitter'], p['delay'], dire, burst, sls)
+            if rule.changed_components(prev):
+                prev = rule
+                yield offset, rule
+
+def make_timeline(config):
+    '''
+    the timeline of a binary timeline file or of a configuration with dynamics or generators
+    '''
+    if isinstance(config, tl.TimelineFile):
+        return MappedTimeline(config)
+    if 'generators' in config:
+        return GeneratedTimeline(config)
+    return Timeline(config)
+
+def set_blocked(blocker, timelines, state, due):
+    '''
+    blocks and unblocks the timelines whose due rule changes their block state, in one go
+    '''
+    block, unblock = [], []
+    for idx in sorted(due):
+        want = blocked(due[idx])
+        if want is None or want == state[idx]:
+            continue
+        state[idx] = want
+        (block if want else unblock).append(timelines[idx].rule.emfilter)
+    if block or unblock:
+        blocker.apply(block, unblock)
+
+def run(configs):
+    '''
+    plays the timelines of all configurations from one loop, the updates falling due at
+    the same time are merged into one change
+    '''
+    try:
+        timelines = [make_timeline(config) for config in configs]
+    except (ValueError, EnvironmentError) as e:
+        print('invalid sls pattern: %s' % e)
+        sys.exit(1)
+    em.submit('add', [t.rule for t in timelines])
+
+    # the block state of each timeline, applied before the tc changes of a step
+    state = [False] * len(timelines)
+    blocker = None
+    if any(blocked(t.rule) or getattr(t, 'blocking', False) for t in timelines):
+        import blocker as bl
+        blocker = bl.Blocker()
+        set_blocked(blocker, timelines, state, dict((idx, t.rule) for idx, t in enumerate(timelines)))
+
+    # heap of (offset, timeline index, sequence, rule), the sequence keeps the updates of
+    # one timeline at the same offset in order
+    heap = []
+    updates = [t.updates() for t in timelines]
+    for idx, it in enumerate(updates):
+        for offset, rule in it:
+            heap.append((offset, idx, 0, rule))
+            break
+    heapq.heapify(heap)
+
+    scheduler = Scheduler()
+    signal.signal(signal.SIGINT, signal.default_int_handler)
+    while True:
+        try:
+            if not heap:
+                # nothing changes any more, keep the rules until interrupted
+                time.sleep(3600)
+                continue
+            offset = heap[0][0]
+            due = {}
+            while heap and heap[0][0] == offset:
+                _, idx, seq, rule = heapq.heappop(heap)
+                # only the last state of a timeline at this offset needs to be applied
+                due[idx] = rule
+                for next_offset, next_rule in updates[idx]:
+                    heapq.heappush(heap, (next_offset, idx, seq + 1, next_rule))
+                    break
+
+            scheduler.wait_until(offset)
+            print('apply %d updates at %.3f seconds' % (len(due), offset / 1000.0))
+            if blocker is not None:
+                set_blocked(blocker, timelines, state, due)
+            em.submit('change', [due[idx] for idx in sorted(due)])
         except KeyboardInterrupt:
             print('\n\nclear rules')
-            em.remove_rule(r)
+            if blocker is not None:
+                blocker.unblock([timelines[idx].rule.emfilter for idx in range(len(timelines)) if state[idx]])
+            em.submit('remove', [t.rule for t in timelines])
+            print(scheduler.summary())
             sys.exit()
 
+def load_configs(paths):
+    '''
+    configuration files or binary timelines, a directory stands for all the .cfg, .json
+    and .tl files in it
+    '''
+    configs = []
+    for path in paths:
+        if os.path.isdir(path):
+            files = sorted(os.path.join(path, name) for name in os.listdir(path)
+                           if name.endswith('.cfg') or name.endswith('.json') or name.endswith('.tl'))
+        else:
+            files = [path]
+        for cfg in files:
+            if tl.is_timeline(cfg):
+                try:
+                    timeline = tl.TimelineFile(cfg)
+                except (ValueError, EnvironmentError) as e:
+                    print('invalid timeline %s: %s' % (cfg, e))
+                    return None
+                if not validate_rule(timeline.config):
+                    print('invalid configure %s' % cfg)
+                    return None
+                configs.append(timeline)
+                continue
+            config = parse_config(cfg)
+            if not validate_config(config):
+                print('invalid configure %s' % cfg)
+                return None
+            configs.append(config)
+    return configs
+
 def main():
     arg_parser = argparse.ArgumentParser()
     arg_parser.add_argument('--dryrun', action='store_true', help='Dry run', default=False)
-    arg_parser.add_argument('--cfg', '-f', help='configuration file', required=True)
+    arg_parser.add_argument('--cfg', '-f', action='append', required=True,
+                            help='configuration file or directory of them, can be given multiple times')
 
     args = arg_parser.parse_args()
     em.DRY_RUN = args.dryrun
@@ -170,9 +508,9 @@ def main():
 
     em.gConfig = em.load_config(em.CONFIG_PATH)
 
-    config = parse_config(args.cfg)
-    if validate_config(config):
-        run(config)
+    configs = load_configs(args.cfg)
+    if configs:
+        run(configs)
     else:
         print('invalid configure')
 
@@ -0,0 +1,201 @@
+#!/usr/bin/python
+'''
+seeded random dynamics of a dynem.py configuration, computed with numpy a chunk of
+steps at a time
+
+A configuration with "generators" instead of "dynamics" has its parameters set every
+"step" seconds by each generator in turn, from random draws seeded with "seed", so
+the same configuration always plays the same steps:
+
+    "step": 0.1,
+    "seed": 7,
+    "generators": [
+        {"type": "markov", "param": "bw", "states": [8000, 2000, 300],
+         "transitions": [[0.98, 0.015, 0.005], [0.03, 0.95, 0.02], [0.05, 0.15, 0.8]]},
+        {"type": "walk", "param": "delay", "sigma": 2, "min": 20, "max": 200},
+        {"type": "outage", "up": 30, "down": 1.5}
+    ]
+
+markov  the parameter takes one of "states", row i of "transitions" holding the chances
+        to go from state i to each state at a step, starting in state "initial" (0)
+walk    the parameter moves by a normal draw of "sigma" at each step, from "start"
+        (the value of the rule), reflected at "min" and "max"
+outage  Gilbert-Elliott outages, "up" and "down" the mean seconds between them and of
+        them, during which the parameters of "set" apply, {"loss": 100} by default
+
+The draws of a chunk are made at once, a Markov state lasts a geometric number of
+steps and an outage period comes from slsgen.ge_states(), so a chunk of thousands of
+steps takes well under a millisecond, and only the steps which change a parameter
+are kept.
+'''
+import numpy as np
+import slsgen
+
+PARAMS = ('bw', 'loss', 'delay', 'jitter', 'qdelay')
+INT_PARAMS = ('bw', 'delay', 'jitter', 'qdelay')
+# the defaults dynem.py gives the parameters missing from a configuration
+DEFAULTS = {'bw': 8000, 'loss': 0, 'qdelay': 100, 'jitter': 0, 'delay': 10}
+# htb needs a rate, an outage of the bandwidth is the lowest one
+MIN_BW = 1
+STEP = 0.1
+CHUNK_STEPS = 4096
+# steps of a state which is never left
+FOREVER = 1 << 62
+
+def to_ms(seconds):
+    return int(round(float(seconds) * 1000))
+
+def param_of(spec):
+    param = spec.get('param', 'bw')
+    if param not in PARAMS:
+        raise ValueError('param %s is not one of %s' % (param, ', '.join(PARAMS)))
+    return param
+
+class Markov(object):
+
+    '''
+    a parameter taking the value of the state of a Markov chain
+    '''
+
+    def __init__(self, spec, base, step_ms, rng):
+        self.param = param_of(spec)
+        self.values = np.array(spec['states'], dtype=float)
+        k = len(self.values)
+        transitions = np.array(spec['transitions'], dtype=float)
+        if k == 0 or transitions.shape != (k, k) or (transitions < 0).any() or \
+                not np.allclose(transitions.sum(axis=1), 1):
+            raise ValueError('markov transitions must be %d rows of %d chances adding up to 1' % (k, k))
+        self.stay = np.diag(transitions).copy()
+        # where a uniform draw lands among the other states when leaving one
+        leave = transitions.copy()
+        np.fill_diagonal(leave, 0)
+        total = leave.sum(axis=1, keepdims=True)
+        self.jump = np.cumsum(leave / np.where(total > 0, total, 1), axis=1)
+        self.rng = rng
+        self.state = int(spec.get('initial', 0))
+        if not 0 <= self.state < k:
+            raise ValueError('markov initial state %d out of %d states' % (self.state, k))
+        self.left = self.hold(self.state)
+
+    def hold(self, state):
+        if self.stay[state] >= 1:
+            return FOREVER
+        return int(self.rng.geometric(1 - self.stay[state]))
+
+    def fill(self, cols, n):
+        states = np.empty(n, dtype=np.int64)
+        pos = 0
+        while pos < n:
+            take = min(self.left, n - pos)
+            states[pos:pos + take] = self.state
+            pos += take
+            self.left -= take
+            if self.left == 0:
+                row = self.jump[self.state]
+                self.state = min(int(np.searchsorted(row, self.rng.random_sample(), side='right')), len(row) - 1)
+                self.left = self.hold(self.state)
+        cols[self.param] = self.values[states]
+
+class Walk(object):
+
+    '''
+    a parameter following a random walk between min and max
+    '''
+
+    def __init__(self, spec, base, step_ms, rng):
+        self.param = param_of(spec)
+        self.sigma = float(spec['sigma'])
+        self.low = float(spec['min'])
+        self.width = float(spec['max']) - self.low
+        if self.sigma < 0 or self.width <= 0:
+            raise ValueError('walk needs sigma >= 0 and max above min')
+        # the walk is kept unbounded and folded into the bounds, the same as reflecting it
+        self.pos = float(spec.get('start', base[self.param])) - self.low
+        self.rng = rng
+
+    def fill(self, cols, n):
+        moves = self.rng.normal(0, self.sigma, n)
+        path = self.pos + np.cumsum(moves) - moves
+        self.pos = path[-1] + moves[-1]
+        cols[self.param] = self.low + self.width - np.abs(np.mod(path, 2 * self.width) - self.width)
+
+class Outage(object):
+
+    '''
+    Gilbert-Elliott outage periods overriding some parameters
+    '''
+
+    def __init__(self, spec, base, step_ms, rng):
+        up, down = float(spec['up']), float(spec['down'])
+        if up <= 0 or down <= 0:
+            raise ValueError('outage up and down must be positive')
+        self.p = min(1.0, step_ms / 1000.0 / up)
+        self.r = min(1.0, step_ms / 1000.0 / down)
+        self.set = spec.get('set', {'loss': 100})
+        for k in self.set:
+            param_of({'param': k})
+        self.bad = False
+        self.rng = rng
+
+    def fill(self, cols, n):
+        bad, self.bad = slsgen.ge_states(self.rng, n, self.p, self.r, self.bad)
+        for k, v in self.set.items():
+            cols[k] = np.where(bad, float(v), cols[k])
+
+SOURCES = {'markov': Markov, 'walk': Walk, 'outage': Outage}
+
+class Generator(object):
+
+    '''
+    the steps of the generators of a configuration, (offset in ms, parameters)
+    '''
+
+    def __init__(self, config):
+        self.step_ms = to_ms(config.get('step', STEP))
+        if self.step_ms <= 0:
+            raise ValueError('step must be at least a millisecond')
+        self.base = dict((k, float(config.get(k, v))) for k, v in DEFAULTS.items())
+        seed = int(config.get('seed', 0))
+        self.sources = []
+        for idx, spec in enumerate(config['generators']):
+            if spec.get('type') not in SOURCES:
+                raise ValueError('generator type %s is not one of %s' % (spec.get('type'), ', '.join(sorted(SOURCES))))
+            # each generator draws from its own stream, adding one leaves the others as they were
+            rng = np.random.RandomState([seed, idx])
+            self.sources.append(SOURCES[spec['type']](spec, self.base, self.step_ms, rng))
+        if not self.sources:
+            raise ValueError('no generators')
+        self.next = 0
+        self.last = None
+
+    def chunk(self, n=CHUNK_STEPS):
+        '''
+        (offsets in ms, {param: values as lists}) of the next n steps, without the ones
+        leaving every parameter as the step before
+        '''
+        cols = dict((k, np.full(n, v)) for k, v in self.base.items())
+        for source in self.sources:
+            source.fill(cols, n)
+        for k in INT_PARAMS:
+            cols[k] = np.maximum(np.rint(cols[k]), MIN_BW if k == 'bw' else 0).astype(np.int64)
+        cols['loss'] = np.clip(np.round(cols['loss'], 2), 0, 100)
+
+        table = np.column_stack([cols[k] for k in PARAMS])
+        keep = np.empty(n, dtype=bool)
+        keep[0] = self.last is None or (table[0] != self.last).any()
+        keep[1:] = (table[1:] != table[:-1]).any(axis=1)
+        self.last = table[-1]
+        offsets = (self.next + np.flatnonzero(keep)) * self.step_ms
+        self.next += n
+        return offsets.tolist(), dict((k, cols[k][keep].tolist()) for k in PARAMS)
+
+    def steps(self, end_ms=None):
+        '''
+        yields (offset in ms, {param: value}) for ever, or until end_ms
+        '''
+        while end_ms is None or self.next * self.step_ms < end_ms:
+            offsets, cols = self.chunk()
+            for i, offset in enumerate(offsets):
+                if end_ms is not None and offset >= end_ms:
+                    return
+                yield offset, dict((k, cols[k][i]) for k in PARAMS)
@@ -1,8 +1,17 @@
 #!/usr/bin/python
 import argparse
+import atexit
+import copy
+import hashlib
 import json
 import os
+import re
+import socket
+import struct
 import subprocess
+import sys
+import time
+from collections import OrderedDict
 
 # settings
 DRY_RUN = 0
@@ -13,6 +22,66 @@ MAX_NUM_IFBS = 64
 
 CONFIG_PATH = '/etc/piem/config.json'
 RULE_PATH = '/etc/piem/piem.rules'
+SOCKET_PATH = '/run/piem/piemd.sock'
+
+# piemd keeps the rules loaded in memory instead of reloading them for each command
+KEEP_RULES = False
+
+BATCH_ERROR = re.compile(r'^Command failed -:(\d+)$')
+BATCH_START = re.compile(r'^(\S+) -force -batch - <<EOF$')
+CLASS_LINE = re.compile(r'^class htb (\S+) (?:parent (\S+)|root)\b.*?\brate ([\d.]+)(\w*bit)')
+RATE_UNITS = {'bit': 0.001, 'Kbit': 1, 'Mbit': 1000, 'Gbit': 1000000, 'Tbit': 1000000000}
+
+# parameters of add, for the rules of a desired state file which leave them out
+RULE_DEFAULTS = {'bw': 8000, 'loss': 0, 'qdelay': 100, 'jitter': 0, 'delay': 10}
+
+# with the hashed classifier, client filters live in buckets of this u32 hash table,
+# selected by the last octet of the client address, linked from the root table 800:
+HASH_TABLE = 1
+HASH_DIVISOR = 256
+
+# u32 node ids are 12 bits, so past 0x800 handles the filters are split into groups,
+# group g keeps its filters in the tables HASH_TABLE + g and, for g > 0, LINEAR_TABLE + g
+# instead of 800:, these are linked from 800: by nodes after the ones of the rules
+FILTER_GROUP_SIZE = 0x800
+LINEAR_TABLE = 0x100
+LINEAR_LINK_NODE = 0xf00
+HASH_LINK_NODE = 0xf80
+
+# with the flower classifier, client filters are flower filters, looked up in a hash
+# table per mask instead of tried one after the other, and the filters flower has no
+# key for run a classic BPF program in cls_bpf, tried first as they are more specific.
+# Each flower mask gets a prio of its own from FLOWER_PRIO on, see Filter.flower_prio()
+BPF_PRIO = 1
+FLOWER_PRIO = 2
+FLOWER_KEY_BITS = {'ip_proto': 1, 'ip_tos': 2, 'src_port': 4, 'dst_port': 8}
+IP_PROTOCOLS = {'tcp': 6, 'udp': 17}
+
+# classic BPF opcodes, loads at SKF_NET_OFF + k are relative to the network header
+BPF_LD_W_ABS = 0x20
+BPF_LD_B_ABS = 0x30
+BPF_LD_H_IND = 0x48
+BPF_LD_B_IND = 0x50
+BPF_LDX_B_MSH = 0xb1
+BPF_ALU_AND_K = 0x54
+BPF_JMP_JEQ_K = 0x15
+BPF_RET_K = 0x06
+SKF_NET_OFF = 0xfff00000
+
+# the shared topology redirects all traffic of a direction into one ifb, where each
+# rule gets an htb class with a netem leaf instead of an ifb of its own
+SHARED_IFBS = {'uplink': 'ifb0', 'downlink': 'ifb1'}
+SHARED_IFB_RATE = 1000000
+
+# first line of the restore script, followed by the hash of the rules and config it was compiled from
+RESTORE_HEADER = '# piem restore %s'
+# bumped when the same rules and config would compile to other commands
+RESTORE_VERSION = 1
+
+gConfig = None
+gNetlink = None
+gRules = None
+gClient = None
 
 def mkdir_p(path):
     try:
@@ -23,18 +92,480 @@ def mkdir_p(path):
             print(e)
             raise
 
+CLOCK_MONOTONIC = 1
+
+def _clock_gettime_monotonic():
+    '''
+    CLOCK_MONOTONIC read through clock_gettime for python 2, which has no time.monotonic,
+    None where libc can't be loaded
+    '''
+    try:
+        import ctypes
+        import ctypes.util
+        libc = ctypes.CDLL(ctypes.util.find_library('c') or 'libc.so.6', use_errno=True)
+        clock_gettime = libc.clock_gettime
+    except (ImportError, OSError, AttributeError):
+        return None
+
+    class Timespec(ctypes.Structure):
+        _fields_ = [('tv_sec', ctypes.c_long), ('tv_nsec', ctypes.c_long)]
+
+    clock_gettime.argtypes = [ctypes.c_int, ctypes.POINTER(Timespec)]
+
+    def monotonic():
+        ts = Timespec()
+        if clock_gettime(CLOCK_MONOTONIC, ctypes.byref(ts)) != 0:
+            errno = ctypes.get_errno()
+            raise OSError(errno, os.strerror(errno))
+        return ts.tv_sec + ts.tv_nsec * 1e-9
+    return monotonic
+
+# seconds on a clock which a step of the wall clock, by NTP or by hand, doesn't move,
+# for deadlines and durations. os.times()[4], in clock ticks, is the last resort
+monotonic = getattr(time, 'monotonic', None) or _clock_gettime_monotonic() or (lambda: os.times()[4])
+
+class Span(object):
+
+    '''
+    one timed phase of a command, nested spans are named after their parents like
+    "add/apply/tc", fields set on it end up in its trace record
+    '''
+
+    def __init__(self, tracer, name, fields):
+        self.tracer = tracer
+        self.name = name
+        self.fields = fields
+
+    def set(self, **fields):
+        self.fields.update(fields)
+
+    def __enter__(self):
+        parent = self.tracer.stack[-1].name + '/' if self.tracer.stack else ''
+        self.name = parent + self.name
+        self.tracer.stack.append(self)
+        # the wall clock time for the record, the duration from the monotonic clock
+        self.ts = time.time()
+        self.start = monotonic()
+        return self
+
+    def __exit__(self, etype, e, tb):
+        duration = monotonic() - self.start
+        self.tracer.stack.pop()
+        if etype is not None:
+            self.fields.update(ok=False, error=repr(e))
+        self.tracer.finish(self, duration)
+        return False
+
+class Tracer(object):
+
+    '''
+    times the phases of the commands (load, handles, build, save, apply) and each tool
+    run inside apply, keeps a latency histogram per span name, and hands each finished
+    span as a dict to the sinks, callables like the json lines writer of trace_to()
+    '''
+
+    # upper bounds of the histogram buckets in seconds, the last bucket is unbounded
+    BUCKETS = (0.0005, 0.001, 0.002, 0.005, 0.01, 0.02, 0.05, 0.1, 0.2, 0.5, 1, 2, 5)
+
+    def __init__(self):
+        self.sinks = []
+        self.stack = []
+        # name -> [counts per bucket, count, sum, max]
+        self.histograms = {}
+
+    def span(self, name, **fields):
+        return Span(self, name, fields)
+
+    def add_sink(self, sink):
+        self.sinks.append(sink)
+
+    def finish(self, span, duration):
+        h = self.histograms.get(span.name)
+        if h is None:
+            h = self.histograms[span.name] = [[0] * (len(self.BUCKETS) + 1), 0, 0.0, 0.0]
+        i = 0
+        while i < len(self.BUCKETS) and duration > self.BUCKETS[i]:
+            i += 1
+        h[0][i] += 1
+        h[1] += 1
+        h[2] += duration
+        h[3] = max(h[3], duration)
+        if self.sinks:
+            record = {'ts': span.ts, 'name': span.name, 'duration': duration}
+            record.update(span.fields)
+            for sink in self.sinks:
+                sink(record)
+
+    def quantile(self, name, q):
+        '''
+        upper bound of the bucket holding quantile q of span name, at most the maximum
+        '''
+        counts, count, _, top = self.histograms[name]
+        seen = 0
+        for i, c in enumerate(counts):
+            seen += c
+            if seen >= q * count and i < len(self.BUCKETS):
+                return min(self.BUCKETS[i], top)
+        return top
+
+    def summary(self):
+        lines = ['%-28s %8s %10s %10s %10s %10s %10s' % ('span', 'count', 'mean ms', 'p50 ms', 'p90 ms', 'p99 ms', 'max ms')]
+        for name in sorted(self.histograms):
+            counts, count, total, top = self.histograms[name]
+            lines.append('%-28s %8d %10.2f %10.2f %10.2f %10.2f %10.2f' % (
+                name, count, total / count * 1000, self.quantile(name, 0.5) * 1000,
+                self.quantile(name, 0.9) * 1000, self.quantile(name, 0.99) * 1000, top * 1000))
+        return '\n'.join(lines)
+
+def trace_to(path):
+    '''
+    appends a json line per finished span to the file at path, closed on exit
+    '''
+    f = open(path, 'a', 1)
+    atexit.register(f.close)
+    gTracer.add_sink(lambda record: f.write(json.dumps(record, sort_keys=True) + '\n'))
+
+gTracer = Tracer()
+
+def span(name, **fields):
+    return gTracer.span(name, **fields)
+
 def exec_shell(command):
     print(command)
     ret = True
     if not DRY_RUN:
-        try:
-            output = subprocess.check_output(command, shell=True, stderr=subprocess.STDOUT)
-        except subprocess.CalledProcessError as e:
-            output = str(e.output)
-            print(output)
-            ret = False
+        with span('shell', command=command) as s:
+            try:
+                output = subprocess.check_output(command, shell=True, stderr=subprocess.STDOUT)
+            except subprocess.CalledProcessError as e:
+                output = str(e.output)
+                print(output)
+                s.set(ok=False, returncode=e.returncode, output=e.output.decode('utf-8', 'replace'))
+                ret = False
     return ret
 
+class Op(object):
+
+    '''
+    one structured tc/ip operation, rendered as a single line of a batch file
+    '''
+
+    tool = 'tc'
+
+    def __init__(self, verb, dev):
+        self.verb = verb
+        self.dev = dev
+
+class ScriptOp(Op):
+
+    '''
+    a line of a saved batch script, run by tool as it is
+    '''
+
+    def __init__(self, tool, line):
+        Op.__init__(self, None, None)
+        self.tool = tool
+        self.line = line
+
+    def __str__(self):
+        return self.line
+
+class LinkOp(Op):
+
+    tool = 'ip'
+
+    def __init__(self, verb, dev, up=True):
+        Op.__init__(self, verb, dev)
+        self.up = up
+
+    def __str__(self):
+        return 'link %s dev %s %s' % (self.verb, self.dev, 'up' if self.up else 'down')
+
+def _format_qdisc_opts(kind, opts):
+    if kind == 'netem':
+        loss = opts['loss']
+        if loss[0] == 'sls':
+            spec = 'loss sls %s' % loss[1]
+        elif loss[0] == 'gemodel':
+            spec = 'loss gemodel %s%% %s%%' % (loss[1], loss[2])
+        else:
+            spec = 'loss random %s%%' % loss[1]
+        return '%s delay %dms %dms' % (spec, opts['delay'], opts['jitter'])
+    elif kind == 'htb':
+        return 'default %d' % opts['default']
+    elif kind == 'bfifo':
+        return 'limit %d' % opts['limit']
+    return ''
+
+class QdiscOp(Op):
+
+    '''
+    parent is either 'root', 'ingress' or a classid like '1:2'
+    '''
+
+    def __init__(self, verb, dev, parent='root', handle=None, kind=None, **opts):
+        Op.__init__(self, verb, dev)
+        self.parent = parent
+        self.handle = handle
+        self.kind = kind
+        self.opts = opts
+
+    def __str__(self):
+        line = 'qdisc %s dev %s' % (self.verb, self.dev)
+        if self.parent in ('root', 'ingress'):
+            line += ' ' + self.parent
+        else:
+            line += ' parent %s' % self.parent
+        if self.handle is not None:
+            line += ' handle %s' % self.handle
+        if self.kind is not None:
+            line += ' ' + ('%s %s' % (self.kind, _format_qdisc_opts(self.kind, self.opts))).strip()
+        return line
+
+class ClassOp(Op):
+
+    '''
+    htb class, rate in kbit
+    '''
+
+    def __init__(self, verb, dev, parent, classid, rate=None):
+        Op.__init__(self, verb, dev)
+        self.parent = parent
+        self.classid = classid
+        self.rate = rate
+
+    def __str__(self):
+        line = 'class %s dev %s parent %s classid %s' % (self.verb, self.dev, self.parent, self.classid)
+        if self.rate is not None:
+            line += ' htb rate %skbit' % self.rate
+        return line
+
+class FilterOp(Op):
+
+    '''
+    u32 filter built from a Filter, optionally redirecting matched packets to another device
+    '''
+
+    def __init__(self, verb, dev, parent, handle, emfilter, flowid, redirect=None, prio=1, ht=None):
+        Op.__init__(self, verb, dev)
+        self.parent = parent
+        self.handle = handle
+        self.emfilter = emfilter
+        self.flowid = flowid
+        self.redirect = redirect
+        self.prio = prio
+        self.ht = ht
+
+    def __str__(self):
+        line = 'filter %s dev %s parent %s protocol ip prio %d handle %s u32' % (
+            self.verb, self.dev, self.parent, self.prio, self.handle)
+        if self.ht is not None:
+            line += ' ht %s' % self.ht
+        line += ' %s flowid %s' % (self.emfilter.matches(), self.flowid)
+        if self.redirect is not None:
+            line += ' action mirred egress redirect dev %s' % self.redirect
+        return line
+
+class FlowerOp(FilterOp):
+
+    '''
+    flower filter built from a Filter, handle is a number
+    '''
+
+    def __init__(self, verb, dev, parent, handle, emfilter, flowid, redirect=None, prio=None):
+        FilterOp.__init__(self, verb, dev, parent, handle, emfilter, flowid, redirect,
+                          emfilter.flower_prio() if prio is None else prio)
+
+    def __str__(self):
+        keys = []
+        for key, value, mask in self.emfilter.flower_keys():
+            if key in ('src_ip', 'dst_ip'):
+                prefix = bin(mask).count('1')
+                keys.append('%s %s/%d' % (key, socket.inet_ntoa(struct.pack('>I', value)), prefix))
+            elif key == 'ip_proto':
+                keys.append('ip_proto %s' % self.emfilter.protocol)
+            elif key == 'ip_tos':
+                keys.append('ip_tos 0x%x/0x%x' % (value, mask))
+            else:
+                keys.append('%s %d' % (key, value))
+        line = 'filter %s dev %s parent %s protocol ip prio %d handle %d flower %s classid %s' % (
+            self.verb, self.dev, self.parent, self.prio, self.handle, ' '.join(keys), self.flowid)
+        if self.redirect is not None:
+            line += ' action mirred egress redirect dev %s' % self.redirect
+        return line
+
+class BpfOp(FilterOp):
+
+    '''
+    cls_bpf filter running the classic BPF program of a Filter, handle is a number
+    '''
+
+    def __init__(self, verb, dev, parent, handle, emfilter, flowid, redirect=None, prio=BPF_PRIO):
+        FilterOp.__init__(self, verb, dev, parent, handle, emfilter, flowid, redirect, prio)
+
+    def __str__(self):
+        program = self.emfilter.bpf_program()
+        bytecode = ','.join([str(len(program))] + ['%d %d %d %d' % insn for insn in program])
+        line = 'filter %s dev %s parent %s protocol ip prio %d handle %d bpf bytecode "%s" classid %s' % (
+            self.verb, self.dev, self.parent, self.prio, self.handle, bytecode, self.flowid)
+        if self.redirect is not None:
+            line += ' action mirred egress redirect dev %s' % self.redirect
+        return line
+
+class HashTableOp(Op):
+
+    '''
+    empty u32 hash table with divisor buckets
+    '''
+
+    def __init__(self, verb, dev, parent, table, divisor, prio=1):
+        Op.__init__(self, verb, dev)
+        self.parent = parent
+        self.table = table
+        self.divisor = divisor
+        self.prio = prio
+
+    def __str__(self):
+        return 'filter %s dev %s parent %s protocol ip prio %d handle %x: u32 divisor %d' % (
+            self.verb, self.dev, self.parent, self.prio, self.table, self.divisor)
+
+class HashLinkOp(Op):
+
+    '''
+    u32 filter in the root table sending every packet on to table, to the bucket selected
+    by the last byte of the 32-bit word at offset if there is one
+    '''
+
+    def __init__(self, verb, dev, parent, handle, table, offset=None, prio=1):
+        Op.__init__(self, verb, dev)
+        self.parent = parent
+        self.handle = handle
+        self.table = table
+        self.offset = offset
+        self.prio = prio
+
+    def __str__(self):
+        line = 'filter %s dev %s parent %s protocol ip prio %d handle %s u32 ht 800: match u32 0 0 at 0' % (
+            self.verb, self.dev, self.parent, self.prio, self.handle)
+        if self.offset is not None:
+            line += ' hashkey mask 0x000000ff at %d' % self.offset
+        return line + ' link %x:' % self.table
+
+class Batch(object):
+
+    '''
+    collects operations of one transaction, consecutive operations of the same tool
+    are sent to a single "tc/ip -force -batch -" process
+    '''
+
+    def __init__(self):
+        self.ops = []
+        self.errors = []
+
+    def add(self, op):
+        self.ops.append(op)
+        return op
+
+    def __len__(self):
+        return len(self.ops)
+
+    def compile(self, netlink=None):
+        '''
+        groups consecutive operations by the tool running them, operations the netlink
+        backend supports are grouped under it instead
+        '''
+        groups = []
+        for op in self.ops:
+            runner = netlink if netlink is not None and netlink.supports(op) else op.tool
+            if groups and groups[-1][0] is runner:
+                groups[-1][1].append(op)
+            else:
+                groups.append((runner, [op]))
+        return groups
+
+    def __str__(self):
+        script = ''
+        for tool, ops in self.compile():
+            script += '%s -force -batch - <<EOF\n' % tool
+            script += ''.join('%s\n' % op for op in ops)
+            script += 'EOF\n'
+        return script
+
+def _run_batch(tool, ops):
+    content = ''.join('%s\n' % op for op in ops)
+    try:
+        p = subprocess.Popen([tool, '-force', '-batch', '-'], stdin=subprocess.PIPE,
+                             stdout=subprocess.PIPE, stderr=subprocess.STDOUT)
+    except OSError as e:
+        return [(None, '%s: %s' % (tool, e))]
+    output = p.communicate(content.encode())[0].decode(errors='replace')
+
+    errors = []
+    message = []
+    for line in output.splitlines():
+        m = BATCH_ERROR.match(line)
+        if m is None:
+            message.append(line)
+            continue
+        lineno = int(m.group(1))
+        op = ops[lineno - 1] if 0 < lineno <= len(ops) else None
+        errors.append((op, '\n'.join(message)))
+        message = []
+    if p.returncode != 0 and not errors:
+        errors.append((None, output))
+    return errors
+
+def get_netlink():
+    '''
+    the rtnetlink backend when selected by "backend" in the config, the socket is kept
+    open for the life of the process, None falls back to the shell backend
+    '''
+    global gNetlink
+    if gNetlink is None and gConfig is not None and gConfig.get('backend', 'shell') == 'netlink':
+        try:
+            import rtnl
+            gNetlink = rtnl.Netlink()
+        except (ImportError, OSError, socket.error) as e:
+            print('netlink backend not available, fall back to shell: %s' % e)
+            gNetlink = False
+    return gNetlink or None
+
+def drop_netlink():
+    '''
+    closes a netlink socket which failed, the shell backend is used from then on
+    '''
+    global gNetlink
+    if gNetlink:
+        gNetlink.close()
+    gNetlink = False
+
+def exec_batch(batch):
+    print(batch)
+    if DRY_RUN or len(batch) == 0:
+        return True
+    batch.errors = []
+    netlink = get_netlink()
+    for runner, ops in batch.compile(netlink):
+        with span('netlink' if runner is netlink else runner, ops=len(ops)) as s:
+            try:
+                errors = netlink.run(ops) if runner is netlink else _run_batch(runner, ops)
+            except (OSError, socket.error) as e:
+                # which ops of the group got in is unknown, the ones after it are not run
+                # and the next batches go through the shell
+                errors = [(None, 'netlink: %s' % e)]
+                drop_netlink()
+            if runner is netlink and netlink.stale:
+                # acks went missing, the next batches go through the shell
+                drop_netlink()
+            if errors:
+                s.set(ok=False, errors=['%s: %s' % (op, message) for op, message in errors])
+        batch.errors.extend(errors)
+        if runner is netlink and gNetlink is False:
+            break
+    for op, message in batch.errors:
+        print('failed: %s %s\n%s' % ('' if op is None else op.tool, '' if op is None else op, message))
+    return len(batch.errors) == 0
+
 def load_config(config):
     if not os.path.exists(config):
         return None
@@ -44,11 +575,39 @@ def load_config(config):
         print('loads config from %s' % config)
         return config
 
+# settings which shape the qdiscs and filters set up by init
+TREE_SETTINGS = ('ingress', 'egress', 'numifbs', 'classifier', 'topology')
+
+def reload_config():
+    '''
+    reads the config again after "emulator.py config", for piemd which loaded it at start.
+    The backend is opened again as configured, the qdiscs only follow a change of their
+    settings on the next init
+    '''
+    global gConfig, gNetlink
+    prev = gConfig
+    gConfig = load_config(CONFIG_PATH)
+    if gNetlink:
+        gNetlink.close()
+    gNetlink = None
+    if gConfig is None:
+        print('Configuration not found at %s, please configure first' % CONFIG_PATH)
+        return False
+    changed = [k for k in TREE_SETTINGS if prev is not None and prev.get(k) != gConfig.get(k)]
+    if changed:
+        print('%s changed, run uninit and init for the qdiscs to follow' % ', '.join(changed))
+    return True
+
 def save_config(args):
     config = {
         'ingress': args.ingress,
         'egress': args.egress,
-        'numifbs': args.numifbs
+        'numifbs': args.numifbs,
+        'backend': args.backend,
+        'classifier': args.classifier,
+        'topology': args.topology,
+        'numrules': args.numrules,
+        'persist': args.persist
     }
     config_dir = os.path.dirname(CONFIG_PATH)
     mkdir_p(config_dir)
@@ -61,104 +620,487 @@ def init():
     if gConfig is None:
         print('Configuration not found at %s, please configure first' % CONFIG_PATH)
         return False
-    init_cmd = '''
-        modprobe ifb numifbs=%(numifbs)d
+    numifbs = len(SHARED_IFBS) if shared_topology() else gConfig['numifbs']
+    if not exec_shell('modprobe ifb numifbs=%d' % numifbs):
+        return False
+    if persistent():
+        return restore()
+    return exec_batch(build_init(Batch()))
+
+def build_init(batch):
+    # uplink
+    batch.add(QdiscOp('add', gConfig['ingress'], 'ingress'))
+    batch.add(QdiscOp('add', gConfig['egress'], 'root', '1:', 'htb', default=1))
+    batch.add(ClassOp('add', gConfig['egress'], '1:', '1:1', rate=1000000))
+
+    # downlink
+    batch.add(QdiscOp('add', gConfig['egress'], 'ingress'))
+    batch.add(QdiscOp('add', gConfig['ingress'], 'root', '1:', 'htb', default=1))
+    batch.add(ClassOp('add', gConfig['ingress'], '1:', '1:1', rate=1000000))
+
+    if shared_topology():
+        for direction, in_inf in (('uplink', gConfig['ingress']), ('downlink', gConfig['egress'])):
+            ifb = SHARED_IFBS[direction]
+            batch.add(LinkOp('set', ifb, up=True))
+            batch.add(QdiscOp('add', ifb, 'root', '1:', 'htb', default=1))
+            batch.add(ClassOp('add', ifb, '1:', '1:1', rate=SHARED_IFB_RATE))
+            batch.add(FilterOp('add', in_inf, 'ffff:', '800::1', MatchAllFilter(), '1:1', redirect=ifb))
+        hooks = [(SHARED_IFBS['uplink'], '1:0', 'uplink'), (gConfig['egress'], '1:0', 'uplink'),
+                 (SHARED_IFBS['downlink'], '1:0', 'downlink'), (gConfig['ingress'], '1:0', 'downlink')]
+    else:
+        hooks = [(gConfig['ingress'], 'ffff:', 'uplink'), (gConfig['egress'], '1:0', 'uplink'),
+                 (gConfig['egress'], 'ffff:', 'downlink'), (gConfig['ingress'], '1:0', 'downlink')]
+
+    for dev, parent, direction in hooks:
+        build_filter_tables(batch, dev, parent, direction)
+    return batch
 
-        # uplink
-        tc qdisc add dev %(ingress)s ingress
-        tc qdisc add dev %(egress)s root handle 1: htb default 1
-        tc class add dev %(egress)s parent 1: classid 1:1 htb rate 1000mbit
+def restore_path():
+    return os.path.splitext(RULE_PATH)[0] + '.batch'
 
-        # downlink
-        tc qdisc add dev %(egress)s ingress
-        tc qdisc add dev %(ingress)s root handle 1: htb default 1
-        tc class add dev %(ingress)s parent 1: classid 1:1 htb rate 1000mbit
-    ''' % gConfig
-    return exec_shell(init_cmd)
+def restore_key(rules):
+    content = json.dumps({'config': gConfig, 'rules': rules.to_list(), 'version': RESTORE_VERSION}, sort_keys=True)
+    return hashlib.sha1(content.encode()).hexdigest()
+
+def load_restore(key):
+    '''
+    the batch of the restore script, None when it's missing or was compiled from other
+    rules or config
+    '''
+    try:
+        with open(restore_path(), 'r') as f:
+            lines = f.read().splitlines()
+    except IOError:
+        return None
+    if not lines or lines[0] != RESTORE_HEADER % key:
+        return None
+    batch = Batch()
+    tool = None
+    for line in lines[1:]:
+        m = BATCH_START.match(line)
+        if tool is None and m is not None:
+            tool = m.group(1)
+        elif line == 'EOF':
+            tool = None
+        elif tool is not None:
+            batch.add(ScriptOp(tool, line))
+    return batch
+
+def save_restore(batch, key):
+    path = restore_path()
+    mkdir_p(os.path.dirname(path))
+    tmp = '%s.%d.tmp' % (path, os.getpid())
+    try:
+        with open(tmp, 'w') as f:
+            f.write('%s\n%s' % (RESTORE_HEADER % key, batch))
+        os.rename(tmp, path)
+    except (IOError, OSError) as e:
+        print('failed to save the restore script to %s: %s' % (path, e))
+
+def restore():
+    '''
+    inits with all the saved rules in one batch, compiled into a script next to the rules
+    file, which is run as it is while the rules and config are the same
+    '''
+    with span('load'):
+        rules = load_rules()
+    key = restore_key(rules)
+    with span('build', rules=len(rules)) as s:
+        batch = load_restore(key)
+        s.set(cached=batch is not None)
+        if batch is None:
+            batch = build_init(Batch())
+            for r in rules:
+                Rule.from_dict(r).build_add(batch)
+            save_restore(batch, key)
+        s.set(ops=len(batch))
+    with span('apply'):
+        if exec_batch(batch):
+            return True
+    print('restore of %d rules failed, the script is compiled again next time' % len(rules))
+    if os.path.exists(restore_path()):
+        os.remove(restore_path())
+    return False
+
+def hashed_classifier():
+    return gConfig is not None and gConfig.get('classifier', 'linear') == 'hashed'
+
+def persistent():
+    return gConfig is not None and gConfig.get('persist', False)
+
+def flower_classifier():
+    return gConfig is not None and gConfig.get('classifier', 'linear') == 'flower'
+
+def shared_topology():
+    return gConfig is not None and gConfig.get('topology', 'dedicated') == 'shared'
+
+def build_filter_tables(batch, dev, parent, direction):
+    '''
+    u32 tables for the filters on one hook, with the hashed classifier the hash tables are
+    keyed on the last octet of the client address, the source address for uplink and the
+    destination address for downlink, flower and cls_bpf filters need no tables
+    '''
+    if flower_classifier():
+        return batch
+    for group in range(filter_groups()):
+        if group > 0:
+            batch.add(HashTableOp('add', dev, parent, LINEAR_TABLE + group, 1))
+            batch.add(HashLinkOp('add', dev, parent, '800::%x' % (LINEAR_LINK_NODE + group), LINEAR_TABLE + group))
+    if hashed_classifier():
+        for group in range(filter_groups()):
+            batch.add(HashTableOp('add', dev, parent, HASH_TABLE + group, HASH_DIVISOR))
+            batch.add(HashLinkOp('add', dev, parent, '800::%x' % (HASH_LINK_NODE + group), HASH_TABLE + group,
+                                 Filter.address_offset(direction)))
+    return batch
 
 def uninit():
-    if os.path.exists(RULE_PATH):
-        print('Clear all rules in %s' % RULE_PATH)
-        os.remove(RULE_PATH)
+    if persistent():
+        print('Keep the rules in %s for the next init' % RULE_PATH)
+    else:
+        if os.path.exists(RULE_PATH):
+            print('Clear all rules in %s' % RULE_PATH)
+            os.remove(RULE_PATH)
+        global gRules
+        if gRules is not None:
+            for r in gRules:
+                gHandleManager.remove_handle(r['handle'])
+            gRules = RuleStore()
 
     if gConfig is None:
         print('Configuration not found at %s, please configure first' % CONFIG_PATH)
         return False
-    uninit_cmd = '''
-        # downlink
-        tc qdisc del dev %(egress)s ingress
-        tc qdisc del dev %(ingress)s root
 
-        # uplink
-        tc qdisc del dev %(ingress)s ingress
-        tc qdisc del dev %(egress)s root
+    batch = Batch()
+    # downlink
+    batch.add(QdiscOp('del', gConfig['egress'], 'ingress'))
+    batch.add(QdiscOp('del', gConfig['ingress'], 'root'))
+
+    # uplink
+    batch.add(QdiscOp('del', gConfig['ingress'], 'ingress'))
+    batch.add(QdiscOp('del', gConfig['egress'], 'root'))
+
+    if shared_topology():
+        for ifb in sorted(SHARED_IFBS.values()):
+            batch.add(QdiscOp('del', ifb, 'root'))
+    ret = exec_batch(batch)
+    return exec_shell('modprobe -r ifb') and ret
+
+class RuleStore(object):
+
+    '''
+    saved rule dicts indexed by the full filter key, so rules for different flows of the
+    same address don't replace each other, kept in the order they were added
+    '''
+
+    def __init__(self, rules=()):
+        self.rules = OrderedDict()
+        for r in rules:
+            self.put(r)
+
+    @staticmethod
+    def key(rule_dict):
+        return Filter.from_dict(rule_dict['emfilter']).key()
+
+    def get(self, key):
+        return self.rules.get(key)
+
+    def lookup(self, keys):
+        return [self.rules.get(k) for k in keys]
 
-        modprobe -r ifb
-    ''' % gConfig
-    return exec_shell(uninit_cmd)
+    def put(self, rule_dict):
+        self.rules[self.key(rule_dict)] = rule_dict
+
+    def pop(self, key):
+        return self.rules.pop(key, None)
+
+    def to_list(self):
+        return list(self.rules.values())
+
+    def items(self):
+        return list(self.rules.items())
+
+    def __iter__(self):
+        return iter(self.rules.values())
+
+    def __len__(self):
+        return len(self.rules)
 
 def load_rules():
+    global gRules
+    if gRules is not None:
+        return gRules
     if not os.path.exists(RULE_PATH):
         print("no rules file found at %s!" % RULE_PATH)
-        return []
-    with open(RULE_PATH, 'r') as f:
-        content = f.read()
-        rules = json.loads(content)
-        for r in rules:
-            global gHandleManager
-            gHandleManager.add_handle(r['handle'])
-        print('loads rules from %s\n%s\n' % (RULE_PATH, content))
-        return rules
+        rules = RuleStore()
+    else:
+        with open(RULE_PATH, 'r') as f:
+            content = f.read()
+            rules = RuleStore(json.loads(content))
+            for r in rules:
+                gHandleManager.add_handle(r['handle'])
+            print('loads rules from %s\n%s\n' % (RULE_PATH, content))
+    if KEEP_RULES:
+        gRules = rules
+    return rules
 
 def save_rules(rules):
     rule_dir = os.path.dirname(RULE_PATH)
     mkdir_p(rule_dir)
     with open(RULE_PATH, 'w') as f:
-        print(rules)
-        content = json.dumps(rules, indent=4)
+        content = json.dumps(rules.to_list(), indent=4)
         print('save rules to %s\n%s\n' % (RULE_PATH, content))
         f.write(content)
+    if KEEP_RULES:
+        global gRules
+        gRules = rules
 
 class HandleManager(object):
 
     '''
     htb handles, 1 is reserved, so at least start with 2
+
+    removed handles go to a free list and are handed out again before the ones never
+    used, entries of the free list taken in the meantime are dropped when they show up,
+    the ones above a lower handle_max kept for a later call with a higher one
     '''
 
     def __init__(self, handle_min, handle_max):
         self.handle_set = set()
         assert handle_min < handle_max
-        self.valid_handles = range(handle_min, handle_max+1)
+        self.handle_max = handle_max
+        self.free = []
+        self.next = handle_min
 
     def add_handle(self, handle):
         self.handle_set.add(handle)
 
     def remove_handle(self, handle):
         self.handle_set.remove(handle)
-
-    def get_available_handle(self):
-        for h in self.valid_handles:
-            if h not in self.handle_set:
-                return h
-        return None
+        self.free.append(handle)
+
+    def get_available_handle(self, handle_max=None):
+        limit = self.handle_max if handle_max is None else min(handle_max, self.handle_max)
+        while self.free and self.free[-1] in self.handle_set:
+            self.free.pop()
+        for handle in reversed(self.free):
+            if handle <= limit and handle not in self.handle_set:
+                return handle
+        while self.next in self.handle_set:
+            self.next += 1
+        return self.next if self.next <= limit else None
 
 HANDLE_MIN = 2
 HANDLE_MAX = HANDLE_MIN + MAX_NUM_IFBS - 1
-gHandleManager = HandleManager(HANDLE_MIN, HANDLE_MAX)
+# the shared topology uses handles as 16-bit htb minors and netem majors, ffff: is
+# left out as the major of ingress qdiscs
+SHARED_HANDLE_MAX = 0xfffe
+gHandleManager = HandleManager(HANDLE_MIN, SHARED_HANDLE_MAX)
 
 get_ifb_idx = lambda handle: handle - HANDLE_MIN
 
+def handle_max():
+    if shared_topology():
+        return min(HANDLE_MIN + gConfig.get('numrules', 4094) - 1, SHARED_HANDLE_MAX)
+    return HANDLE_MAX
+
+def filter_groups():
+    return (handle_max() - 1) // FILTER_GROUP_SIZE + 1
+
+class MatchAllFilter(object):
+
+    '''
+    u32 match on every ip packet, used to redirect a whole direction into its shared ifb
+    '''
+
+    def u32_keys(self):
+        return [(0, 0, 0)]
+
+    def matches(self):
+        return 'match u32 0 0 at 0'
+
+    def __str__(self):
+        return 'u32 %s' % self.matches()
+
+# largest value of each number a filter matches, the size of its field in the header
+FILTER_NUMBERS = {'tos': 0xff, 'srcport': 0xffff, 'dstport': 0xffff, 'ptype': 0x7f}
+
+def filter_number(name, value):
+    '''
+    a number of a filter, given as an int or a decimal string, None when unset. Raises
+    ValueError when it isn't a number or doesn't fit its field
+    '''
+    if value is None:
+        return None
+    try:
+        number = int(str(value).strip(), 10)
+    except ValueError:
+        raise ValueError('%s %s is not a decimal number' % (name, value))
+    if not 0 <= number <= FILTER_NUMBERS[name]:
+        raise ValueError('%s %s out of range 0-%d' % (name, value, FILTER_NUMBERS[name]))
+    return number
+
+def filter_arg(name):
+    '''
+    argparse type of a number of a filter
+    '''
+    def parse(value):
+        try:
+            return filter_number(name, value)
+        except ValueError as e:
+            raise argparse.ArgumentTypeError(str(e))
+    return parse
+
 class Filter(object):
 
+    @classmethod
+    def from_dict(cls, filter_dict):
+        return cls(filter_dict['direction'], filter_dict['ip'],
+                   filter_dict.get('tos', None),
+                   filter_dict.get('srcport', None),
+                   filter_dict.get('dstport', None),
+                   filter_dict.get('ptype', None),
+                   filter_dict.get('protocol', 'all'))
+
     def __init__(self, direction, ip, tos=None, srcport=None, dstport=None, ptype=None, protocol='all'):
         self.direction = direction
         self.ip = ip
-        self.tos = tos
-        self.srcport = srcport
-        self.dstport = dstport
-        self.ptype = ptype
+        self.tos = filter_number('tos', tos)
+        self.srcport = filter_number('srcport', srcport)
+        self.dstport = filter_number('dstport', dstport)
+        self.ptype = filter_number('ptype', ptype)
         self.protocol = protocol
 
+    def key(self):
+        '''
+        identity of the filter in the rule store
+        '''
+        return (self.ip, self.direction, self.protocol or 'all', self.tos,
+                self.srcport, self.dstport, self.ptype)
+
+    @staticmethod
+    def address_offset(direction):
+        return 12 if direction == 'uplink' else 16
+
+    def hash_bucket(self):
+        '''
+        bucket in the hashed classifier, None for a subnet, its last octet isn't fixed
+        so it stays in the root table
+        '''
+        addr, _, prefix = self.ip.partition('/')
+        if prefix and int(prefix) < 32:
+            return None
+        return struct.unpack('>I', socket.inet_aton(addr))[0] & 0xff
+
+    def u32_keys(self):
+        '''
+        the 32-bit (value, mask, offset) keys u32 matches on, packed and merged the same way tc does
+        '''
+        keys = []
+
+        def pack(value, mask, off, size):
+            shift = 8 * (4 - size - (off & 3))
+            mask = (mask << shift) & 0xffffffff
+            value = (value << shift) & mask
+            off &= ~3
+            for idx, (v, m, o) in enumerate(keys):
+                if o == off:
+                    keys[idx] = (v | value, m | mask, o)
+                    return
+            keys.append((value, mask, off))
+
+        addr, _, prefix = self.ip.partition('/')
+        prefix = int(prefix) if prefix else 32
+        pack(struct.unpack('>I', socket.inet_aton(addr))[0],
+             (0xffffffff << (32 - prefix)) & 0xffffffff,
+             self.address_offset(self.direction), 4)
+        if self.protocol == 'tcp':
+            pack(6, 0xff, 9, 1)
+        elif self.protocol == 'udp':
+            pack(17, 0xff, 9, 1)
+        if self.tos is not None:
+            pack(self.tos, 0xff, 1, 1)
+        if self.srcport is not None:
+            pack(self.srcport, 0xffff, 20, 2)
+        if self.dstport is not None:
+            pack(self.dstport, 0xffff, 22, 2)
+        if self.ptype is not None:
+            pack(0x80, 0xc0, 28, 1)
+            pack(self.ptype, 0x7f, 29, 1)
+        return keys
+
+    def flower_keys(self):
+        '''
+        [(key, value, mask)] of the flower filter matching the same packets as u32_keys(),
+        None when flower has no key for a field, the RTP payload type, or for ports
+        without a protocol, which it only knows within tcp or udp
+        '''
+        if self.ptype is not None:
+            return None
+        if self.protocol not in IP_PROTOCOLS and (self.srcport is not None or self.dstport is not None):
+            return None
+        addr, _, prefix = self.ip.partition('/')
+        mask = (0xffffffff << (32 - int(prefix or 32))) & 0xffffffff
+        keys = [('src_ip' if self.direction == 'uplink' else 'dst_ip',
+                 struct.unpack('>I', socket.inet_aton(addr))[0] & mask, mask)]
+        if self.protocol in IP_PROTOCOLS:
+            keys.append(('ip_proto', IP_PROTOCOLS[self.protocol], 0xff))
+        if self.tos is not None:
+            keys.append(('ip_tos', self.tos, 0xff))
+        if self.srcport is not None:
+            keys.append(('src_port', self.srcport, 0xffff))
+        if self.dstport is not None:
+            keys.append(('dst_port', self.dstport, 0xffff))
+        return keys
+
+    def flower_prio(self):
+        '''
+        prio of the flower filter, one per mask since older kernels and the hardware flower
+        offloads to take a single mask per prio, longer prefixes first, then the masks
+        with more port keys
+        '''
+        keys = self.flower_keys()
+        bits = sum(FLOWER_KEY_BITS[key] for key, _, _ in keys[1:])
+        return FLOWER_PRIO + (32 - bin(keys[0][2]).count('1')) * 16 + 15 - bits
+
+    def bpf_program(self):
+        '''
+        classic BPF program matching the same packets as u32_keys(), as [(code, jt, jf, k)],
+        the transport header is found from the IP header length, so IP options don't move
+        the ports or the RTP header, returns -1 for a match, the classid of the filter
+        '''
+        program = []
+
+        def check(load, value, mask, full):
+            program.append(load)
+            if mask != full:
+                program.append((BPF_ALU_AND_K, 0, 0, mask))
+            # jf is set to the jump to the no match return once the program is complete
+            program.append((BPF_JMP_JEQ_K, 0, None, value & mask))
+
+        addr, _, prefix = self.ip.partition('/')
+        check((BPF_LD_W_ABS, 0, 0, SKF_NET_OFF + self.address_offset(self.direction)),
+              struct.unpack('>I', socket.inet_aton(addr))[0],
+              (0xffffffff << (32 - int(prefix or 32))) & 0xffffffff, 0xffffffff)
+        if self.protocol in IP_PROTOCOLS:
+            check((BPF_LD_B_ABS, 0, 0, SKF_NET_OFF + 9), IP_PROTOCOLS[self.protocol], 0xff, 0xff)
+        if self.tos is not None:
+            check((BPF_LD_B_ABS, 0, 0, SKF_NET_OFF + 1), self.tos, 0xff, 0xff)
+        if self.srcport is not None or self.dstport is not None or self.ptype is not None:
+            # X = 4 * the IP header length
+            program.append((BPF_LDX_B_MSH, 0, 0, SKF_NET_OFF))
+        if self.srcport is not None:
+            check((BPF_LD_H_IND, 0, 0, SKF_NET_OFF), self.srcport, 0xffff, 0xffff)
+        if self.dstport is not None:
+            check((BPF_LD_H_IND, 0, 0, SKF_NET_OFF + 2), self.dstport, 0xffff, 0xffff)
+        if self.ptype is not None:
+            # version 2 and the payload type of the RTP header after the 8 bytes of udp
+            check((BPF_LD_B_IND, 0, 0, SKF_NET_OFF + 8), 0x80, 0xc0, 0xff)
+            check((BPF_LD_B_IND, 0, 0, SKF_NET_OFF + 9), self.ptype, 0x7f, 0xff)
+        program.append((BPF_RET_K, 0, 0, 0xffffffff))
+        program.append((BPF_RET_K, 0, 0, 0))
+        fail = len(program) - 1
+        return [(code, jt, fail - i - 1 if jf is None else jf, k) for i, (code, jt, jf, k) in enumerate(program)]
+
     def _get_protocol_filter(self):
         if self.protocol == 'tcp':
             return ' match ip protocol 6 0xff'
@@ -168,12 +1110,15 @@ class Filter(object):
             return ' '
 
     def __str__(self):
+        return 'u32 %s' % self.matches()
+
+    def matches(self):
         assert self.ip is not None
         netem_filter = ''
         if self.direction == 'uplink':
-            netem_filter = 'u32 match ip src %s' % self.ip
+            netem_filter = 'match ip src %s' % self.ip
         else:
-            netem_filter = 'u32 match ip dst %s' % self.ip
+            netem_filter = 'match ip dst %s' % self.ip
 
         netem_filter += self._get_protocol_filter()
 
@@ -196,17 +1141,27 @@ class Rule(object):
 
     @classmethod
     def from_dict(cls, rule_dict):
-        filter_dict = rule_dict['emfilter']
-        f = Filter(filter_dict['direction'], filter_dict['ip'],
-                   filter_dict.get('tos', None),
-                   filter_dict.get('srcport', None),
-                   filter_dict.get('dstport', None),
-                   filter_dict.get('ptype', None),
-                   filter_dict.get('protocol', 'all'))
+        f = Filter.from_dict(rule_dict['emfilter'])
         r = cls.__new__(cls)
-        r.__init(f, 0, 0, 0, 0, 0, rule_dict['direction'], handle=rule_dict['handle'])
+        r.__init(f, rule_dict.get('bw', 0), rule_dict.get('loss', 0), rule_dict.get('qdelay', 0),
+                 rule_dict.get('jitter', 0), rule_dict.get('delay', 0), rule_dict['direction'],
+                 rule_dict.get('burst', None), rule_dict.get('sls', None), rule_dict.get('handle', None))
         return r
 
+    def to_dict(self):
+        return {
+            'emfilter': self.emfilter.__dict__,
+            'direction': self.direction,
+            'bw': self.bw,
+            'loss': self.loss,
+            'qdelay': self.qdelay,
+            'jitter': self.jitter,
+            'delay': self.delay,
+            'burst': self.burst,
+            'sls': self.sls,
+            'handle': self.handle
+        }
+
     def __init__(self, emfilter, bw, loss, qdelay, jitter, delay, direction, burst=None, sls=None, handle=None):
         self.__init(emfilter, bw, loss, qdelay, jitter, delay, direction, burst, sls, handle)
 
@@ -222,13 +1177,8 @@ class Rule(object):
         self.direction = direction
         self.handle = handle
 
-    def exists(self, rules):
-        for idx, r in enumerate(rules):
-            # todo: take other filter fields into account
-            if r['emfilter']['ip'] == self.emfilter.ip and \
-              r['emfilter']['direction'] == self.emfilter.direction:
-                return idx
-        return -1
+    def key(self):
+        return self.emfilter.key()
 
     def set_handle(self, handle):
         self.handle = handle
@@ -241,152 +1191,805 @@ class Rule(object):
             in_inf = gConfig['egress']
             out_inf = gConfig['ingress']
 
-        ifb_idx = get_ifb_idx(self.handle)
+        if shared_topology():
+            ifb = SHARED_IFBS[self.direction]
+            classid = '1:%x' % self.handle
+            netem_parent, netem_handle = classid, '%x:' % self.handle
+            group, node = divmod(self.handle - 1, FILTER_GROUP_SIZE)
+            node = '%x' % (node + 1)
+        else:
+            ifb = 'ifb%d' % get_ifb_idx(self.handle)
+            classid = '1:%d' % self.handle
+            netem_parent, netem_handle = 'root', '1:'
+            group, node = 0, '%d' % self.handle
+
+        bucket = self.emfilter.hash_bucket() if hashed_classifier() else None
+        if flower_classifier():
+            ht = None
+        elif bucket is not None:
+            ht = '%x:%x:' % (HASH_TABLE + group, bucket)
+        elif group > 0:
+            ht = '%x:0:' % (LINEAR_TABLE + group)
+        else:
+            ht = None
+        # flower and cls_bpf filters take the rule handle as it is
+        filter_handle = self.handle if flower_classifier() else (ht or '800::') + node
 
         params = {
             'in_inf': in_inf,
             'out_inf': out_inf,
-            'ifb_idx': ifb_idx,
-            'emfilter': str(self.emfilter),
+            'ifb': ifb,
+            'emfilter': self.emfilter,
             'bw': self.bw,
             'delay': self.delay,
             'jitter': self.jitter,
-            'tb_qsize': self.bw * 1000 * self.qdelay / 8000,
-            'handle': self.handle
+            'tb_qsize': self._get_tb_qsize(),
+            'loss': self._get_loss_params(),
+            'handle': self.handle,
+            'classid': classid,
+            'netem_parent': netem_parent,
+            'netem_handle': netem_handle,
+            'filter_handle': filter_handle,
+            'ht': ht
         }
 
+        return params
+
+    def _get_tb_qsize(self):
+        return self.bw * 1000 * self.qdelay / 8000
+
+    def _get_loss_params(self):
         if self.sls is not None:
-            params['sls'] = self.sls
+            return ('sls', self.sls)
         elif self.burst is not None and self.burst > 0:
             floss = self.loss / 100.0
             if self.loss != 100:
-                params['gemodel_p'] = 100.0 * floss / self.burst / (1 - floss)
+                gemodel_p = 100.0 * floss / self.burst / (1 - floss)
             else:
-                params['gemodel_p'] = 100
-            params['gemodel_r'] = 100.0 / self.burst
+                gemodel_p = 100
+            gemodel_r = 100.0 / self.burst
+            return ('gemodel', gemodel_p, gemodel_r)
         else:
-            params['loss'] = self.loss
+            return ('random', self.loss)
+
+    def tc_components(self):
+        '''
+        the parameters of each kernel object a change can touch, as the kernel keeps them
+        '''
+        return {
+            'netem': (_round_loss(self._get_loss_params()), int(self.delay), int(self.jitter)),
+            'class': int(self.bw),
+            'bfifo': int(self._get_tb_qsize())
+        }
 
-        return params
+    def changed_components(self, prev):
+        '''
+        kernel objects whose parameters differ from rule prev, or from the components read
+        from the kernel by LiveState, all of them without prev
+        '''
+        cur = self.tc_components()
+        if prev is None:
+            return set(cur)
+        old = prev if isinstance(prev, dict) else prev.tc_components()
+        return set(k for k in cur if cur[k] != old[k])
+
+    def _netem_op(self, verb, params):
+        return QdiscOp(verb, params['ifb'], params['netem_parent'], params['netem_handle'], 'netem',
+                       loss=params['loss'], delay=params['delay'], jitter=params['jitter'])
+
+    def _filter_op(self, verb, params, dev, parent, redirect=None):
+        if flower_classifier():
+            op = FlowerOp if params['emfilter'].flower_keys() is not None else BpfOp
+            return op(verb, dev, parent, params['filter_handle'], params['emfilter'], params['classid'],
+                      redirect=redirect)
+        return FilterOp(verb, dev, parent, params['filter_handle'], params['emfilter'], params['classid'],
+                        redirect=redirect, ht=params['ht'])
+
+    def build_add(self, batch):
+        p = self._get_tc_params()
+        if shared_topology():
+            batch.add(ClassOp('add', p['ifb'], '1:', p['classid'], rate=SHARED_IFB_RATE))
+            batch.add(self._netem_op('add', p))
+            batch.add(self._filter_op('add', p, p['ifb'], '1:0'))
+        else:
+            batch.add(LinkOp('set', p['ifb'], up=True))
+            batch.add(self._filter_op('add', p, p['in_inf'], 'ffff:', redirect=p['ifb']))
+            batch.add(self._netem_op('add', p))
+        batch.add(ClassOp('add', p['out_inf'], '1:1', p['classid'], rate=p['bw']))
+        batch.add(self._filter_op('add', p, p['out_inf'], '1:0'))
+        batch.add(QdiscOp('add', p['out_inf'], p['classid'], kind='bfifo', limit=p['tb_qsize']))
+        return batch
+
+    def build_change(self, batch, prev=None):
+        '''
+        with prev, a rule or live components, only the objects whose parameters changed are
+        touched, a netem change resets its loss model state so it's left alone unless needed
+        '''
+        p = self._get_tc_params()
+        changed = self.changed_components(prev)
+        # filter is not going to be changed
+        if 'netem' in changed:
+            batch.add(self._netem_op('change', p))
+        if 'class' in changed:
+            batch.add(ClassOp('change', p['out_inf'], '1:1', p['classid'], rate=p['bw']))
+        if 'bfifo' in changed:
+            batch.add(QdiscOp('change', p['out_inf'], p['classid'], kind='bfifo', limit=p['tb_qsize']))
+        return batch
+
+    def build_remove(self, batch):
+        p = self._get_tc_params()
+        batch.add(self._filter_op('del', p, p['out_inf'], '1:0'))
+        batch.add(ClassOp('del', p['out_inf'], '1:1', p['classid']))
+        if shared_topology():
+            batch.add(self._filter_op('del', p, p['ifb'], '1:0'))
+            batch.add(ClassOp('del', p['ifb'], '1:', p['classid']))
+        else:
+            batch.add(QdiscOp('del', p['ifb'], 'root'))
+            batch.add(self._filter_op('del', p, p['in_inf'], 'ffff:', redirect=p['ifb']))
+            batch.add(LinkOp('set', p['ifb'], up=False))
+        return batch
 
     def add(self):
-        params = self._get_tc_params()
-        add_cmd = '''
-        ip link set dev ifb%(ifb_idx)d up
-        tc filter add dev %(in_inf)s parent ffff: protocol ip prio 1 handle ::%(handle)d %(emfilter)s flowid 1:%(handle)d action mirred egress redirect dev ifb%(ifb_idx)d
-        ''' % params
-        if self.sls is not None:
-            add_cmd += 'tc qdisc add dev ifb%(ifb_idx)d root handle 1: netem loss sls %(sls)s delay %(delay)dms %(jitter)dms\n' % params
-        elif self.burst is not None and self.burst > 0:
-            add_cmd += 'tc qdisc add dev ifb%(ifb_idx)d root handle 1: netem loss gemodel %(gemodel_p)s%% %(gemodel_r)s%% delay %(delay)dms %(jitter)dms\n' % params
-        else:
-            add_cmd += 'tc qdisc add dev ifb%(ifb_idx)d root handle 1: netem loss random %(loss)s%% delay %(delay)dms %(jitter)dms\n' % params
+        return exec_batch(self.build_add(Batch()))
 
-        add_cmd += '''
-        tc class add dev %(out_inf)s parent 1:1 classid 1:%(handle)d htb rate %(bw)skbit
-        tc filter add dev %(out_inf)s protocol ip parent 1:0 prio 1 handle ::%(handle)d %(emfilter)s flowid 1:%(handle)d
-        tc qdisc add dev %(out_inf)s parent 1:%(handle)d bfifo limit %(tb_qsize)d
-        ''' % params
+    def change(self):
+        return exec_batch(self.build_change(Batch()))
 
-        return exec_shell(add_cmd)
+    def remove(self):
+        return exec_batch(self.build_remove(Batch()))
 
-    def change(self):
-        params = self._get_tc_params()
-        change_cmd = ''
-        # filter is not going to be changed
-        if self.sls is not None:
-            change_cmd += 'tc qdisc change dev ifb%(ifb_idx)d root handle 1: netem loss sls %(sls)s delay %(delay)dms %(jitter)dms\n' % params
-        elif self.burst is not None and self.burst > 0:
-            change_cmd += 'tc qdisc change dev ifb%(ifb_idx)d root handle 1: netem loss gemodel %(gemodel_p)s%% %(gemodel_r)s%% delay %(delay)dms %(jitter)dms\n' % params
-        else:
-            change_cmd += 'tc qdisc change dev ifb%(ifb_idx)d root handle 1: netem loss random %(loss)s%% delay %(delay)dms %(jitter)dms\n' % params
+def _round_loss(loss):
+    if loss[0] == 'sls':
+        return loss
+    return (loss[0],) + tuple(round(float(v), 3) for v in loss[1:])
 
-        change_cmd += '''
-        tc class change dev %(out_inf)s parent 1:1 classid 1:%(handle)d htb rate %(bw)skbit
-        tc qdisc change dev %(out_inf)s parent 1:%(handle)d bfifo limit %(tb_qsize)d
-        ''' % params
+def _tc_output(args):
+    return subprocess.check_output(['tc'] + args).decode()
 
-        return exec_shell(change_cmd)
+class LiveState(object):
 
-    def remove(self):
-        params = self._get_tc_params()
-        remove_cmd = '''
-        tc filter del dev %(out_inf)s protocol ip parent 1:0 prio 1 handle 800::%(handle)d %(emfilter)s flowid 1:%(handle)d
-        tc class del dev %(out_inf)s parent 1:1 classid 1:%(handle)d
-        tc qdisc del dev ifb%(ifb_idx)d root
-        tc filter del dev %(in_inf)s parent ffff: protocol ip prio 1 handle 800::%(handle)d %(emfilter)s flowid 1:%(handle)d action mirred egress redirect dev ifb%(ifb_idx)d
-        ip link set dev ifb%(ifb_idx)d down
-        ''' % params
+    '''
+    snapshot of the kernel objects of the emulator, from one "tc -j qdisc show" and a
+    class and filter dump of each device and hook the rules use
+    '''
 
-        return exec_shell(remove_cmd)
+    def __init__(self):
+        # (dev, parent) -> (kind, options), (dev, classid) -> rate in kbit,
+        # (dev, parent) -> handles of the filters, u32 ones as rtnl.parse_u32_handle() gives them
+        self.qdiscs = {}
+        self.classes = {}
+        self.filters = {}
 
+    @classmethod
+    def read(cls):
+        import rtnl
+        live = cls()
+        for q in json.loads(_tc_output(['-j', 'qdisc', 'show'])):
+            parent = 'root' if q.get('root') else q.get('parent')
+            live.qdiscs[(q['dev'], parent)] = (q['kind'], q.get('options', {}))
+
+        devs = [gConfig['ingress'], gConfig['egress']]
+        if shared_topology():
+            devs += sorted(SHARED_IFBS.values())
+            hooks = [(dev, '1:0') for dev in devs]
+        else:
+            hooks = [(dev, parent) for dev in devs for parent in ('ffff:', '1:0')]
+
+        # htb classes have no json output in tc
+        for dev in devs:
+            for line in _tc_output(['class', 'show', 'dev', dev]).splitlines():
+                m = CLASS_LINE.match(line)
+                if m is not None:
+                    live.classes[(dev, m.group(1))] = float(m.group(3)) * RATE_UNITS.get(m.group(4), 0)
+        for dev, parent in hooks:
+            handles = live.filters[(dev, parent)] = set()
+            for f in json.loads(_tc_output(['-j', 'filter', 'show', 'dev', dev, 'parent', parent]) or '[]'):
+                options = f.get('options', {})
+                if 'fh' in options:
+                    handles.add(rtnl.parse_u32_handle(options['fh']))
+                elif 'handle' in options:
+                    # flower and bpf, as a number or a hex string depending on the tc version
+                    handles.add(int(str(options['handle']), 0))
+        return live
+
+    def _has_filter(self, dev, parent, handle):
+        import rtnl
+        if not isinstance(handle, int):
+            handle = rtnl.parse_u32_handle(handle)
+        return handle in self.filters.get((dev, parent), ())
+
+    def has(self, op):
+        '''
+        whether the kernel object a delete operation targets exists
+        '''
+        if isinstance(op, FilterOp):
+            return self._has_filter(op.dev, op.parent, op.handle)
+        if isinstance(op, ClassOp):
+            return (op.dev, op.classid) in self.classes
+        if isinstance(op, QdiscOp):
+            return (op.dev, op.parent) in self.qdiscs
+        return True
+
+    def components(self, rule):
+        '''
+        the components of the kernel objects of a saved rule, comparable with
+        Rule.tc_components(), None if one of its objects is missing
+        '''
+        p = rule._get_tc_params()
+        if shared_topology():
+            netem = self.qdiscs.get((p['ifb'], p['classid']))
+            present = (p['ifb'], p['classid']) in self.classes and \
+                self._has_filter(p['ifb'], '1:0', p['filter_handle'])
+        else:
+            netem = self.qdiscs.get((p['ifb'], 'root'))
+            present = self._has_filter(p['in_inf'], 'ffff:', p['filter_handle'])
+        bfifo = self.qdiscs.get((p['out_inf'], p['classid']))
+        rate = self.classes.get((p['out_inf'], p['classid']))
+        present = present and self._has_filter(p['out_inf'], '1:0', p['filter_handle'])
+        if not present or rate is None or netem is None or netem[0] != 'netem' or \
+                bfifo is None or bfifo[0] != 'bfifo':
+            return None
+
+        options = netem[1]
+        if 'loss-gemodel' in options:
+            loss = ('gemodel', 100 * options['loss-gemodel']['p'], 100 * options['loss-gemodel']['r'])
+        elif 'loss-random' in options:
+            loss = ('random', 100 * options['loss-random']['loss'])
+        else:
+            loss = ('random', 0)
+        if p['loss'][0] == 'sls':
+            # tc doesn't report the pattern, trust the saved rule
+            loss = p['loss']
+        delay = options.get('delay', {})
+        return {
+            'netem': (_round_loss(loss), int(round(delay.get('delay', 0) * 1000)),
+                      int(round(delay.get('jitter', 0) * 1000))),
+            'class': int(round(rate)),
+            'bfifo': int(bfifo[1].get('limit', -1))
+        }
 
-def add_rule(r):
+def load_desired(path):
+    '''
+    rules of a desired state file, a list of rules like the rules file without handles,
+    the parameters left out take the defaults of add
+    '''
+    with open(path, 'r') as f:
+        content = json.load(f)
+    if isinstance(content, dict):
+        content = content.get('rules', [])
+    rules = []
+    for d in content:
+        rule_dict = dict(RULE_DEFAULTS)
+        rule_dict.update(d)
+        rule_dict.setdefault('direction', rule_dict['emfilter']['direction'])
+        rule_dict['handle'] = None
+        rules.append(Rule.from_dict(rule_dict))
+    return rules
+
+def apply_rules(rs, plan=False):
+    '''
+    makes rules rs the whole rule set with one rules file update and one batch, the
+    saved rules not in rs are removed, and the objects of the others are compared with
+    the live kernel state so only the ones missing or differing are touched, with plan
+    the changes are printed but not made
+    '''
+    with span('load'):
+        saved = load_rules()
+    handles = copy.deepcopy(gHandleManager) if plan else gHandleManager
+    rules = RuleStore(saved.to_list())
+    if DRY_RUN:
+        print('dry run, compare with the saved rules only')
+        live = None
+    else:
+        try:
+            with span('live'):
+                live = LiveState.read()
+        except (OSError, ValueError, KeyError, subprocess.CalledProcessError) as e:
+            print('failed to read the live state: %s' % e)
+            return False
+    with span('build') as build:
+
+        desired = OrderedDict((r.key(), r) for r in rs)
+        batch = Batch()
+        diff = []
+        for key, d in rules.items():
+            if key not in desired:
+                prev = Rule.from_dict(rules.pop(key))
+                prev.build_remove(batch)
+                handles.remove_handle(prev.handle)
+                diff.append('- %s %s' % (prev.direction, prev.emfilter.matches()))
+
+        ret = True
+        unchanged = 0
+        for key, r in desired.items():
+            d = rules.get(key)
+            if d is None:
+                h = handles.get_available_handle(handle_max())
+                if h is None:
+                    print('apply rule, no handle available')
+                    ret = False
+                    continue
+                handles.add_handle(h)
+                r.set_handle(h)
+                r.build_add(batch)
+                diff.append('+ %s %s' % (r.direction, r.emfilter.matches()))
+            else:
+                prev = Rule.from_dict(d)
+                r.set_handle(prev.handle)
+                old = prev if live is None else live.components(prev)
+                if old is None:
+                    # remove what's left of the rule and add it again
+                    for op in prev.build_remove(Batch()).ops:
+                        if live.has(op):
+                            batch.add(op)
+                    r.build_add(batch)
+                    diff.append('! %s %s: missing in the kernel, add again' % (r.direction, r.emfilter.matches()))
+                elif r.changed_components(old):
+                    diff.append('~ %s %s: %s' % (r.direction, r.emfilter.matches(),
+                                                 ', '.join(sorted(r.changed_components(old)))))
+                    r.build_change(batch, old)
+                else:
+                    unchanged += 1
+            rules.put(r.to_dict())
+        build.set(ops=len(batch))
+
+    print('\n'.join(diff + ['= %d rules unchanged' % unchanged]) + '\n')
+    if plan:
+        print(batch)
+        return ret
+    if diff:
+        with span('save'):
+            save_rules(rules)
+    if len(batch) == 0:
+        print('nothing to apply')
+        return ret
+    with span('apply'):
+        return exec_batch(batch) and ret
+
+def plan_rules(rs):
+    return apply_rules(rs, plan=True)
+
+def lookup_rules(rs):
+    '''
+    the saved rules with the same filters as rules rs, None for the ones not found
+    '''
     rules = load_rules()
-    idx = r.exists(rules)
-    if idx != -1:
-        Rule.from_dict(rules[idx]).remove()
-        gHandleManager.remove_handle(rules[idx]['handle'])
-        del rules[idx]
-    h = gHandleManager.get_available_handle()
-    if h is None:
-        print('add rule, no handle available')
-        return
-    r.set_handle(h)
-    rules.append({
-        'emfilter': r.emfilter.__dict__,
-        'direction': r.direction,
-        'bw': r.bw,
-        'loss': r.loss,
-        'qdelay': r.qdelay,
-        'jitter': r.jitter,
-        'delay': r.delay,
-        'burst': r.burst,
-        'sls': r.sls,
-        'handle': r.handle
-    })
-    save_rules(rules)
-    r.add()
+    return [None if d is None else Rule.from_dict(d) for d in rules.lookup([r.key() for r in rs])]
 
-def change_rule(r):
-    rules = load_rules()
-    idx = r.exists(rules)
-    if idx != -1:
-        h = rules[idx]['handle']
-        r.set_handle(h)
-        del rules[idx]
-        rules.append({
-            'emfilter': r.emfilter.__dict__,
-            'direction': r.direction,
-            'bw': r.bw,
-            'loss': r.loss,
-            'qdelay': r.qdelay,
-            'jitter': r.jitter,
-            'delay': r.delay,
-            'burst': r.burst,
-            'sls': r.sls,
-            'handle': r.handle
-        })
+def add_rule(r):
+    return add_rules([r])
+
+def add_rules(rs):
+    '''
+    adds several rules with one rules file update and one batch, a rule replaces the
+    saved one with the same filter. The rules file and the handles only change once the
+    batch went through
+    '''
+    with span('load'):
+        rules = load_rules()
+    batch = Batch()
+    replaced = []
+    added = []
+    with span('handles'):
+        keys = set()
+        for r in rs:
+            key = r.key()
+            if key in keys:
+                print('add rule, %s %s given twice' % (r.direction, r.emfilter.ip))
+                continue
+            prev = rules.get(key)
+            if prev is not None:
+                # the replaced rule's handle can be taken again, its objects go first
+                gHandleManager.remove_handle(prev['handle'])
+            h = gHandleManager.get_available_handle(handle_max())
+            if h is None:
+                if prev is not None:
+                    gHandleManager.add_handle(prev['handle'])
+                print('add rule, no handle available')
+                continue
+            keys.add(key)
+            gHandleManager.add_handle(h)
+            r.set_handle(h)
+            if prev is not None:
+                replaced.append(prev)
+            added.append(r)
+    with span('build', rules=len(added)) as s:
+        # the replaced rules go first, their handles may have been taken again
+        for prev in replaced:
+            Rule.from_dict(prev).build_remove(batch)
+        for r in added:
+            r.build_add(batch)
+        s.set(ops=len(batch))
+    with span('apply'):
+        ok = exec_batch(batch)
+    if not ok:
+        # the saved rules stay as they were, with their handles
+        for r in added:
+            gHandleManager.remove_handle(r.handle)
+        for prev in replaced:
+            gHandleManager.add_handle(prev['handle'])
+        return False
+    for r in added:
+        rules.pop(r.key())
+        rules.put(r.to_dict())
+    with span('save'):
         save_rules(rules)
-        r.change()
+    return len(added) == len(rs)
+
+def change_rule(r):
+    return change_rules([r])
+
+def change_rules(rs):
+    '''
+    changes several rules with one rules file update and one batch, only the tc
+    operations for the parameters differing from the saved ones are issued. The rules
+    file only changes once the batch went through
+    '''
+    with span('load'):
+        rules = load_rules()
+        saved = rules.lookup([r.key() for r in rs])
+    batch = Batch()
+    changed = []
+    with span('build') as s:
+        for r, prev in zip(rs, saved):
+            if prev is None:
+                print('no rule found!')
+                continue
+            prev = Rule.from_dict(prev)
+            r.set_handle(prev.handle)
+            r.build_change(batch, prev)
+            changed.append(r)
+        s.set(rules=len(changed), ops=len(batch))
+    if not changed:
+        return False
+    if len(batch) == 0:
+        print('nothing to change')
     else:
-        print('no rule found!')
+        with span('apply'):
+            if not exec_batch(batch):
+                return False
+    for r in changed:
+        rules.put(r.to_dict())
+    with span('save'):
+        save_rules(rules)
+    return len(changed) == len(rs)
 
 def remove_rule(r):
-    print('removing rule for %s %s...' % (r.emfilter.__dict__, r.direction))
-    rules = load_rules()
-    idx = r.exists(rules)
-    if idx != -1:
-        Rule.from_dict(rules[idx]).remove()
-        gHandleManager.remove_handle(rules[idx]['handle'])
-        del rules[idx]
+    return remove_rules([r])
+
+def remove_rules(rs):
+    '''
+    removes several rules with one rules file update and one batch
+    '''
+    with span('load'):
+        rules = load_rules()
+    batch = Batch()
+    removed = []
+    with span('handles'):
+        for r in rs:
+            print('removing rule for %s %s...' % (r.emfilter.__dict__, r.direction))
+            prev = rules.pop(r.key())
+            if prev is None:
+                print('rule not found!\n')
+                continue
+            removed.append(prev)
+    if not removed:
+        return False
+    with span('build', rules=len(removed)) as s:
+        for prev in removed:
+            Rule.from_dict(prev).build_remove(batch)
+        s.set(ops=len(batch))
+    with span('apply'):
+        ok = exec_batch(batch)
+    if not ok:
+        # the rules stay saved with their handles, which must not be handed out again
+        # while their tc objects may still be there
+        for prev in removed:
+            rules.put(prev)
+        return False
+    for prev in removed:
+        gHandleManager.remove_handle(prev['handle'])
+    with span('save'):
         save_rules(rules)
-    else:
-        print('rule not found!\n')
+    return len(removed) == len(rs)
+
+TXN_VERBS = ('remove', 'change', 'add')
+
+def load_txn(path):
+    '''
+    operations of a transaction file, a list of rules like the desired state file, each
+    with "op" add, change or remove
+    '''
+    with open(path, 'r') as f:
+        content = json.load(f)
+    if isinstance(content, dict):
+        content = content.get('ops', [])
+    return content
+
+def check_rule(r):
+    addr, _, prefix = r.emfilter.ip.partition('/')
+    try:
+        socket.inet_aton(addr)
+    except socket.error:
+        raise ValueError('address %s' % r.emfilter.ip)
+    if prefix and not 0 <= int(prefix) <= 32:
+        raise ValueError('prefix of %s' % r.emfilter.ip)
+    if r.direction not in ('uplink', 'downlink') or r.direction != r.emfilter.direction:
+        raise ValueError('direction %s of %s' % (r.direction, r.emfilter.ip))
+    if not r.bw > 0:
+        raise ValueError('bw %s of %s' % (r.bw, r.emfilter.ip))
+    if not 0 <= r.loss <= 100:
+        raise ValueError('loss %s of %s' % (r.loss, r.emfilter.ip))
+    if min(r.delay, r.jitter, r.qdelay) < 0:
+        raise ValueError('negative delay of %s' % r.emfilter.ip)
+
+def txn_steps(ops, rules, handles):
+    '''
+    [(verb, rule, saved rule)] of the operations, checked against the saved rules in
+    rules and handles, which are updated, removes first so their handles can be taken
+    again. A change leaves the parameters not given as they were, an add takes the
+    defaults of add for them. Raises ValueError when an operation can't be made
+    '''
+    seen = set()
+    steps = []
+    for d in sorted(ops, key=lambda d: TXN_VERBS.index(d.get('op')) if d.get('op') in TXN_VERBS else -1):
+        verb = d.get('op')
+        if verb not in TXN_VERBS:
+            raise ValueError('unknown op %s' % verb)
+        rule_dict = dict((k, v) for k, v in d.items() if k != 'op')
+        rule_dict.setdefault('direction', rule_dict['emfilter']['direction'])
+        key = RuleStore.key(rule_dict)
+        if key in seen:
+            raise ValueError('more than one op for %s %s' % (rule_dict['direction'], rule_dict['emfilter']['ip']))
+        seen.add(key)
+        saved = rules.get(key)
+        prev = None if saved is None else Rule.from_dict(saved)
+        if verb == 'add':
+            if saved is not None:
+                raise ValueError('rule for %s %s exists' % (prev.direction, prev.emfilter.ip))
+            merged = dict(RULE_DEFAULTS)
+            merged.update(rule_dict)
+            merged['handle'] = handles.get_available_handle(handle_max())
+            if merged['handle'] is None:
+                raise ValueError('no handle available')
+            handles.add_handle(merged['handle'])
+        else:
+            if saved is None:
+                raise ValueError('no rule for %s %s' % (rule_dict['direction'], rule_dict['emfilter']['ip']))
+            merged = dict(saved)
+            merged.update(rule_dict)
+            merged['handle'] = saved['handle']
+        r = Rule.from_dict(merged)
+        if verb == 'remove':
+            rules.pop(key)
+            handles.remove_handle(prev.handle)
+        else:
+            check_rule(r)
+            rules.put(r.to_dict())
+        steps.append((verb, r, prev))
+    return steps
+
+def gather_links(ops):
+    '''
+    the operations with the ifb devices brought up before and down after the others, so
+    the tc ones run back to back in one process
+    '''
+    links = OrderedDict()
+    for op in ops:
+        if isinstance(op, LinkOp):
+            # the last state wins, a handle removed and taken again keeps its ifb up
+            links[op.dev] = op
+    return [op for op in links.values() if op.up] + \
+        [op for op in ops if not isinstance(op, LinkOp)] + \
+        [op for op in links.values() if not op.up]
+
+def rollback(steps):
+    '''
+    puts the kernel objects of the rules of a failed transaction back as the rules file
+    has them, what's left of the added rules is removed
+    '''
+    try:
+        live = LiveState.read()
+    except (OSError, ValueError, KeyError, subprocess.CalledProcessError) as e:
+        print('rollback failed to read the live state: %s' % e)
+        return False
+    batch = Batch()
+    seen = set()
+
+    def clear(rule, keep_link=False):
+        for op in rule.build_remove(Batch()).ops:
+            if keep_link and isinstance(op, LinkOp):
+                continue
+            if live.has(op) and str(op) not in seen:
+                seen.add(str(op))
+                batch.add(op)
+
+    added = set(r.handle for verb, r, _ in steps if verb == 'add')
+    for verb, r, prev in reversed(steps):
+        if verb == 'add':
+            clear(r)
+            continue
+        # the objects of a handle an added rule took again are gone by now
+        old = None if prev.handle in added else live.components(prev)
+        if old is None:
+            clear(prev, keep_link=True)
+            prev.build_add(batch)
+        elif prev.changed_components(old):
+            prev.build_change(batch, old)
+    return exec_batch(batch)
+
+def run_txn(ops):
+    '''
+    makes add, change and remove operations all or none: they're checked against the saved
+    rules before anything is touched and sent as one batch, the rules file is saved only
+    when the batch went through, otherwise the rules are rolled back in the kernel
+    '''
+    with span('load'):
+        saved = load_rules()
+    rules = RuleStore(saved.to_list())
+    handles = copy.deepcopy(gHandleManager)
+    with span('build') as s:
+        try:
+            steps = txn_steps(ops, rules, handles)
+            batch = Batch()
+            for verb, r, prev in steps:
+                if verb == 'add':
+                    r.build_add(batch)
+                elif verb == 'change':
+                    r.build_change(batch, prev)
+                else:
+                    prev.build_remove(batch)
+            batch.ops = gather_links(batch.ops)
+        except (AttributeError, KeyError, TypeError, ValueError, socket.error) as e:
+            print('transaction rejected, nothing applied: %s' % e)
+            return False
+        s.set(rules=len(steps), ops=len(batch))
+
+    start = monotonic()
+    with span('apply'):
+        ok = exec_batch(batch)
+    if ok:
+        print('%d operations of %d rules applied in %.1f ms' % (len(batch), len(steps), (monotonic() - start) * 1000))
+        for verb, r, prev in steps:
+            if verb == 'add':
+                gHandleManager.add_handle(r.handle)
+            elif verb == 'remove':
+                gHandleManager.remove_handle(prev.handle)
+        with span('save'):
+            save_rules(rules)
+        return True
+    print('transaction failed, rolling back to the rules in %s' % RULE_PATH)
+    with span('rollback'):
+        if not rollback(steps):
+            print('rollback failed, "emulator.py apply %s" puts the saved rules back' % RULE_PATH)
+    return False
+
+class Transaction(object):
+
+    '''
+    rule operations made all or none in one batch, through piemd when it's running
+
+        txn = Transaction()
+        txn.change(Rule(Filter('uplink', '10.0.0.5'), 500, 5, 100, 0, 80, 'uplink'))
+        txn.remove(Rule(Filter('downlink', '10.0.0.6'), 0, 0, 0, 0, 0, 'downlink'))
+        txn.commit()
+    '''
+
+    def __init__(self):
+        self.ops = []
+
+    def _op(self, verb, rule):
+        d = rule.to_dict() if isinstance(rule, Rule) else dict(rule)
+        d.pop('handle', None)
+        d['op'] = verb
+        self.ops.append(d)
+
+    def add(self, rule):
+        self._op('add', rule)
+
+    def change(self, rule):
+        self._op('change', rule)
+
+    def remove(self, rule):
+        self._op('remove', rule)
+
+    def commit(self):
+        return submit('txn', ops=self.ops)
+
+def list_rules():
+    print(json.dumps(gConfig, indent=4))
+    rules = load_rules()
+    if KEEP_RULES:
+        print('rules in memory\n%s\n' % json.dumps(rules.to_list(), indent=4))
+    return True
+
+RULE_COMMANDS = {
+    'add': add_rules,
+    'change': change_rules,
+    'remove': remove_rules,
+    'apply': apply_rules,
+    'plan': plan_rules
+}
+
+def run_command(cmd, rules=(), ops=None):
+    '''
+    runs a subcommand in this process, all the rules in one batch, the operations of a
+    transaction in ops
+    '''
+    if cmd == 'list':
+        return list_rules()
+    elif cmd == 'latency':
+        print(gTracer.summary())
+        return True
+    with span(cmd, rules=len(rules)) as s:
+        if cmd == 'config':
+            ret = reload_config()
+        elif cmd == 'init':
+            ret = init()
+        elif cmd == 'uninit':
+            ret = uninit()
+        elif cmd == 'txn':
+            ret = run_txn(ops or [])
+        else:
+            ret = RULE_COMMANDS[cmd](rules)
+        s.set(ok=bool(ret))
+    return ret
+
+class Client(object):
+
+    '''
+    thin client of piemd, one json request/reply per line over the unix socket
+    '''
+
+    def __init__(self, path):
+        self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self.sock.connect(path)
+        self.rfile = self.sock.makefile('rb')
+
+    def call(self, cmd, rules=(), ops=None):
+        request = {'cmd': cmd, 'rules': [r.to_dict() for r in rules]}
+        if ops is not None:
+            request['ops'] = ops
+        self.sock.sendall((json.dumps(request) + '\n').encode())
+        line = self.rfile.readline()
+        if not line:
+            raise IOError('piemd closed the connection')
+        return json.loads(line.decode())
+
+def get_client():
+    global gClient
+    if gClient is None and not DRY_RUN and os.path.exists(SOCKET_PATH):
+        try:
+            gClient = Client(SOCKET_PATH)
+        except (IOError, OSError, socket.error) as e:
+            print('piemd not reachable at %s: %s' % (SOCKET_PATH, e))
+    return gClient
+
+def submit(cmd, rules=(), ops=None):
+    '''
+    runs a subcommand in piemd when it's running, so rules, handles and config stay in
+    memory there, otherwise in this process. Once piemd is connected it's never run here
+    too: piemd may have applied the request before failing, so a failure after connecting
+    is reported and the next call connects again
+    '''
+    global gClient
+    client = get_client()
+    if client is None:
+        return run_command(cmd, rules, ops)
+    try:
+        reply = client.call(cmd, rules, ops)
+        sys.stdout.write(reply['output'])
+        return reply['ok']
+    except (IOError, OSError, socket.error, KeyError, ValueError) as e:
+        print('piemd request %s failed: %s' % (cmd, e))
+        client.sock.close()
+        gClient = None
+        return False
 
 def main():
     arg_parser = argparse.ArgumentParser()
     arg_parser.add_argument('--dryrun', action='store_true', help='Dry run', default=False)
+    arg_parser.add_argument('--trace', help='append a json line per command phase to this file, when run without piemd')
 
     subparsers = arg_parser.add_subparsers(dest='subcommand')
 
@@ -412,6 +2015,41 @@ def main():
         type=int
     )
 
+    config_parser.add_argument('--backend',
+        action='store',
+        help='how rules are installed, shell runs tc/ip, netlink talks to the kernel directly',
+        choices=['shell', 'netlink'],
+        default='shell'
+    )
+
+    config_parser.add_argument('--classifier',
+        action='store',
+        help='linear chains all client filters, hashed spreads them over a u32 hash table on the last address octet, '
+             'flower looks them up in flower hash tables',
+        choices=['linear', 'hashed', 'flower'],
+        default='linear'
+    )
+
+    config_parser.add_argument('--topology',
+        action='store',
+        help='dedicated gives each rule an ifb of its own, shared puts each rule in an htb class of one ifb per direction',
+        choices=['dedicated', 'shared'],
+        default='dedicated'
+    )
+
+    config_parser.add_argument('--numrules',
+        action='store',
+        help='number of rules the shared topology makes room for, up to 65533',
+        default=4094,
+        type=int
+    )
+
+    config_parser.add_argument('--persist',
+        action='store_true',
+        help='keep the rules over uninit, init restores them in one batch',
+        default=False
+    )
+
     # list command
     list_parser = subparsers.add_parser('list')
 
@@ -433,10 +2071,10 @@ def main():
     add_parser.add_argument('--ip', '-f', help="src(uplink) or dst(downlink) ip filter", required=True)
     add_parser.add_argument('--direction', '-c', choices=['uplink', 'downlink'], required=True)
 
-    add_parser.add_argument('--tos', help='filter by dscp value', default=None)
-    add_parser.add_argument('--srcport', help='filter by source port', default=None)
-    add_parser.add_argument('--dstport', help='filter by destination port', default=None)
-    add_parser.add_argument('--ptype', help='filter by RTP payload type', default=None)
+    add_parser.add_argument('--tos', type=filter_arg('tos'), help='filter by dscp value', default=None)
+    add_parser.add_argument('--srcport', type=filter_arg('srcport'), help='filter by source port', default=None)
+    add_parser.add_argument('--dstport', type=filter_arg('dstport'), help='filter by destination port', default=None)
+    add_parser.add_argument('--ptype', type=filter_arg('ptype'), help='filter by RTP payload type', default=None)
     add_parser.add_argument('--protocol', help='filter by protocol number', choices=['tcp', 'udp', 'all'], default='all')
 
     # change command
@@ -451,11 +2089,43 @@ def main():
     change_parser.add_argument('--ip', '-f', help="src(uplink) or dst(downlink) ip filter", required=True)
     change_parser.add_argument('--direction', '-c', choices=['uplink', 'downlink'], required=True)
 
+    change_parser.add_argument('--tos', type=filter_arg('tos'), help='filter by dscp value', default=None)
+    change_parser.add_argument('--srcport', type=filter_arg('srcport'), help='filter by source port', default=None)
+    change_parser.add_argument('--dstport', type=filter_arg('dstport'), help='filter by destination port', default=None)
+    change_parser.add_argument('--ptype', type=filter_arg('ptype'), help='filter by RTP payload type', default=None)
+    change_parser.add_argument('--protocol', help='filter by protocol number', choices=['tcp', 'udp', 'all'], default='all')
+
     # remove command
     remove_parser = subparsers.add_parser('remove')
     remove_parser.add_argument('--ip', '-f', help="src(uplink) or dst(downlink) ip filter", required=True)
     remove_parser.add_argument('--direction', '-c', choices=['uplink', 'downlink'])
 
+    remove_parser.add_argument('--tos', type=filter_arg('tos'), help='filter by dscp value', default=None)
+    remove_parser.add_argument('--srcport', type=filter_arg('srcport'), help='filter by source port', default=None)
+    remove_parser.add_argument('--dstport', type=filter_arg('dstport'), help='filter by destination port', default=None)
+    remove_parser.add_argument('--ptype', type=filter_arg('ptype'), help='filter by RTP payload type', default=None)
+    remove_parser.add_argument('--protocol', help='filter by protocol number', choices=['tcp', 'udp', 'all'], default='all')
+
+    # apply command
+    apply_parser = subparsers.add_parser('apply')
+    apply_parser.add_argument('desired', help='json file with the list of rules to have, like the rules file without handles')
+    apply_parser.add_argument('--plan', action='store_true', help='print the changes without making them', default=False)
+
+    # txn command
+    txn_parser = subparsers.add_parser('txn')
+    txn_parser.add_argument('file', help='json file with the list of rules to add, change or remove, each with "op"')
+
+    # latency command
+    subparsers.add_parser('latency')
+
+    # stats command
+    stats_parser = subparsers.add_parser('stats')
+    stats_parser.add_argument('--interval', '-n',
+        type=float,
+        help='seconds between the two samples the rates are computed from',
+        default=1
+    )
+
     args = arg_parser.parse_args()
     global DRY_RUN
     DRY_RUN = args.dryrun
@@ -466,39 +2136,41 @@ def main():
 
     global gConfig
     gConfig = load_config(CONFIG_PATH)
+    if args.trace:
+        trace_to(args.trace)
 
     if args.subcommand == 'config':
         save_config(args)
-    elif args.subcommand == 'list':
-        print(json.dumps(gConfig, indent=4))
-        load_rules()
-    elif args.subcommand == 'init':
-        init()
-    elif args.subcommand == 'uninit':
-        uninit()
+        submit('config')
+    elif args.subcommand in ('list', 'init', 'uninit', 'latency'):
+        submit(args.subcommand)
     elif args.subcommand == 'add':
         f = Filter(args.direction, args.ip, args.tos, args.srcport, args.dstport, args.ptype, args.protocol)
-        add_rule(
+        submit('add', [
             Rule(f, args.bw, args.loss, args.qdelay, args.jitter, args.delay, args.direction, args.burst, args.sls)
-        )
+        ])
     elif args.subcommand == 'change':
-        f = Filter(args.direction, args.ip)
-        change_rule(
+        f = Filter(args.direction, args.ip, args.tos, args.srcport, args.dstport, args.ptype, args.protocol)
+        submit('change', [
             Rule(f, args.bw, args.loss, args.qdelay, args.jitter, args.delay, args.direction, args.burst, args.sls)
-        )
+        ])
+    elif args.subcommand == 'apply':
+        try:
+            desired = load_desired(args.desired)
+        except (IOError, KeyError, ValueError) as e:
+            arg_parser.error('invalid desired state %s: %s' % (args.desired, e))
+        submit('plan' if args.plan else 'apply', desired)
+    elif args.subcommand == 'txn':
+        submit('txn', ops=load_txn(args.file))
+    elif args.subcommand == 'stats':
+        import piemstats
+        piemstats.print_stats(args.interval)
     elif args.subcommand == 'remove':
-        f = Filter(args.direction, args.ip)
-        if args.direction is not None:
-            remove_rule(
-                Rule(f, 0, 0, 0, 0, 0, args.direction)
-            )
-        else:
-            remove_rule(
-                Rule(f, 0, 0, 0, 0, 0, 'uplink')
-            )
-            remove_rule(
-                Rule(f, 0, 0, 0, 0, 0, 'downlink')
-            )
+        directions = [args.direction] if args.direction is not None else ['uplink', 'downlink']
+        submit('remove', [
+            Rule(Filter(d, args.ip, args.tos, args.srcport, args.dstport, args.ptype, args.protocol), 0, 0, 0, 0, 0, d)
+            for d in directions
+        ])
     else:
         arg_parser.error('subcommand not found!')
 
@@ -5,6 +5,12 @@ REMOTE_PORT=9000
 PROTOCOL="udp"
 IP="192.168.1.0/24"
 
+# blocked addresses, blocked address and protocol:remote port, and the list of both
+# the two static FORWARD rules match, see blocker.py
+ALL_SET="piem-block-all"
+PORT_SET="piem-block-port"
+BLOCK_SET="piem-block"
+
 if [ `whoami` != root ]; then
     echo "Please run this script using sudo"
     exit
@@ -12,7 +18,11 @@ fi
 
 COMMAND_LINE_OPTIONS_HELP="
 Usage:  $0 block [protocol] [remote_port] [ip]
+        $0 block all [ip]
         $0 unblock [protocol] [remote_port] [ip]
+        $0 unblock all [ip]
+        $0 init
+        $0 uninit
         $0 flush
         $0 list
 "
@@ -22,57 +32,106 @@ usage() {
    exit 3
 }
 
+init()
+{
+    ipset create -exist ${ALL_SET} hash:net
+    ipset create -exist ${PORT_SET} hash:net,port
+    ipset create -exist ${BLOCK_SET} list:set
+    ipset add -exist ${BLOCK_SET} ${ALL_SET}
+    ipset add -exist ${BLOCK_SET} ${PORT_SET}
+    # the address is the source of uplink packets, matched with the remote destination
+    # port, and the destination of downlink ones, with the remote source port
+    for FLAGS in src,dst dst,src; do
+        iptables -C FORWARD -m set --match-set ${BLOCK_SET} ${FLAGS} -j DROP 2>/dev/null ||
+            iptables -I FORWARD -m set --match-set ${BLOCK_SET} ${FLAGS} -j DROP
+    done
+}
+
+uninit()
+{
+    for FLAGS in src,dst dst,src; do
+        iptables -D FORWARD -m set --match-set ${BLOCK_SET} ${FLAGS} -j DROP 2>/dev/null || true
+    done
+    for SET in ${BLOCK_SET} ${ALL_SET} ${PORT_SET}; do
+        ipset destroy ${SET} 2>/dev/null || true
+    done
+}
+
 block()
 {
-    #iptables -A OUTPUT -p ${PROTOCOL} --dport ${REMOTE_PORT} -s ${IP} -j DROP
-    #iptables -A INPUT -p ${PROTOCOL} --sport ${REMOTE_PORT} -d ${IP} -j DROP
-    iptables -A FORWARD -p ${PROTOCOL} --dport ${REMOTE_PORT} -s ${IP} -j DROP
-    iptables -A FORWARD -p ${PROTOCOL} --sport ${REMOTE_PORT} -d ${IP} -j DROP
+    init
+    if [ "${PROTOCOL}" == "all" ]; then
+        ipset add -exist ${ALL_SET} ${IP}
+    else
+        ipset add -exist ${PORT_SET} ${IP},${PROTOCOL}:${REMOTE_PORT}
+    fi
 }
 
 unblock()
 {
-    #iptables -D OUTPUT -p ${PROTOCOL} --dport ${REMOTE_PORT} -s ${IP} -j DROP
-    #iptables -D INPUT -p ${PROTOCOL} --sport ${REMOTE_PORT} -d ${IP} -j DROP
-    iptables -D FORWARD -p ${PROTOCOL} --dport ${REMOTE_PORT} -s ${IP} -j DROP
-    iptables -D FORWARD -p ${PROTOCOL} --sport ${REMOTE_PORT} -d ${IP} -j DROP
+    if [ "${PROTOCOL}" == "all" ]; then
+        ipset del -exist ${ALL_SET} ${IP}
+    else
+        ipset del -exist ${PORT_SET} ${IP},${PROTOCOL}:${REMOTE_PORT}
+    fi
 }
 
 flush()
 {
-    iptables --flush
+    # only the blocks, the other iptables rules stay
+    ipset flush ${ALL_SET}
+    ipset flush ${PORT_SET}
 }
 
 list()
 {
-    iptables -L
+    ipset list ${ALL_SET}
+    ipset list ${PORT_SET}
 }
 
 
 case "$1" in
 
 block)
-    if [ "$#" -ne 4 ]; then
+    if [ "$2" == "all" ] && [ "$#" -eq 3 ]; then
+        echo "block all traffic for $3"
+        PROTOCOL=all
+        IP=$3
+    elif [ "$#" -eq 4 ]; then
+        echo "block $2 for remote port $3 for $4"
+        PROTOCOL=$2
+        REMOTE_PORT=$3
+        IP=$4
+    else
         usage
     fi
-    echo "block $2 for remote port $3 for $4"
-    PROTOCOL=$2
-    REMOTE_PORT=$3
-    IP=$4
     block
     ;;
 
 unblock)
-    if [ "$#" -ne 4 ]; then
+    if [ "$2" == "all" ] && [ "$#" -eq 3 ]; then
+        echo "unblock all traffic for $3"
+        PROTOCOL=all
+        IP=$3
+    elif [ "$#" -eq 4 ]; then
+        echo "unblock $2 for remote port $3 for $4"
+        PROTOCOL=$2
+        REMOTE_PORT=$3
+        IP=$4
+    else
         usage
     fi
-    echo "unblock $2 for remote port $3 for $4"
-    PROTOCOL=$2
-    REMOTE_PORT=$3
-    IP=$4
     unblock
     ;;
 
+init)
+    init
+    ;;
+
+uninit)
+    uninit
+    ;;
+
 flush)
     flush
     ;;
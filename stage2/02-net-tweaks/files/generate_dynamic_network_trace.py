@@ -1,66 +1,197 @@
 # This tool translates a network trace as produced by the mari_pcap_decode tool in MARI library to a network trace in a format compatible with the TA specification pattern.
+#
+# The TA trace is a run of sections "time-loss-latency-bw-burst-qdelay" separated by '_', on one
+# line or spread over many. Section k holds from its time until the time of section k + 1, and
+# the first one, at time 'S' or 0, gives the base parameters of the rule. The trace is read and
+# the dynamics written as a stream, so the memory used doesn't grow with the length of the trace.
 import argparse
 import json
-
-
-def parse_section(section):
-    par = section.split('-')
-    for k in range(6):
-        assert(len(par[k]) > 0)
-        par[k] = par[k].strip()
-    return tuple(par)
-
-
-def write_dynamic_format(prefix, ta_format, direction, ip):
-    # Format as https://sqbu-github.cisco.com/jianfu/piem#emulate-network-dynamics
-    sections = ta_format.split('_')
-    time0, loss0, latency0, bw0, burst0, qdelay0 = parse_section(sections[0])
-    assert(time0 == 'S' or time0 == '0')
-
-    fileOut = prefix + '_dynamic_trace.json'
-    with open(fileOut, 'w') as f:
-        f.write('{\n')
-        f.write('\t"qdelay": ' + qdelay0 + ',\n')
-        f.write('\t"loss": ' + loss0 + ',\n')
-        f.write('\t"bw": ' + bw0 + ',\n')
-        f.write('\t"handle": 2,\n')                 # What is this?
-        f.write('\t"delay": ' + latency0 + ',\n')
-        f.write('\t"burst": ' + burst0 + ',\n')
-        f.write('\t"emfilter": {\n')
-        f.write('\t\t"direction": "' + direction + '",\n')
-        f.write('\t\t"ip": "' + ip + '",\n')
-        f.write('\t\t"srcport": null,\n')
-        f.write('\t\t"ptype": null,\n')
-        f.write('\t\t"tos": null,\n')
-        f.write('\t\t"dstport": null\n')
-        f.write('\t},\n')
-        f.write('\t"sls": null,\n')
-
-        f.write('\n')
-        f.write('\t"dynamics": [\n')
-
-        lastbw = bw0
-        lasttime = 0
-        for k in range(1, len(sections)):
-            time, loss, latency, bw, burst, qdelay = parse_section(sections[k])
-            assert(loss == loss0 and latency == latency0 and burst == burst0 and qdelay == qdelay0)
-            duration = int(time) - lasttime
-            if duration > 0:
-                f.write('\t\t{\n')
-                f.write('\t\t\t"bw": ' + lastbw + ',\n')
-                f.write('\t\t\t"duration": ' + str(duration) + ',\n')
-                f.write('\t\t\t"interval": 0\n')
-                if k == len(sections) - 1:
-                    f.write('\t\t}\n')
-                else:
-                    f.write('\t\t},\n')
-            lasttime = int(time)
-            lastbw = bw
-
-        f.write('\t]\n')
-        f.write('}\n')
-
-    return fileOut
+import os
+import sys
+from collections import OrderedDict
+
+# the parameters of a section after its time, with the names dynem.py knows them by
+PARAMS = ('loss', 'delay', 'bw', 'burst', 'qdelay')
+
+CHUNK_SIZE = 1 << 16
+# parsed parameters are kept per distinct text, up to this many
+PARAMS_CACHE_SIZE = 4096
+
+
+def iter_sections(f):
+    '''
+    sections of a TA trace in file f, read a chunk at a time, separated by '_' or white space
+    '''
+    rest = ''
+    while True:
+        chunk = f.read(CHUNK_SIZE)
+        if not chunk:
+            break
+        tokens = (rest + chunk).replace('_', ' ').split()
+        # the last token may go on in the next chunk, unless the chunk ended on a separator
+        rest = tokens.pop() if tokens and not chunk[-1].isspace() and chunk[-1] != '_' else ''
+        for token in tokens:
+            yield token
+    if rest:
+        yield rest
+
+
+def parse_number(value, what):
+    try:
+        return int(value)
+    except ValueError:
+        try:
+            return float(value)
+        except ValueError:
+            raise ValueError('invalid %s "%s"' % (what, value))
+
+
+def to_ms(seconds):
+    return int(round(float(seconds) * 1000))
+
+
+def seconds(ms):
+    '''
+    a duration in ms as the seconds dynem.py reads, times are kept in whole ms so the
+    durations add up to the offsets of the trace
+    '''
+    return ms // 1000 if ms % 1000 == 0 else ms / 1000.0
+
+
+def parse_params(text, index):
+    '''
+    parameters of a section from the text after its time
+    '''
+    par = text.split('-')
+    if len(par) < 5 or not all(par[:5]):
+        raise ValueError('section %d "%s" does not have 6 fields time-loss-latency-bw-burst-qdelay' % (index, text))
+    return tuple(parse_number(v, '%s in section %d' % (name, index)) for name, v in zip(PARAMS, par))
+
+
+class SectionParser(object):
+
+    '''
+    parses sections into (time in ms, parameters), time is None for the 'S' of the
+    first one, a trace only has a few distinct parameter sets so they are parsed once
+    '''
+
+    def __init__(self):
+        self.cache = {}
+
+    def parse(self, section, index):
+        time, _, text = section.partition('-')
+        params = self.cache.get(text)
+        if params is None:
+            params = parse_params(text, index)
+            if len(self.cache) >= PARAMS_CACHE_SIZE:
+                self.cache.clear()
+            self.cache[text] = params
+        if time == 'S':
+            return None, params
+        try:
+            return to_ms(time), params
+        except ValueError:
+            raise ValueError('invalid time in section %d "%s"' % (index, time))
+
+
+def iter_segments(sections, last_duration=0):
+    '''
+    yields the parameters of the first section, then (duration in ms, parameters) of
+    each section held for some time, adjacent sections with the same parameters merged,
+    the last section only marks the end of the trace unless last_duration is given
+    '''
+    parser = SectionParser()
+    sections = iter(sections)
+    try:
+        first = next(sections)
+    except StopIteration:
+        raise ValueError('empty trace')
+    time0, params = parser.parse(first, 0)
+    if time0 not in (None, 0):
+        raise ValueError('the first section starts at %s instead of S or 0' % time0)
+    yield params
+
+    start, last = 0, 0
+    for index, section in enumerate(sections, 1):
+        time, next_params = parser.parse(section, index)
+        if time is None or time < last:
+            raise ValueError('section %d goes back in time to %s' % (index, time))
+        if next_params != params:
+            if time > start:
+                yield time - start, params
+            start, params = time, next_params
+        last = time
+    if last_duration > 0:
+        last += to_ms(last_duration)
+    if last > start:
+        yield last - start, params
+
+
+def base_rule(params, direction, ip):
+    rule = OrderedDict(zip(PARAMS, params))
+    rule['emfilter'] = OrderedDict([
+        ('direction', direction),
+        ('ip', ip),
+        ('srcport', None),
+        ('ptype', None),
+        ('tos', None),
+        ('dstport', None)
+    ])
+    rule['sls'] = None
+    return rule
+
+
+def write_dynamics(f, rule, entries):
+    '''
+    writes the dynem.py configuration of rule with the dynamics entries, an iterable of
+    dicts serialized one at a time as they come
+    '''
+    f.write('{\n')
+    for key, value in rule.items():
+        f.write('    %s: %s,\n' % (json.dumps(key), json.dumps(value)))
+    f.write('    "dynamics": [')
+    sep = '\n'
+    for entry in entries:
+        f.write(sep + '        ' + json.dumps(entry))
+        sep = ',\n'
+    f.write('\n    ]\n}\n')
+
+
+def convert(f_in, f_out, direction='uplink', ip='x.x.x.x', start_offset=0, last_duration=0):
+    '''
+    converts the TA trace read from f_in into a dynem.py configuration written to f_out,
+    the dynamics entries only carry the parameters differing from the base ones, returns
+    the number of entries
+    '''
+    segments = iter_segments(iter_sections(f_in), last_duration)
+    base = next(segments)
+    names = [(i, name) for i, name in enumerate(PARAMS)]
+    count = [0]
+
+    def entries():
+        pending = None
+        if start_offset > 0:
+            # the base parameters held a while before the trace starts
+            pending = [to_ms(start_offset), base]
+        for duration, params in segments:
+            if pending is not None and pending[1] == params:
+                pending[0] += duration
+                continue
+            if pending is not None:
+                yield entry(*pending)
+            pending = [duration, params]
+        if pending is not None:
+            yield entry(*pending)
+
+    def entry(duration, params):
+        count[0] += 1
+        e = OrderedDict((name, params[i]) for i, name in names if params[i] != base[i])
+        e['duration'] = seconds(duration)
+        e['interval'] = 0
+        return e
+
+    write_dynamics(f_out, base_rule(base, direction, ip), entries())
+    return count[0]
 
 
 def main():
@@ -68,43 +199,45 @@ def main():
 
     parser.add_argument("PatternFile", help = "Text file containing the TA netwotk specification to simplify.")
 
-    parser.add_argument("-s", "--StartTimeOffsetSec", help = "[OPTIONAL] Insert seconds at start. Useful for aligning audio playout with interesting network changes.")
-
-    parser.add_argument("-d", "--Direction", help = "[OPTIONAL] Specify 'uplink' or 'downlink' drection. Defaults to 'uplink'.")
+    parser.add_argument("-s", "--StartTimeOffsetSec", type = float, default = 0, help = "[OPTIONAL] Insert seconds at start. Useful for aligning audio playout with interesting network changes.")
 
-    parser.add_argument("-i", "--ip", help = "[OPTIONAL] The source IP to write to JSON output. Defaults to 'x.x.x.x'.")
+    parser.add_argument("-d", "--Direction", choices = ['uplink', 'downlink'], default = 'uplink', help = "[OPTIONAL] Specify 'uplink' or 'downlink' drection. Defaults to 'uplink'.")
 
-    args = parser.parse_args()
+    parser.add_argument("-i", "--ip", default = 'x.x.x.x', help = "[OPTIONAL] The source IP to write to JSON output. Defaults to 'x.x.x.x'.")
 
-    prefix = args.PatternFile.removesuffix('.txt')
-    prefix = prefix.removesuffix('_simplified_trace')
+    parser.add_argument("-l", "--LastDurationSec", type = float, default = 0, help = "[OPTIONAL] Hold the parameters of the last section this many seconds, by default it only marks the end of the trace.")
 
-    with open(args.PatternFile, 'r') as f:
-        lines = f.readlines()
-        assert len(lines) == 1
+    parser.add_argument("-o", "--output", help = "[OPTIONAL] Output file. Defaults to the pattern file name with '_dynamic_trace.json' instead of '.txt' or '_simplified_trace.txt'.")
 
-    direction = 'uplink'
-    if (args.Direction):
-        assert(args.Direction == 'uplink' or args.Direction == 'downlink')
-        direction = args.Direction
+    args = parser.parse_args()
 
-    ip = 'x.x.x.x'
-    if (args.ip):
-        octets = args.ip.split('.')
-        assert(len(octets) == 4)
-        ip = args.ip
+    if len(args.ip.split('.')) != 4:
+        parser.error('invalid ip %s' % args.ip)
 
-    fileOut = write_dynamic_format(prefix, lines[0], direction, ip)
+    fileOut = args.output
+    if fileOut is None:
+        prefix = args.PatternFile
+        for suffix in ('.txt', '_simplified_trace'):
+            if prefix.endswith(suffix):
+                prefix = prefix[:-len(suffix)]
+        fileOut = prefix + '_dynamic_trace.json'
 
+    # written next to the output and renamed over it once the whole trace converted, so
+    # an error doesn't leave a truncated configuration
+    tmpOut = '%s.tmp.%d' % (fileOut, os.getpid())
     try:
-        with open(fileOut, 'r') as f:
-            data = json.load(f)
-    except:
-        print('Error: Output file failed JSON parsing.')
+        with open(args.PatternFile, 'r') as f_in:
+            with open(tmpOut, 'w') as f_out:
+                count = convert(f_in, f_out, args.Direction, args.ip, args.StartTimeOffsetSec, args.LastDurationSec)
+        os.rename(tmpOut, fileOut)
+    except (ValueError, EnvironmentError) as e:
+        print('Error: %s' % e)
+        sys.exit(1)
+    finally:
+        if os.path.exists(tmpOut):
+            os.remove(tmpOut)
+    print('%s: %d dynamics entries' % (fileOut, count))
 
 
 if __name__ == "__main__":
     main()
-
-
-
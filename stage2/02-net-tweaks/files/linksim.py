@@ -0,0 +1,555 @@
+#!/usr/bin/python
+'''
+offline simulator of the link a rule of emulator.py builds
+
+Previews what a rule, or the dynamics of a dynem.py configuration or timeline, does
+to a traffic profile without a Pi. A packet goes through the same chain as on the
+emulator, the netem of the rule (loss, then delay and jitter, the delay line
+holding up to 1000 packets) and the htb class at the bandwidth of the rule with its
+bfifo of tb_qsize bytes:
+
+    $ linksim.py --bw 2000 --qdelay 100 --delay 40 --jitter 5 --loss 1 cbr --rate 2500
+    $ linksim.py -f unstable-wifi.cfg --series wifi.csv tcp --duration 120
+    $ linksim.py -f verizon.tl -o call.npz pcap call.pcapng
+
+Packets are simulated in NumPy batches. The backlog of the htb token bucket and the
+bfifo, less the tokens, follows a Lindley recursion, solved in closed form with prefix
+sums and a running max as long as the bfifo doesn't drop. While it does, packets go
+one at a time until the queue gets quiet again, so the tail drop stays exact for any
+mix of packet sizes. The jitter reorders packets like netem does.
+
+The result is the delay or the drop cause of every packet and the offered and
+delivered throughput per --bin, printed as a summary and written with --output
+(npz of the per-packet arrays) and --series (csv of the throughput). Needs numpy.
+'''
+import argparse
+import heapq
+import sys
+import time
+import numpy as np
+import dynem
+import emulator as em
+import pcapstream
+import slsgen
+import timeline as tl
+
+# the burst tc gives an htb class without one, rate / HZ + mtu
+HZ = 1000
+MTU = 1600
+# packets the delay line of a netem holds when no limit is given
+NETEM_LIMIT = 1000
+
+# packets per batch of the sources
+CHUNK = 1 << 18
+# packets the htb queue is solved for at a time, and how many in a row have to get in
+# the bfifo after a drop for the queue to be solved in closed form again
+SCAN_WINDOW = 1 << 14
+QUIET = 256
+
+DELIVERED = 0
+NETEM_LOSS = 1
+NETEM_LIMIT_DROP = 2
+BFIFO_DROP = 3
+CAUSES = ('delivered', 'netem loss', 'netem limit', 'bfifo drop')
+
+def lindley(x0, c, lo):
+    '''
+    x[i] = max(x[i - 1] + c[i], lo[i]) from x[-1] = x0, in closed form as the prefix
+    sums of c plus the running max of where the lower bound last held
+    '''
+    C = np.cumsum(c)
+    return C + np.maximum(x0, np.maximum.accumulate(lo - C))
+
+class Schedule(object):
+
+    '''
+    the link parameters over time, a segment per rule, from the offset of its update to
+    the next one. The updates, possibly endless, are consumed as far as the simulation goes
+    '''
+
+    def __init__(self, rule, updates=()):
+        self.updates = iter(updates)
+        self.done = False
+        self.starts = []
+        self.params = []
+        self.losses = []
+        # counts the changes of the netem, a change resets the state of its loss model
+        self.epochs = []
+        self.netem = None
+        self._arrays = None
+        self._append(0, rule)
+
+    def _append(self, start, rule):
+        rate = max(rule.bw, 1) * 1000 / 8.0
+        netem = rule.tc_components()['netem']
+        self.starts.append(start)
+        self.params.append((rate, rate / HZ + MTU, float(int(rule._get_tb_qsize())),
+                            rule.delay / 1000.0, rule.jitter / 1000.0))
+        self.losses.append(netem[0])
+        self.epochs.append((self.epochs[-1] + (netem != self.netem)) if self.epochs else 0)
+        self.netem = netem
+
+    def extend(self, t):
+        '''
+        takes the updates up to time t in seconds
+        '''
+        while not self.done and self.starts[-1] <= t:
+            try:
+                offset, rule = next(self.updates)
+            except StopIteration:
+                self.done = True
+                break
+            self._append(offset / 1000.0, rule)
+
+    def arrays(self):
+        if self._arrays is None or len(self._arrays[0]) != len(self.starts):
+            params = np.array(self.params, dtype=float).reshape(-1, 5)
+            self._arrays = (np.array(self.starts, dtype=float),) + tuple(params.T)
+        return self._arrays
+
+    def lookup(self, times):
+        '''
+        segment of each time, times sorted
+        '''
+        if len(times):
+            self.extend(times[-1])
+        return np.searchsorted(self.arrays()[0], times, 'right') - 1
+
+class Link(object):
+
+    '''
+    the netem, htb class and bfifo of a rule, simulated a batch of packets at a time.
+    push() returns (index, delay, cause) of the packets whose fate got decided, the index
+    counting the packets pushed so far, a packet still in the delay line comes out of a
+    later push() or of flush()
+    '''
+
+    def __init__(self, schedule, seed=None, netem_limit=NETEM_LIMIT, sls_dir=slsgen.SLS_DIR):
+        self.schedule = schedule
+        self.rng = np.random.RandomState(seed)
+        self.netem_limit = netem_limit
+        self.sls_dir = sls_dir
+        self.patterns = {}
+        self.count = 0
+        # loss model state, the epoch of the netem it belongs to
+        self.epoch = None
+        self.bad = False
+        self.sls_pos = 0
+        # exit times of the packets in the delay line
+        self.inflight = np.empty(0)
+        # (netem exit, size, index, arrival) of the packets not yet at the htb
+        self.pending = (np.empty(0), np.empty(0), np.empty(0, dtype=np.int64), np.empty(0))
+        # backlog less the tokens of the htb class in bytes, time of the last packet
+        self.x = None
+        self.last = 0.0
+
+    def _pattern(self, name):
+        if name not in self.patterns:
+            self.patterns[name] = slsgen.read_pattern(name, self.sls_dir)
+        return self.patterns[name]
+
+    def _lose(self, seg):
+        '''
+        netem loss of packets in segments seg
+        '''
+        lost = np.zeros(len(seg), dtype=bool)
+        losses = self.schedule.losses
+        epochs = self.schedule.epochs
+        bounds = np.flatnonzero(np.diff(seg)) + 1
+        for a, b in zip(np.r_[0, bounds], np.r_[bounds, len(seg)]):
+            loss = losses[seg[a]]
+            if epochs[seg[a]] != self.epoch:
+                self.epoch = epochs[seg[a]]
+                self.bad = False
+                self.sls_pos = 0
+            if loss[0] == 'random':
+                if loss[1] > 0:
+                    lost[a:b] = self.rng.random_sample(b - a) * 100 < loss[1]
+            elif loss[0] == 'gemodel':
+                lost[a:b], self.bad = slsgen.ge_states(self.rng, b - a, loss[1] / 100.0, loss[2] / 100.0, self.bad)
+            else:
+                pattern = self._pattern(loss[1])
+                lost[a:b] = pattern[(self.sls_pos + np.arange(b - a)) % len(pattern)]
+                self.sls_pos = (self.sls_pos + b - a) % len(pattern)
+        return lost
+
+    def _congested(self, pos, x, s, drain, burst, limit, out, dropped):
+        '''
+        packets from pos one at a time while the bfifo drops, until QUIET packets in a row
+        get in, returns where it stopped and the backlog there
+        '''
+        start = pos
+        quiet = 0
+        while pos < len(s) and quiet < QUIET:
+            end = min(len(s), pos + SCAN_WINDOW)
+            xs = []
+            append = xs.append
+            for si, di, bi, li in zip(s[pos:end].tolist(), drain[pos:end].tolist(),
+                                      burst[pos:end].tolist(), limit[pos:end].tolist()):
+                x -= di
+                if x < -bi:
+                    x = -bi
+                if x + si > li:
+                    quiet = 0
+                else:
+                    x += si
+                    quiet += 1
+                    if quiet >= QUIET:
+                        append(x)
+                        break
+                append(x)
+            out[pos:pos + len(xs)] = xs
+            pos += len(xs)
+        # the same arithmetic as the loop, so the drops come out the same
+        before = out[start - 1:pos - 1] if start else np.r_[self.x, out[:pos - 1]]
+        dropped[start:pos] = (np.maximum(before - drain[start:pos], -burst[start:pos]) +
+                              s[start:pos] > limit[start:pos])
+        return pos, x
+
+    def _netem_limit(self, t, d):
+        '''
+        packets dropped for finding the delay line full, in closed form while it never
+        fills up, one at a time from the first packet it would be full for
+        '''
+        occupancy = (np.arange(len(t)) - np.searchsorted(np.sort(d), t, 'right') +
+                     len(self.inflight) - np.searchsorted(self.inflight, t, 'right'))
+        over = np.zeros(len(t), dtype=bool)
+        full = occupancy >= self.netem_limit
+        if not full.any():
+            return over
+        k = int(np.argmax(full))
+        heap = [v for v in np.r_[self.inflight, d[:k]].tolist() if v > t[k]]
+        heapq.heapify(heap)
+        for j, (tj, dj) in enumerate(zip(t[k:].tolist(), d[k:].tolist()), k):
+            while heap and heap[0] <= tj:
+                heapq.heappop(heap)
+            if len(heap) >= self.netem_limit:
+                over[j] = True
+            else:
+                heapq.heappush(heap, dj)
+        return over
+
+    def _shape(self, d, s, idx, t):
+        '''
+        the htb class and bfifo, packets in the order they leave the netem
+        '''
+        _, rate, burst, limit, _, _ = (a[self.schedule.lookup(d)] for a in self.schedule.arrays())
+        if self.x is None:
+            # the bucket starts full
+            self.x, self.last = -burst[0], d[0]
+        # a flush lets packets on before later ones leave the netem, which then queue behind them
+        d = np.maximum(d, self.last)
+        drain = rate * np.diff(d, prepend=self.last)
+        n = len(d)
+        out = np.empty(n)
+        dropped = np.zeros(n, dtype=bool)
+        pos, x = 0, self.x
+        while pos < n:
+            # exact up to the first drop of the window, the rest of it is done again
+            end = min(n, pos + SCAN_WINDOW)
+            xs = lindley(x, s[pos:end] - drain[pos:end], s[pos:end] - burst[pos:end])
+            before = np.r_[x, xs[:-1]]
+            over = np.maximum(before - drain[pos:end], -burst[pos:end]) + s[pos:end] > limit[pos:end]
+            k = int(np.argmax(over)) if over.any() else end - pos
+            out[pos:pos + k] = xs[:k]
+            if k:
+                x = xs[k - 1]
+            pos += k
+            if pos < end:
+                pos, x = self._congested(pos, x, s, drain, burst, limit, out, dropped)
+        self.x, self.last = x, d[-1]
+        delay = np.where(dropped, np.nan, d + np.maximum(out, 0) / rate - t)
+        return idx, delay, np.where(dropped, BFIFO_DROP, DELIVERED)
+
+    def push(self, times, sizes, flush=False):
+        '''
+        simulates packets arriving at times in seconds, sorted, of sizes in bytes
+        '''
+        times = np.asarray(times, dtype=float)
+        sizes = np.asarray(sizes, dtype=float)
+        idx = np.arange(self.count, self.count + len(times), dtype=np.int64)
+        self.count += len(times)
+        parts = []
+        if len(times):
+            seg = self.schedule.lookup(times)
+            lost = self._lose(seg)
+            parts.append((idx[lost], np.full(lost.sum(), np.nan), np.full(lost.sum(), NETEM_LOSS)))
+
+            kept = ~lost
+            t, s, i, seg = times[kept], sizes[kept], idx[kept], seg[kept]
+            _, _, _, _, delay, jitter = (a[seg] for a in self.schedule.arrays())
+            d = t + delay
+            if jitter.any():
+                d += jitter * self.rng.uniform(-1, 1, len(t))
+            d = np.maximum(d, t)
+            over = self._netem_limit(t, d)
+            parts.append((i[over], np.full(over.sum(), np.nan), np.full(over.sum(), NETEM_LIMIT_DROP)))
+            inflight = np.concatenate([self.inflight, d[~over]])
+            self.inflight = np.sort(inflight[inflight > times[-1]])
+
+            under = ~over
+            pending = tuple(np.concatenate([p, a[under]]) for p, a in zip(self.pending, (d, s, i, t)))
+        else:
+            pending = self.pending
+
+        # packets arriving later leave the netem after times[-1], the ones before can go on
+        order = np.argsort(pending[0], kind='mergesort')
+        pending = tuple(a[order] for a in pending)
+        cut = len(order) if flush or not len(times) else np.searchsorted(pending[0], times[-1], 'right')
+        if cut:
+            parts.append(self._shape(*(a[:cut] for a in pending)))
+        self.pending = tuple(a[cut:] for a in pending)
+        return tuple(np.concatenate(a) for a in zip(*parts)) if parts else (
+            np.empty(0, dtype=np.int64), np.empty(0), np.empty(0, dtype=np.int64))
+
+    def flush(self):
+        return self.push((), (), flush=True)
+
+class Results(object):
+
+    '''
+    per-packet arrival, size, delay (nan when dropped) and drop cause of a simulation
+    '''
+
+    def __init__(self):
+        self.offered = []
+        self.parts = []
+
+    def add(self, times, sizes, part):
+        self.offered.append((np.asarray(times, dtype=float), np.asarray(sizes, dtype=float)))
+        self.parts.append(part)
+
+    def finish(self):
+        n = sum(len(t) for t, _ in self.offered)
+        self.arrival = np.concatenate([t for t, _ in self.offered]) if n else np.empty(0)
+        self.size = np.concatenate([s for _, s in self.offered]) if n else np.empty(0)
+        self.delay = np.full(n, np.nan)
+        self.cause = np.zeros(n, dtype=np.int8)
+        for idx, delay, cause in self.parts:
+            self.delay[idx] = delay
+            self.cause[idx] = cause
+        self.offered = self.parts = None
+        return self
+
+    def series(self, bin_s):
+        '''
+        (bin start, offered kbit/s, delivered kbit/s, drops, mean delay ms) per bin of bin_s,
+        delivered by the time packets leave the link
+        '''
+        end = np.nanmax(self.arrival + self.delay) if np.isfinite(self.delay).any() else 0
+        bins = int(max(end, self.arrival[-1] if len(self.arrival) else 0) // bin_s) + 1
+        ok = self.cause == DELIVERED
+        out_bin = ((self.arrival[ok] + self.delay[ok]) // bin_s).astype(np.int64)
+        in_bin = (self.arrival // bin_s).astype(np.int64)
+        scale = 8 / 1000.0 / bin_s
+        offered = np.bincount(in_bin, self.size, bins) * scale
+        delivered = np.bincount(out_bin, self.size[ok], bins) * scale
+        drops = np.bincount(in_bin[~ok], minlength=bins)
+        delay_sum = np.bincount(out_bin, self.delay[ok], bins)
+        count = np.bincount(out_bin, minlength=bins)
+        mean_delay = np.where(count > 0, delay_sum * 1000 / np.maximum(count, 1), np.nan)
+        return np.arange(bins) * bin_s, offered, delivered, drops, mean_delay
+
+    def summary(self):
+        n = len(self.arrival)
+        lines = ['packets %d' % n]
+        for code, name in enumerate(CAUSES):
+            count = int((self.cause == code).sum())
+            lines.append('  %-12s %10d %7.2f%%' % (name, count, 100.0 * count / n if n else 0))
+        ok = self.cause == DELIVERED
+        if ok.any():
+            d = self.delay[ok] * 1000
+            lines.append('delay ms     p50 %.1f  p95 %.1f  p99 %.1f  max %.1f' % (
+                np.percentile(d, 50), np.percentile(d, 95), np.percentile(d, 99), d.max()))
+            span = max(self.arrival[-1] - self.arrival[0], 1e-9)
+            out_span = max((self.arrival[ok] + self.delay[ok]).max() - self.arrival[0], 1e-9)
+            lines.append('throughput   offered %.1f kbit/s  delivered %.1f kbit/s' % (
+                self.size.sum() * 8 / 1000.0 / span, self.size[ok].sum() * 8 / 1000.0 / out_span))
+        return '\n'.join(lines)
+
+def cbr(rate, size, duration):
+    '''
+    batches of (times, sizes) of a constant bit rate source, rate in kbit/s
+    '''
+    gap = size * 8.0 / (rate * 1000)
+    n = int(duration / gap)
+    for a in range(0, n, CHUNK):
+        m = min(CHUNK, n - a)
+        yield (a + np.arange(m)) * gap, np.full(m, size)
+
+def bursty(rate, size, duration, burst, line_rate, rng):
+    '''
+    bursts of burst packets back to back at line_rate, starting at exponential intervals
+    so the mean is rate, both rates in kbit/s
+    '''
+    mean_gap = burst * size * 8.0 / (rate * 1000)
+    spacing = np.arange(burst) * size * 8.0 / (line_rate * 1000)
+    start = 0.0
+    while start < duration:
+        starts = start + np.cumsum(rng.exponential(mean_gap, max(1, CHUNK // burst)))
+        start = starts[-1]
+        times = (starts[:, None] + spacing).ravel()
+        times = np.maximum.accumulate(times[times < duration])
+        if len(times):
+            yield times, np.full(len(times), size)
+
+def pcap(path):
+    '''
+    batches of the packets of a capture, times from its first packet
+    '''
+    first = None
+    times, sizes = [], []
+    for ts, length, _, _ in pcapstream.iter_packets(path):
+        if first is None:
+            first = ts
+        times.append(ts - first)
+        sizes.append(length)
+        if len(times) == CHUNK:
+            yield np.array(times), np.array(sizes)
+            times, sizes = [], []
+    if times:
+        yield np.array(times), np.array(sizes)
+
+def simulate(link, batches):
+    results = Results()
+    last = 0.0
+    for times, sizes in batches:
+        # captures can be slightly out of order
+        times = np.maximum.accumulate(np.maximum(times, last))
+        last = times[-1]
+        results.add(times, sizes, link.push(times, sizes))
+    results.parts.append(link.flush())
+    return results.finish()
+
+def simulate_tcp(link, duration, mss, rtt):
+    '''
+    a Reno-like flow, a round of cwnd packets paced over the last round trip, a round
+    with a loss halves cwnd, one without grows it, doubling up to ssthresh. Rounds are
+    flushed through the link so the next one knows of their losses, rtt is the return
+    path added to the delay through the link
+    '''
+    results = Results()
+    cwnd, ssthresh = 1.0, float('inf')
+    srtt = rtt + 1e-3
+    t = 0.0
+    while t < duration:
+        n = int(cwnd)
+        times = t + np.arange(n) * (srtt / n)
+        sizes = np.full(n, mss)
+        idx, delay, cause = [np.concatenate(a) for a in zip(link.push(times, sizes), link.flush())]
+        results.add(times, sizes, (idx, delay, cause))
+        ok = cause == DELIVERED
+        if ok.any():
+            srtt = np.nanmax(delay) + rtt
+        if not ok.any():
+            # retransmission timeout
+            ssthresh, cwnd = max(cwnd / 2, 2.0), 1.0
+            t += max(0.2, 2 * srtt)
+            continue
+        if not ok.all():
+            ssthresh = cwnd = max(cwnd / 2, 1.0)
+        elif cwnd < ssthresh:
+            cwnd = min(cwnd * 2, ssthresh) if ssthresh != float('inf') else cwnd * 2
+        else:
+            cwnd += 1
+        t += max(srtt, (n - 1) * (srtt / n) + 1e-6)
+    return results.finish()
+
+def load_schedule(args):
+    '''
+    the schedule of -f, a configuration with or without dynamics or a timeline, or of
+    the rule options
+    '''
+    if args.cfg is None:
+        f = em.Filter('uplink', '0.0.0.0')
+        return Schedule(em.Rule(f, args.bw, args.loss, args.qdelay, args.jitter, args.delay,
+                                'uplink', args.burst, args.sls))
+    if tl.is_timeline(args.cfg):
+        timeline = dynem.MappedTimeline(tl.TimelineFile(args.cfg))
+    else:
+        config = dynem.parse_config(args.cfg)
+        if not dynem.validate_rule(config):
+            return None
+        if not config.get('dynamics') and not config.get('generators'):
+            return Schedule(dynem.base_rule(config))
+        if not dynem.validate_config(config):
+            return None
+        timeline = dynem.make_timeline(config)
+    return Schedule(timeline.rule, timeline.updates())
+
+def write_series(path, series):
+    with open(path, 'w') as f:
+        f.write('time,offered_kbps,delivered_kbps,drops,delay_ms\n')
+        for row in zip(*series):
+            f.write('%.3f,%.1f,%.1f,%d,%.2f\n' % row)
+
+def main():
+    arg_parser = argparse.ArgumentParser()
+    arg_parser.add_argument('--cfg', '-f', help='dynem.py configuration or timeline to simulate instead of a rule')
+    arg_parser.add_argument('--bw', type=int, help='bandwidth in kbit', default=em.RULE_DEFAULTS['bw'])
+    arg_parser.add_argument('--loss', type=float, help='loss ratio in percentage', default=em.RULE_DEFAULTS['loss'])
+    arg_parser.add_argument('--qdelay', type=int, help='maxinum queuing delay in ms', default=em.RULE_DEFAULTS['qdelay'])
+    arg_parser.add_argument('--delay', type=int, help='delay in ms', default=em.RULE_DEFAULTS['delay'])
+    arg_parser.add_argument('--jitter', type=int, help='jitter in ms', default=em.RULE_DEFAULTS['jitter'])
+    arg_parser.add_argument('--burst', type=float, help='mean loss burst length in packets')
+    arg_parser.add_argument('--sls', help='loss pattern name in --sls-dir')
+    arg_parser.add_argument('--sls-dir', help='directory of the loss patterns', default=slsgen.SLS_DIR)
+    arg_parser.add_argument('--seed', type=int, help='seed of the random losses and jitter')
+    arg_parser.add_argument('--bin', type=float, help='seconds per bin of the throughput series', default=0.1)
+    arg_parser.add_argument('--output', '-o', help='npz file for the per-packet arrays and the series')
+    arg_parser.add_argument('--series', '-s', help='csv file for the throughput series')
+
+    subparsers = arg_parser.add_subparsers(dest='source', help='traffic source')
+    subparsers.required = True
+    for name, help_text in (('cbr', 'constant bit rate'), ('bursty', 'bursts at exponential intervals'),
+                            ('tcp', 'a Reno-like flow')):
+        sub = subparsers.add_parser(name, help=help_text)
+        sub.add_argument('--duration', '-d', type=float, help='seconds', default=60)
+        sub.add_argument('--size', type=int, help='packet size in bytes', default=1500)
+        if name != 'tcp':
+            sub.add_argument('--rate', '-r', type=float, help='mean rate in kbit/s', default=1000)
+        if name == 'bursty':
+            sub.add_argument('--burst-packets', type=int, help='packets per burst', default=10)
+            sub.add_argument('--line-rate', type=float, help='rate within a burst in kbit/s', default=1000000)
+        if name == 'tcp':
+            sub.add_argument('--rtt', type=float, help='return path delay in ms', default=10)
+    sub = subparsers.add_parser('pcap', help='timestamps and sizes of a pcap or pcapng capture')
+    sub.add_argument('capture')
+    args = arg_parser.parse_args()
+
+    schedule = load_schedule(args)
+    if schedule is None:
+        print('invalid configure %s' % args.cfg)
+        sys.exit(1)
+    link = Link(schedule, seed=args.seed, sls_dir=args.sls_dir)
+
+    start = time.time()
+    try:
+        if args.source == 'cbr':
+            results = simulate(link, cbr(args.rate, args.size, args.duration))
+        elif args.source == 'bursty':
+            results = simulate(link, bursty(args.rate, args.size, args.duration, args.burst_packets,
+                                            args.line_rate, np.random.RandomState(args.seed)))
+        elif args.source == 'tcp':
+            results = simulate_tcp(link, args.duration, args.size, args.rtt / 1000.0)
+        else:
+            results = simulate(link, pcap(args.capture))
+    except (IOError, ValueError) as e:
+        print('error, %s' % e)
+        sys.exit(1)
+    elapsed = time.time() - start
+
+    print(results.summary())
+    print('simulated %d packets in %.2f seconds, %.0f packets/s' % (
+        len(results.arrival), elapsed, len(results.arrival) / max(elapsed, 1e-9)))
+
+    series = results.series(args.bin)
+    if args.series:
+        write_series(args.series, series)
+    if args.output:
+        np.savez_compressed(args.output, arrival=results.arrival, size=results.size, delay=results.delay,
+                            cause=results.cause, series_time=series[0], series_offered=series[1],
+                            series_delivered=series[2], series_drops=series[3], series_delay=series[4])
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,274 @@
+#!/usr/bin/python
+'''
+imports a Mahimahi-style delivery trace as a dynem.py timeline
+
+A Mahimahi trace has one line per packet delivery opportunity, the millisecond it
+happens at, a line repeated for several packets in the same millisecond. The
+deliveries are counted per bin of the shortest update period, turned into a rate
+averaged over a sliding window centered on each bin, and held for an update period
+at a time. Each candidate period is scored by its throughput error, the gap between
+the held rates and the windowed ones relative to the windowed throughput, and the
+coarsest period within --max-error is written as a timeline:
+
+    $ mahimahi.py Verizon-LTE-driving.down verizon.tl --ip 192.168.1.5 --direction downlink
+    period ms   updates/s   error %   mean kbit/s
+           10       72.94      0.00       26442.3
+           ...
+          100        8.36      4.27       26442.3  <-
+    $ sudo dynem.py -f verizon.tl
+
+The trace is read twice, once to score the periods and once to write the timeline,
+and only a window of bins is kept in memory, so traces of any length can be imported.
+'''
+import argparse
+import json
+import sys
+from collections import deque
+import timeline as tl
+
+PERIODS = (10, 20, 50, 100, 200, 500, 1000, 2000, 5000)
+PACKET_SIZE = 1500
+# htb needs a rate, an outage is emulated with the lowest one
+MIN_BW = 1
+
+def iter_counts(path, bin_ms):
+    '''
+    deliveries per bin of bin_ms milliseconds, read a line at a time
+    '''
+    with open(path, 'r') as f:
+        current, count = 0, 0
+        for lineno, line in enumerate(f, 1):
+            line = line.strip()
+            if not line or line.startswith('#'):
+                continue
+            try:
+                b = int(line) // bin_ms
+            except ValueError:
+                raise ValueError('line %d: invalid timestamp "%s"' % (lineno, line))
+            if b < current:
+                raise ValueError('line %d: timestamp %s goes back in time' % (lineno, line))
+            while current < b:
+                yield count
+                count = 0
+                current += 1
+            count += 1
+        yield count
+
+def smooth(values, half):
+    '''
+    averages of values over a window of half values on each side, the window is cut at
+    the ends of the trace
+    '''
+    buf = deque()
+    total = 0.0
+    n = 0
+    for v in values:
+        buf.append(v)
+        total += v
+        n += 1
+        if len(buf) > 2 * half + 1:
+            total -= buf.popleft()
+        if n - 1 - half >= 0:
+            yield total / len(buf)
+    for center in range(max(0, n - half), n):
+        while len(buf) > n - center + half:
+            total -= buf.popleft()
+        yield total / len(buf)
+
+def iter_rates(path, bin_ms, window_ms, packet_size):
+    '''
+    rate in kbit/s of each bin, averaged over the sliding window
+    '''
+    kbit_per_delivery = packet_size * 8.0 / bin_ms
+    half = max(0, int(window_ms // bin_ms) // 2)
+    for avg in smooth(iter_counts(path, bin_ms), half):
+        yield avg * kbit_per_delivery
+
+class Candidate(object):
+
+    '''
+    holds the rate of a period of `bins` bins, the mean of the windowed rates over it,
+    and scores how far the held rates are from them
+    '''
+
+    def __init__(self, bins):
+        self.bins = bins
+        self.block = []
+        self.error = 0.0
+        self.total = 0.0
+        self.count = 0
+        self.updates = 0
+        self.last = None
+
+    def add(self, rate):
+        '''
+        returns the rate held for the period which ends with this bin, None otherwise
+        '''
+        self.block.append(rate)
+        if len(self.block) == self.bins:
+            return self.flush()
+        return None
+
+    def flush(self):
+        if not self.block:
+            return None
+        held = max(MIN_BW, int(round(sum(self.block) / len(self.block))))
+        self.error += sum(abs(held - r) for r in self.block)
+        self.total += sum(self.block)
+        self.count += len(self.block)
+        if held != self.last:
+            self.updates += 1
+            self.last = held
+        self.block = []
+        return held
+
+    def relative_error(self):
+        return self.error / self.total if self.total else 0.0
+
+def score(path, periods, window_ms, packet_size):
+    '''
+    one pass over the trace scoring all periods, [(period, Candidate)]
+    '''
+    bin_ms = periods[0]
+    candidates = [(p, Candidate(p // bin_ms)) for p in periods]
+    for rate in iter_rates(path, bin_ms, window_ms, packet_size):
+        for _, c in candidates:
+            c.add(rate)
+    for _, c in candidates:
+        c.flush()
+    return candidates
+
+def choose(candidates, max_error):
+    '''
+    the coarsest period within max_error %, the finest one if none is
+    '''
+    within = [p for p, c in candidates if c.relative_error() * 100 <= max_error]
+    return max(within) if within else candidates[0][0]
+
+def write_timeline(path, out, period, bin_ms, window_ms, packet_size, rule):
+    '''
+    second pass over the trace writing the held rates of period as timeline records,
+    a record only where the rate changes, returns the number of records
+    '''
+    c = Candidate(period // bin_ms)
+    params = dict((k, rule.get(k, v)) for k, v in tl.DEFAULTS.items())
+    writer = None
+    last = None
+    offset = 0
+    bins = 0
+    try:
+        for rate in iter_rates(path, bin_ms, window_ms, packet_size):
+            bins += 1
+            held = c.add(rate)
+            if held is None:
+                continue
+            if writer is None:
+                writer = tl.TimelineWriter(out, dict(rule, bw=held))
+            if held != last:
+                params['bw'] = last = held
+                writer.add(offset, params)
+            offset = bins * bin_ms
+        held = c.flush()
+        if held is not None:
+            if writer is None:
+                writer = tl.TimelineWriter(out, dict(rule, bw=held))
+            if held != last:
+                params['bw'] = held
+                writer.add(offset, params)
+        if writer is None:
+            raise ValueError('empty trace')
+        writer.close(bins * bin_ms)
+    finally:
+        if writer is not None:
+            writer.discard()
+    return writer.count
+
+def report(candidates, chosen, duration_ms):
+    lines = ['%9s %11s %9s %13s' % ('period ms', 'updates/s', 'error %', 'mean kbit/s')]
+    for p, c in candidates:
+        lines.append('%9d %11.2f %9.2f %13.1f%s' % (
+            p, c.updates * 1000.0 / duration_ms if duration_ms else 0, c.relative_error() * 100,
+            c.total / c.count if c.count else 0, '  <-' if p == chosen else ''))
+    return '\n'.join(lines)
+
+def main():
+    arg_parser = argparse.ArgumentParser()
+    arg_parser.add_argument('trace', help='mahimahi trace, one line per delivery opportunity with its millisecond')
+    arg_parser.add_argument('timeline', help='timeline file to write')
+    arg_parser.add_argument('--ip', '-f', required=True, help='src(uplink) or dst(downlink) ip filter')
+    arg_parser.add_argument('--direction', '-c', choices=['uplink', 'downlink'], required=True)
+    arg_parser.add_argument('--window', '-w',
+        type=int,
+        help='sliding window the rates are averaged over in ms',
+        default=100
+    )
+    arg_parser.add_argument('--max-error', '-e',
+        type=float,
+        help='throughput error in percentage the chosen update period stays within',
+        default=5
+    )
+    arg_parser.add_argument('--periods',
+        type=int,
+        nargs='+',
+        help='candidate update periods in ms, multiples of the shortest one',
+        default=list(PERIODS)
+    )
+    arg_parser.add_argument('--period', '-p',
+        type=int,
+        help='use this update period instead of choosing one, one of --periods'
+    )
+    arg_parser.add_argument('--packet-size', '-s',
+        type=int,
+        help='bytes delivered per opportunity',
+        default=PACKET_SIZE
+    )
+    arg_parser.add_argument('--delay', '-d', type=int, help='delay in ms', default=10)
+    arg_parser.add_argument('--loss', '-l', type=float, help='loss ratio in percentage', default=0)
+    arg_parser.add_argument('--qdelay', '-q', type=int, help='maxinum queuing delay in ms', default=100)
+    arg_parser.add_argument('--report', '-r', help='write the scores of the periods to this json file')
+    args = arg_parser.parse_args()
+
+    periods = sorted(set(args.periods))
+    if any(p <= 0 or p % periods[0] for p in periods):
+        arg_parser.error('the periods must be positive multiples of the shortest one')
+    if args.period is not None and args.period not in periods:
+        arg_parser.error('--period must be one of --periods')
+
+    rule = {
+        'emfilter': {'direction': args.direction, 'ip': args.ip},
+        'delay': args.delay,
+        'loss': args.loss,
+        'qdelay': args.qdelay
+    }
+    try:
+        candidates = score(args.trace, periods, args.window, args.packet_size)
+        duration_ms = candidates[0][1].count * periods[0]
+        chosen = args.period or choose(candidates, args.max_error)
+        print(report(candidates, chosen, duration_ms))
+        if args.period is None and candidates[0][1].relative_error() * 100 > args.max_error:
+            print('no period within %g%% error, use the shortest one' % args.max_error)
+        count = write_timeline(args.trace, args.timeline, chosen, periods[0], args.window, args.packet_size, rule)
+    except (IOError, ValueError) as e:
+        print('error, %s' % e)
+        sys.exit(1)
+    print('%s: %d records, update period %d ms, loop of %.1f seconds' % (
+        args.timeline, count, chosen, duration_ms / 1000.0))
+
+    if args.report:
+        with open(args.report, 'w') as f:
+            json.dump({
+                'trace': args.trace,
+                'window': args.window,
+                'max_error': args.max_error,
+                'chosen': chosen,
+                'duration_ms': duration_ms,
+                'periods': [{
+                    'period': p,
+                    'updates_per_second': c.updates * 1000.0 / duration_ms if duration_ms else 0,
+                    'error': c.relative_error() * 100,
+                    'mean_kbps': c.total / c.count if c.count else 0
+                } for p, c in candidates]
+            }, f, indent=4)
+
+if __name__ == "__main__":
+    main()
@@ -17,7 +17,7 @@ Version: $VERSION
 Section: net
 Priority: optional
 Architecture: all
-Depends: python2.7, hostapd, wpasupplicant
+Depends: python2.7, python-numpy, hostapd, wpasupplicant
 Maintainer: Jeromy Fu<jianfu@cisco.com>
 Description: Pi Network Emulator
  Wrapper of a bunch of tc commands to allow
@@ -38,6 +38,7 @@ chmod +x $BUILD_NAME/DEBIAN/postinst
 mkdir -p $BUILD_NAME/etc/piem
 cp piem-config.json $BUILD_NAME/etc/piem/config.json
 cp unstable-wifi.cfg $BUILD_NAME/etc/piem/unstable-wifi.cfg
+cp random-wifi.cfg $BUILD_NAME/etc/piem/random-wifi.cfg
 
 mkdir -p $BUILD_NAME/etc/network
 cp interfaces.wlan $BUILD_NAME/etc/network/interfaces.wlan
@@ -51,10 +52,22 @@ cp wpa_supplicant.conf $BUILD_NAME/etc/wpa_supplicant/wpa_supplicant.conf
 
 mkdir -p $BUILD_NAME/lib/systemd/system
 cp piem.service $BUILD_NAME/lib/systemd/system/
+cp piemstats.service $BUILD_NAME/lib/systemd/system/
 
 mkdir $BUILD_NAME/sbin
 cp emulator.py $BUILD_NAME/sbin/
+cp rtnl.py $BUILD_NAME/sbin/
+cp piemd.py $BUILD_NAME/sbin/
+cp piemstats.py $BUILD_NAME/sbin/
 cp dynem.py $BUILD_NAME/sbin/
+cp timeline.py $BUILD_NAME/sbin/
+cp mahimahi.py $BUILD_NAME/sbin/
+cp pcaptrace.py $BUILD_NAME/sbin/
+cp pcapstream.py $BUILD_NAME/sbin/
+cp linksim.py $BUILD_NAME/sbin/
+cp slsgen.py $BUILD_NAME/sbin/
+cp dyngen.py $BUILD_NAME/sbin/
+cp blocker.py $BUILD_NAME/sbin/
 cp bridge_switch.sh $BUILD_NAME/sbin/
 cp fw.sh $BUILD_NAME/sbin/
 
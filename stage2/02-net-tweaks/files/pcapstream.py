@@ -0,0 +1,151 @@
+#!/usr/bin/python
+'''
+streams the packets of a pcap or pcapng capture
+
+Only the block being decoded is held in memory, so captures of any size can be
+read. Packets come out as (timestamp in seconds, length on the wire, link type,
+captured bytes), in the order of the file:
+
+    for ts, length, linktype, data in pcapstream.iter_packets('call.pcapng'):
+        ...
+'''
+import struct
+
+PCAP_MAGIC = 0xa1b2c3d4
+PCAP_MAGIC_NS = 0xa1b23c4d
+PCAPNG_SHB = 0x0a0d0d0a
+PCAPNG_BYTE_ORDER = 0x1a2b3c4d
+
+# pcapng block types
+BLOCK_IDB = 1
+BLOCK_PB = 2
+BLOCK_SPB = 3
+BLOCK_EPB = 6
+# pcapng interface option with the resolution of the timestamps
+OPT_ENDOFOPT = 0
+OPT_IF_TSRESOL = 9
+
+# bytes read at a time
+CHUNK_SIZE = 1 << 20
+
+LINKTYPE_ETHERNET = 1
+LINKTYPE_RAW = 101
+LINKTYPE_LINUX_SLL = 113
+LINKTYPE_IPV4 = 228
+
+def _read(f, size):
+    data = f.read(size)
+    if len(data) < size:
+        raise EOFError
+    return data
+
+def _iter_pcap(f, head):
+    magic_le = struct.unpack('<I', head)[0]
+    if magic_le in (PCAP_MAGIC, PCAP_MAGIC_NS):
+        endian = '<'
+    else:
+        endian = '>'
+    magic = struct.unpack(endian + 'I', head)[0]
+    scale = 1e-9 if magic == PCAP_MAGIC_NS else 1e-6
+    _, _, _, _, _, linktype = struct.unpack(endian + 'HHiIII', _read(f, 20))
+    record = struct.Struct(endian + 'IIII')
+    size = record.size
+    # records are sliced out of a buffer read a chunk at a time, two reads per packet
+    # would take longer than decoding it
+    buf, pos = b'', 0
+    while True:
+        if len(buf) - pos < size:
+            buf, pos = buf[pos:] + f.read(CHUNK_SIZE), 0
+            if len(buf) < size:
+                return
+        sec, frac, caplen, length = record.unpack_from(buf, pos)
+        end = pos + size + caplen
+        if end > len(buf):
+            buf, pos = buf[pos:] + f.read(max(CHUNK_SIZE, size + caplen)), 0
+            end = size + caplen
+            if end > len(buf):
+                return
+        yield sec + frac * scale, length, linktype, buf[pos + size:end]
+        pos = end
+
+def _tsresol(options, endian):
+    '''
+    seconds per timestamp unit from the options of an interface description block
+    '''
+    pos = 0
+    while pos + 4 <= len(options):
+        code, size = struct.unpack_from(endian + 'HH', options, pos)
+        if code == OPT_ENDOFOPT:
+            break
+        if code == OPT_IF_TSRESOL and size >= 1:
+            value = struct.unpack_from('B', options, pos + 4)[0]
+            if value & 0x80:
+                return 2.0 ** -(value & 0x7f)
+            return 10.0 ** -value
+        pos += 4 + size + (-size % 4)
+    return 1e-6
+
+def _iter_pcapng(f, head):
+    endian = '<'
+    interfaces = []
+    block_type = struct.unpack('<I', head)[0]
+    last_ts = 0.0
+    while True:
+        try:
+            if head is None:
+                head = _read(f, 4)
+                block_type = struct.unpack(endian + 'I', head)[0]
+            if block_type == PCAPNG_SHB:
+                length_raw = _read(f, 4)
+                order = _read(f, 4)
+                endian = '<' if struct.unpack('<I', order)[0] == PCAPNG_BYTE_ORDER else '>'
+                length = struct.unpack(endian + 'I', length_raw)[0]
+                _read(f, length - 12)
+                # interface ids are per section
+                interfaces = []
+                head = None
+                continue
+            length = struct.unpack(endian + 'I', _read(f, 4))[0]
+            body = _read(f, length - 12)
+            _read(f, 4)
+            head = None
+        except EOFError:
+            return
+
+        if block_type == BLOCK_IDB:
+            linktype = struct.unpack_from(endian + 'H', body, 0)[0]
+            interfaces.append((linktype, _tsresol(body[8:], endian)))
+        elif block_type == BLOCK_EPB:
+            iface, high, low, caplen, wire = struct.unpack_from(endian + 'IIIII', body, 0)
+            linktype, resol = interfaces[iface]
+            last_ts = ((high << 32) | low) * resol
+            yield last_ts, wire, linktype, body[20:20 + caplen]
+        elif block_type == BLOCK_PB:
+            iface, _, high, low, caplen, wire = struct.unpack_from(endian + 'HHIIII', body, 0)
+            linktype, resol = interfaces[iface]
+            last_ts = ((high << 32) | low) * resol
+            yield last_ts, wire, linktype, body[20:20 + caplen]
+        elif block_type == BLOCK_SPB:
+            # no timestamp in a simple packet block, it takes the one of the packet before
+            wire = struct.unpack_from(endian + 'I', body, 0)[0]
+            linktype = interfaces[0][0] if interfaces else LINKTYPE_ETHERNET
+            yield last_ts, wire, linktype, body[4:4 + wire]
+
+def iter_packets(path):
+    '''
+    yields (timestamp in seconds, length on the wire, link type, captured bytes) of each
+    packet of a pcap or pcapng file
+    '''
+    with open(path, 'rb') as f:
+        head = f.read(4)
+        if len(head) < 4:
+            return
+        magic = struct.unpack('<I', head)[0]
+        if magic == PCAPNG_SHB:
+            packets = _iter_pcapng(f, head)
+        elif magic in (PCAP_MAGIC, PCAP_MAGIC_NS) or struct.unpack('>I', head)[0] in (PCAP_MAGIC, PCAP_MAGIC_NS):
+            packets = _iter_pcap(f, head)
+        else:
+            raise ValueError('%s is neither a pcap nor a pcapng capture' % path)
+        for packet in packets:
+            yield packet
@@ -0,0 +1,412 @@
+#!/usr/bin/python
+'''
+derives dynem.py dynamics from a packet capture, to replay the conditions of a real
+call or drive test
+
+The packets of one client are picked from a pcap or pcapng capture the way the filter
+of its rule picks them, the ones from --ip for uplink and to it for downlink, with the
+remote --port, the --protocol and the RTP --ptype when given. Per --window ms:
+
+    bw      the throughput of the packets picked, in kbit/s
+    loss    the RTP packets missing from the sequence numbers of each stream, the late
+            ones counted back when they come
+    delay   --delay plus how much longer than the fastest one so far the RTP packets of
+            a stream took, from their timestamps and the clock rate of the stream
+    jitter  the RFC 3550 interarrival jitter of the RTP streams, the worst one
+
+A window without packets, a pause of the sender, holds the parameters before it, and
+without RTP only the bw changes. The output is a timeline when it ends in .tl, a
+configuration otherwise, with the emfilter of the packets picked:
+
+    $ pcaptrace.py call.pcapng call.tl --ip 192.168.1.5 --direction downlink --ptype 96
+    call.tl: 10 records from 2990 packets, 60.0 seconds
+    $ sudo dynem.py -f call.tl
+
+The capture is streamed once with pcapstream.py, and only the state of each RTP stream
+is kept, so captures of any size are read in bounded memory.
+'''
+import argparse
+import json
+import math
+import socket
+import struct
+import sys
+from collections import OrderedDict
+import pcapstream
+import timeline as tl
+
+WINDOW = 500
+PARAMS = ('bw', 'loss', 'delay', 'jitter', 'qdelay')
+# htb needs a rate
+MIN_BW = 1
+IP_PROTOCOLS = {'tcp': 6, 'udp': 17}
+ETHERTYPE_IP = 0x0800
+ETHERTYPE_VLAN = (0x8100, 0x88a8)
+# payload types of RTCP sharing the port of RTP, RFC 5761
+RTCP_TYPES = frozenset(range(72, 77))
+# clock rates the one of a stream is rounded to, and the seconds it is measured over
+CLOCK_RATES = (8000, 16000, 32000, 44100, 48000, 90000)
+CLOCK_SPAN = 2.0
+# RFC 3550 A.1, packets in sequence before a source is taken for RTP, and the jumps of
+# the sequence number taken for losses and for late packets
+MIN_SEQUENTIAL = 2
+MAX_DROPOUT = 3000
+MAX_MISORDER = 100
+# sources on probation kept at most, some udp which isn't RTP looks like it
+MAX_PROBATION = 1024
+
+ETHERTYPE = struct.Struct('!H')
+# version and header length, total length, fragment offset, protocol
+IPV4 = struct.Struct('!BxH2xHxB')
+# offsets of the source and destination addresses in the header
+SRC_OFFSET = 12
+DST_OFFSET = 16
+PORTS = struct.Struct('!HH')
+RTP = struct.Struct('!BBHII')
+
+def ip_offset(linktype, data):
+    '''
+    offset of the IPv4 header in a packet of the link type, None for other packets
+    '''
+    if linktype == pcapstream.LINKTYPE_ETHERNET:
+        pos = 12
+        ethertype = ETHERTYPE.unpack_from(data, pos)[0]
+        while ethertype in ETHERTYPE_VLAN:
+            pos += 4
+            ethertype = ETHERTYPE.unpack_from(data, pos)[0]
+        return pos + 2 if ethertype == ETHERTYPE_IP else None
+    if linktype == pcapstream.LINKTYPE_LINUX_SLL:
+        return 16 if ETHERTYPE.unpack_from(data, 14)[0] == ETHERTYPE_IP else None
+    if linktype in (pcapstream.LINKTYPE_RAW, pcapstream.LINKTYPE_IPV4):
+        return 0
+    return None
+
+class Picker(object):
+
+    '''
+    picks the packets of an emfilter
+    '''
+
+    def __init__(self, direction, ip, protocol='all', port=None, ptype=None):
+        self.uplink = direction == 'uplink'
+        self.ip = socket.inet_aton(ip)
+        self.addr_offset = SRC_OFFSET if self.uplink else DST_OFFSET
+        self.proto = IP_PROTOCOLS.get(protocol)
+        self.port = port
+        self.ptype = ptype
+
+    def pick(self, linktype, data):
+        '''
+        (ip length, RTP (ssrc, sequence, timestamp) or None) of a packet of the filter,
+        None for the others
+        '''
+        try:
+            pos = ip_offset(linktype, data)
+            if pos is None:
+                return None
+            # most packets are of other addresses, they are left before decoding more
+            if data[pos + self.addr_offset:pos + self.addr_offset + 4] != self.ip:
+                return None
+            ver_ihl, length, frag, proto = IPV4.unpack_from(data, pos)
+            if ver_ihl >> 4 != 4:
+                return None
+            if self.proto is not None and proto != self.proto:
+                return None
+            if proto not in (6, 17) or frag & 0x1fff:
+                # no ports in other protocols and in the fragments after the first
+                if self.port is not None or self.ptype is not None:
+                    return None
+                return length, None
+            pos += (ver_ihl & 0xf) * 4
+            srcport, dstport = PORTS.unpack_from(data, pos)
+            if self.port is not None and (dstport if self.uplink else srcport) != self.port:
+                return None
+            rtp = None
+            if proto == 17 and len(data) >= pos + 8 + RTP.size:
+                b0, b1, seq, ts, ssrc = RTP.unpack_from(data, pos + 8)
+                ptype = b1 & 0x7f
+                if b0 >> 6 == 2 and ptype not in RTCP_TYPES and self.ptype in (None, ptype):
+                    rtp = ssrc, seq, ts
+            if self.ptype is not None and rtp is None:
+                return None
+            return length, rtp
+        except struct.error:
+            return None
+
+class Window(object):
+
+    '''
+    what the packets of a window add up to
+    '''
+
+    def __init__(self):
+        self.packets = 0
+        self.bytes = 0
+        self.expected = 0
+        self.lost = 0
+        self.delay = 0.0
+        self.timed = 0
+        self.jitter = 0.0
+
+    def params(self, prev, delay, window_ms):
+        '''
+        the parameters of the window, the ones it can't tell kept from prev
+        '''
+        params = dict(prev)
+        params['bw'] = max(MIN_BW, int(round(self.bytes * 8.0 / window_ms)))
+        if self.expected:
+            params['loss'] = round(min(100.0, max(0, self.lost) * 100.0 / self.expected), 2)
+        if self.timed:
+            params['delay'] = delay + int(round(self.delay * 1000 / self.timed))
+            params['jitter'] = int(round(self.jitter * 1000))
+        return params
+
+class Stream(object):
+
+    '''
+    sequence and timing of an RTP source, after RFC 3550 A.1 and A.8
+    '''
+
+    def __init__(self, seq, ts, arrival, clock_rate=None):
+        self.max_seq = seq
+        self.probation = MIN_SEQUENTIAL - 1
+        self.clock_rate = clock_rate
+        self.restart(ts, arrival)
+
+    def restart(self, ts, arrival):
+        self.last_ts = ts
+        self.ts = ts
+        self.first = arrival, ts
+        self.clock = self.clock_rate
+        self.transit = None
+        self.min_transit = None
+        self.jitter = 0.0
+
+    def update(self, seq, ts, arrival, window):
+        delta = (seq - self.max_seq) & 0xffff
+        if self.probation:
+            self.probation = self.probation - 1 if delta == 1 else MIN_SEQUENTIAL - 1
+            self.max_seq = seq
+            self.unwrap(ts)
+            return
+        if delta == 0:
+            return
+        if delta >= 0x10000 - MAX_MISORDER:
+            # late, it was counted lost when the packets after it came
+            window.lost -= 1
+            return
+        self.max_seq = seq
+        if delta >= MAX_DROPOUT:
+            # the source started over
+            window.expected += 1
+            self.restart(ts, arrival)
+            return
+        window.expected += delta
+        window.lost += delta - 1
+        self.unwrap(ts)
+        self.time(arrival, window)
+
+    def unwrap(self, ts):
+        self.ts += ((ts - self.last_ts + 0x80000000) & 0xffffffff) - 0x80000000
+        self.last_ts = ts
+
+    def time(self, arrival, window):
+        if self.clock is None:
+            start, start_ts = self.first
+            if arrival - start < CLOCK_SPAN:
+                return
+            rate = max(1.0, (self.ts - start_ts) / (arrival - start))
+            self.clock = min(CLOCK_RATES, key=lambda r: abs(math.log(rate / r)))
+        transit = arrival - float(self.ts) / self.clock
+        if self.transit is not None:
+            self.jitter += (abs(transit - self.transit) - self.jitter) / 16
+        self.transit = transit
+        if self.min_transit is None or transit < self.min_transit:
+            self.min_transit = transit
+        window.delay += transit - self.min_transit
+        window.timed += 1
+        window.jitter = max(window.jitter, self.jitter)
+
+class Trace(object):
+
+    '''
+    the parameters of the windows of a capture, end and packets are set once they
+    have all been read
+    '''
+
+    def __init__(self, path, picker, window_ms, base, clock_rate=None):
+        self.path = path
+        self.picker = picker
+        self.window_ms = window_ms
+        self.base = base
+        self.clock_rate = clock_rate
+        self.packets = 0
+        self.end = 0
+
+    def windows(self):
+        '''
+        yields (offset in ms, parameters) of each window with packets
+        '''
+        streams, probation = {}, {}
+        start = None
+        index = 0
+        count = 0
+        w = Window()
+        params = self.base
+        span = self.window_ms / 1000.0
+        pick = self.picker.pick
+        for ts, _, linktype, data in pcapstream.iter_packets(self.path):
+            picked = pick(linktype, data)
+            if picked is None:
+                continue
+            if start is None:
+                start = ts
+            arrival = ts - start
+            i = int(arrival / span)
+            if i > index:
+                if w.packets:
+                    params = w.params(params, self.base['delay'], self.window_ms)
+                    yield index * self.window_ms, params
+                    w = Window()
+                index = i
+            length, rtp = picked
+            count += 1
+            w.packets += 1
+            w.bytes += length
+            if rtp is None:
+                continue
+            ssrc, seq, rtp_ts = rtp
+            s = streams.get(ssrc)
+            if s is not None:
+                s.update(seq, rtp_ts, arrival, w)
+                continue
+            s = probation.get(ssrc)
+            if s is None:
+                if len(probation) >= MAX_PROBATION:
+                    probation.clear()
+                probation[ssrc] = Stream(seq, rtp_ts, arrival, self.clock_rate)
+                continue
+            s.update(seq, rtp_ts, arrival, w)
+            if not s.probation:
+                streams[ssrc] = probation.pop(ssrc)
+        if start is None:
+            raise ValueError('no packets of the filter in %s' % self.path)
+        if w.packets:
+            params = w.params(params, self.base['delay'], self.window_ms)
+            yield index * self.window_ms, params
+        self.packets = count
+        self.end = (index + 1) * self.window_ms
+
+def iter_changes(windows):
+    '''
+    the windows whose parameters differ from the ones before
+    '''
+    last = None
+    for offset, params in windows:
+        if params != last:
+            yield offset, params
+            last = params
+
+def write_timeline(path, rule, trace):
+    '''
+    returns the number of records
+    '''
+    writer = None
+    try:
+        for offset, params in iter_changes(trace.windows()):
+            if writer is None:
+                writer = tl.TimelineWriter(path, dict(rule, **params))
+            writer.add(offset, dict(params, burst=None))
+        writer.close(trace.end)
+    finally:
+        if writer is not None:
+            writer.discard()
+    return writer.count
+
+def write_config(f, rule, trace):
+    '''
+    writes a dynem.py configuration as the windows are read, its parameters the ones of
+    the first window and a dynamics entry per change, returns the number of entries
+    '''
+    changes = iter_changes(trace.windows())
+    start, base = next(changes)
+    f.write('{\n')
+    for key in PARAMS:
+        f.write('    %s: %s,\n' % (json.dumps(key), json.dumps(base[key])))
+    for key, value in rule.items():
+        f.write('    %s: %s,\n' % (json.dumps(key), json.dumps(value)))
+    f.write('    "dynamics": [\n')
+
+    def entry(params, duration):
+        e = OrderedDict((k, params[k]) for k in PARAMS if params[k] != base[k])
+        e['duration'] = duration / 1000.0
+        e['interval'] = 0
+        return '        ' + json.dumps(e)
+
+    count = 1
+    pending = base
+    for offset, params in changes:
+        f.write(entry(pending, offset - start) + ',\n')
+        count += 1
+        start, pending = offset, params
+    f.write(entry(pending, trace.end - start) + '\n    ]\n}\n')
+    return count
+
+def main():
+    arg_parser = argparse.ArgumentParser()
+    arg_parser.add_argument('capture', help='pcap or pcapng capture')
+    arg_parser.add_argument('output', help='timeline (.tl) or dynem.py configuration to write')
+    arg_parser.add_argument('--ip', '-f', required=True, help='src(uplink) or dst(downlink) ip filter')
+    arg_parser.add_argument('--direction', '-c', choices=['uplink', 'downlink'], required=True)
+    arg_parser.add_argument('--protocol', choices=['all', 'tcp', 'udp'], help='filter by protocol', default='all')
+    arg_parser.add_argument('--port', type=int, help='filter by remote port, needs --protocol tcp or udp')
+    arg_parser.add_argument('--ptype', type=int, help='filter by RTP payload type')
+    arg_parser.add_argument('--window', '-w', type=int, help='ms per window of the parameters', default=WINDOW)
+    arg_parser.add_argument('--clock-rate', type=int, help='RTP clock rate in Hz, measured per stream otherwise')
+    arg_parser.add_argument('--delay', '-d', type=int, help='delay in ms the measured one adds to', default=10)
+    arg_parser.add_argument('--loss', '-l', type=float, help='loss ratio in percentage without RTP', default=0)
+    arg_parser.add_argument('--qdelay', '-q', type=int, help='maxinum queuing delay in ms', default=100)
+    args = arg_parser.parse_args()
+
+    if args.ptype is not None:
+        if args.protocol == 'tcp':
+            arg_parser.error('--ptype is RTP over udp')
+        args.protocol = 'udp'
+    if args.port is not None and args.protocol == 'all':
+        arg_parser.error('--port needs --protocol tcp or udp')
+    if args.window <= 0:
+        arg_parser.error('--window must be positive')
+    try:
+        picker = Picker(args.direction, args.ip, args.protocol, args.port, args.ptype)
+    except socket.error:
+        arg_parser.error('invalid ip %s' % args.ip)
+
+    rule = OrderedDict([
+        ('emfilter', OrderedDict([
+            ('direction', args.direction),
+            ('ip', args.ip),
+            ('protocol', args.protocol),
+            ('srcport', args.port if args.direction == 'downlink' else None),
+            ('dstport', args.port if args.direction == 'uplink' else None),
+            ('ptype', args.ptype),
+            ('tos', None)
+        ])),
+        ('sls', None)
+    ])
+    base = {'bw': tl.DEFAULTS['bw'], 'loss': args.loss, 'delay': args.delay, 'jitter': 0, 'qdelay': args.qdelay}
+    trace = Trace(args.capture, picker, args.window, base, args.clock_rate)
+    try:
+        if args.output.endswith('.tl'):
+            count = write_timeline(args.output, rule, trace)
+        else:
+            with open(args.output, 'w') as f:
+                count = write_config(f, rule, trace)
+    except (IOError, ValueError) as e:
+        print('error, %s' % e)
+        sys.exit(1)
+    print('%s: %d %s from %d packets, %.1f seconds' % (
+        args.output, count, 'records' if args.output.endswith('.tl') else 'dynamics entries',
+        trace.packets, trace.end / 1000.0))
+
+if __name__ == "__main__":
+    main()
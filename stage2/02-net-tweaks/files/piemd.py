@@ -0,0 +1,120 @@
+#!/usr/bin/python
+'''
+piem daemon, started by piem.service
+
+Keeps config, rules and handles of emulator.py in memory and serves the
+init/uninit/list/latency/add/change/remove/apply/txn subcommands over a UNIX socket, so neither
+the CLI nor dynem.py reload and re-parse the state files for each command.
+"config" makes it read config.json again after the CLI saved it. The socket is
+only open to root and the group of the daemon, as its commands run tc as root.
+Requests are served one at a time, so all the controllers share one
+consistent view of the rules.
+
+Protocol, one json object per line in both directions:
+
+    {"cmd": "change", "rules": [{"emfilter": {...}, "direction": "uplink", "bw": 500, ...}]}
+    {"ok": true, "output": "what emulator.py would have printed"}
+
+A transaction carries its operations instead of rules:
+
+    {"cmd": "txn", "ops": [{"op": "change", "emfilter": {...}, "bw": 500}, ...]}
+'''
+import argparse
+import json
+import os
+import signal
+import sys
+import threading
+import emulator as em
+
+try:
+    import socketserver
+except ImportError:
+    import SocketServer as socketserver
+
+try:
+    from StringIO import StringIO
+except ImportError:
+    from io import StringIO
+
+gLock = threading.Lock()
+# the socket is created 0660
+SOCKET_UMASK = 0o117
+
+def serve(request):
+    cmd = request.get('cmd')
+    if cmd not in ('config', 'init', 'uninit', 'list', 'latency', 'txn') and cmd not in em.RULE_COMMANDS:
+        return {'ok': False, 'output': 'unknown command %s\n' % cmd}
+
+    with gLock:
+        stdout = sys.stdout
+        sys.stdout = StringIO()
+        try:
+            rules = [em.Rule.from_dict(r) for r in request.get('rules', [])]
+            ok = bool(em.run_command(cmd, rules, request.get('ops')))
+        except Exception as e:
+            print('%s failed: %r' % (cmd, e))
+            ok = False
+        finally:
+            output = sys.stdout.getvalue()
+            sys.stdout = stdout
+    return {'ok': ok, 'output': output}
+
+class RequestHandler(socketserver.StreamRequestHandler):
+
+    def handle(self):
+        # a client like dynem.py keeps the connection open for many requests
+        for line in iter(self.rfile.readline, b''):
+            try:
+                reply = serve(json.loads(line.decode()))
+            except ValueError as e:
+                reply = {'ok': False, 'output': 'invalid request: %s\n' % e}
+            self.wfile.write((json.dumps(reply) + '\n').encode())
+
+class Server(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+
+    daemon_threads = True
+
+def main():
+    arg_parser = argparse.ArgumentParser()
+    arg_parser.add_argument('--socket', '-s', help='unix socket path', default=em.SOCKET_PATH)
+    arg_parser.add_argument('--no-init', action='store_true', help='do not init/uninit the emulator', default=False)
+    arg_parser.add_argument('--trace', help='append a json line per command phase to this file')
+    args = arg_parser.parse_args()
+    if args.trace:
+        em.trace_to(args.trace)
+
+    em.KEEP_RULES = True
+    em.gConfig = em.load_config(em.CONFIG_PATH)
+    if not args.no_init and not em.init():
+        print('init failed')
+    em.load_rules()
+
+    em.mkdir_p(os.path.dirname(args.socket))
+    if os.path.exists(args.socket):
+        os.remove(args.socket)
+    # set through the umask, so the socket is never open wider in between
+    umask = os.umask(SOCKET_UMASK)
+    try:
+        server = Server(args.socket, RequestHandler)
+    finally:
+        os.umask(umask)
+
+    def stop(signum, frame):
+        threading.Thread(target=server.shutdown).start()
+    signal.signal(signal.SIGTERM, stop)
+    signal.signal(signal.SIGINT, stop)
+
+    print('piemd listening on %s' % args.socket)
+    sys.stdout.flush()
+    try:
+        server.serve_forever()
+    finally:
+        server.server_close()
+        os.remove(args.socket)
+        if not args.no_init:
+            with gLock:
+                em.uninit()
+
+if __name__ == "__main__":
+    main()
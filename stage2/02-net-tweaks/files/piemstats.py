@@ -0,0 +1,331 @@
+#!/usr/bin/python
+'''
+per-rule data-plane telemetry of emulator.py
+
+Samples the statistics of the netem and bfifo qdiscs of every rule in piem.rules
+(sent bytes and packets, drops, overlimits, backlog) at a fixed rate, keeps the
+last samples of each qdisc in a ring buffer, and serves them as Prometheus text
+on a local HTTP port:
+
+    $ sudo piemstats.py --rate 10 --port 9464
+    $ curl -s localhost:9464/metrics
+
+Each sample is one netlink dump of all the qdiscs, or one "tc -s -j qdisc show"
+when no netlink socket can be opened, and piem.rules is parsed again only when
+it changes, so a sample of 64 rules takes about a millisecond.
+'''
+import argparse
+import json
+import os
+import signal
+import socket
+import sys
+import threading
+import time
+import emulator as em
+import rtnl
+
+try:
+    from http.server import BaseHTTPRequestHandler, HTTPServer
+except ImportError:
+    from BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer
+
+FIELDS = rtnl.QDISC_STATS_FIELDS
+COUNTERS = (
+    ('bytes', 'bytes sent by the qdisc'),
+    ('packets', 'packets sent by the qdisc'),
+    ('drops', 'packets dropped by the qdisc'),
+    ('overlimits', 'overlimit events of the qdisc')
+)
+GAUGES = (
+    ('backlog_bytes', 'backlog', 'bytes queued in the qdisc'),
+    ('qlen_packets', 'qlen', 'packets queued in the qdisc')
+)
+RING_SIZE = 600
+METRICS_PORT = 9464
+
+class Ring(object):
+
+    '''
+    fixed-size ring buffer of (time, counters) samples, counters in the order of FIELDS
+    '''
+
+    def __init__(self, size):
+        self.samples = [None] * size
+        self.pos = 0
+        self.count = 0
+
+    def append(self, sample):
+        self.samples[self.pos] = sample
+        self.pos = (self.pos + 1) % len(self.samples)
+        self.count = min(self.count + 1, len(self.samples))
+
+    def __len__(self):
+        return self.count
+
+    def __iter__(self):
+        start = self.pos - self.count
+        for i in range(start, self.pos):
+            yield self.samples[i]
+
+    def latest(self):
+        return self.samples[self.pos - 1] if self.count else None
+
+    def oldest(self):
+        return self.samples[self.pos - self.count] if self.count else None
+
+    def rate(self, field):
+        '''
+        per second increase of a counter over the samples in the buffer
+        '''
+        first, last = self.oldest(), self.latest()
+        if first is None or last[0] <= first[0]:
+            return 0.0
+        i = FIELDS.index(field)
+        return (last[1][i] - first[1][i]) / (last[0] - first[0])
+
+    def max(self, field):
+        i = FIELDS.index(field)
+        return max(s[1][i] for s in self) if self.count else 0
+
+class Sampler(object):
+
+    '''
+    samples the qdiscs of the rules in piem.rules into one ring per rule and qdisc
+    '''
+
+    def __init__(self, size=RING_SIZE):
+        self.size = size
+        self.lock = threading.Lock()
+        # rule dict, [(qdisc kind, (ifindex, parent), Ring)]
+        self.rules = []
+        self.mtime = None
+        self.samples = 0
+        self.duration = 0.0
+        self.ifindexes = {}
+        self.wanted = set()
+        try:
+            self.netlink = rtnl.Netlink()
+        except (OSError, socket.error) as e:
+            print('netlink not available, sample with tc: %s' % e)
+            self.netlink = None
+
+    def _ifindex(self, dev):
+        if dev not in self.ifindexes:
+            self.ifindexes[dev] = rtnl.ifindex(dev)
+        return self.ifindexes[dev]
+
+    def reload(self):
+        '''
+        parses piem.rules again when it changed, the rings of the rules still there are kept.
+        The file is rewritten in place, so a read in the middle of it is retried on the next
+        sample with the rules parsed before
+        '''
+        try:
+            mtime = os.stat(em.RULE_PATH).st_mtime
+        except OSError:
+            mtime = None
+        if mtime == self.mtime:
+            return
+        content = []
+        if mtime is not None:
+            try:
+                with open(em.RULE_PATH, 'r') as f:
+                    content = json.load(f)
+            except (IOError, ValueError) as e:
+                print('rules not read, keep the ones before: %s' % e)
+                return
+
+        # a handle removed and taken by another rule gets new rings
+        rings = dict(((_rule_key(r), kind), ring) for r, qdiscs in self.rules for kind, _, ring in qdiscs)
+        self.ifindexes = {}
+        rules = []
+        for d in content:
+            p = em.Rule.from_dict(d)._get_tc_params()
+            qdiscs = []
+            for kind, dev, parent in (('netem', p['ifb'], p['netem_parent']),
+                                      ('bfifo', p['out_inf'], p['classid'])):
+                try:
+                    key = (self._ifindex(dev), rtnl.parse_handle(parent))
+                except LookupError:
+                    continue
+                qdiscs.append((kind, key, rings.get((_rule_key(d), kind)) or Ring(self.size)))
+            rules.append((d, qdiscs))
+        self.mtime = mtime
+        with self.lock:
+            self.rules = rules
+            self.wanted = set(key for _, qdiscs in rules for _, key, _ in qdiscs)
+
+    def read_qdiscs(self):
+        '''
+        {(ifindex, parent): (kind, stats)} of the qdiscs of the rules, stats in the order of FIELDS
+        '''
+        if self.netlink is not None:
+            return self.netlink.dump_qdiscs(self.wanted)
+        qdiscs = {}
+        for q in json.loads(em._tc_output(['-s', '-j', 'qdisc', 'show'])):
+            try:
+                key = (self._ifindex(q['dev']), rtnl.parse_handle('root' if q.get('root') else q['parent']))
+            except LookupError:
+                continue
+            qdiscs[key] = (q['kind'], tuple(q.get(f, 0) for f in FIELDS))
+        return qdiscs
+
+    def sample(self):
+        start = time.time()
+        self.reload()
+        qdiscs = self.read_qdiscs()
+        with self.lock:
+            for _, rule_qdiscs in self.rules:
+                for kind, key, ring in rule_qdiscs:
+                    q = qdiscs.get(key)
+                    # the netem of an sls rule is a netem as well, anything else isn't ours
+                    if q is not None and q[0] == kind:
+                        ring.append((start, q[1]))
+            self.samples += 1
+            self.duration = time.time() - start
+
+    def run(self, rate, stop):
+        '''
+        samples at rate Hz against absolute deadlines until stop is set
+        '''
+        period = 1.0 / rate
+        deadline = time.time()
+        while not stop.is_set():
+            try:
+                self.sample()
+            except (OSError, IOError, ValueError) as e:
+                print('sample failed: %s' % e)
+            deadline += period
+            now = time.time()
+            if deadline < now:
+                # fell behind, skip the missed samples instead of bursting
+                deadline = now
+            stop.wait(deadline - now)
+
+    def metrics(self):
+        '''
+        the latest samples in the Prometheus text format
+        '''
+        lines = []
+        with self.lock:
+            series = []
+            for d, qdiscs in self.rules:
+                f = em.Filter.from_dict(d['emfilter'])
+                labels = 'handle="%s",direction="%s",filter="%s"' % (
+                    d['handle'], d['direction'], _escape(f.matches()))
+                for kind, _, ring in qdiscs:
+                    if len(ring):
+                        series.append(('%s,qdisc="%s"' % (labels, kind), ring))
+
+            for name, help_text in COUNTERS:
+                lines.append('# HELP piem_qdisc_%s_total %s' % (name, help_text))
+                lines.append('# TYPE piem_qdisc_%s_total counter' % name)
+                i = FIELDS.index(name)
+                lines += ['piem_qdisc_%s_total{%s} %d' % (name, labels, ring.latest()[1][i])
+                          for labels, ring in series]
+            for name, field, help_text in GAUGES:
+                lines.append('# HELP piem_qdisc_%s %s' % (name, help_text))
+                lines.append('# TYPE piem_qdisc_%s gauge' % name)
+                i = FIELDS.index(field)
+                lines += ['piem_qdisc_%s{%s} %d' % (name, labels, ring.latest()[1][i])
+                          for labels, ring in series]
+            lines.append('# HELP piem_qdisc_backlog_max_bytes highest backlog over the samples kept')
+            lines.append('# TYPE piem_qdisc_backlog_max_bytes gauge')
+            lines += ['piem_qdisc_backlog_max_bytes{%s} %d' % (labels, ring.max('backlog'))
+                      for labels, ring in series]
+            lines.append('# HELP piem_sampler_samples_total samples taken')
+            lines.append('# TYPE piem_sampler_samples_total counter')
+            lines.append('piem_sampler_samples_total %d' % self.samples)
+            lines.append('# HELP piem_sampler_duration_seconds time taken by the last sample')
+            lines.append('# TYPE piem_sampler_duration_seconds gauge')
+            lines.append('piem_sampler_duration_seconds %.6f' % self.duration)
+        return '\n'.join(lines) + '\n'
+
+def _rule_key(d):
+    return (d['handle'], em.Filter.from_dict(d['emfilter']).key())
+
+def _escape(value):
+    return value.replace('\\', '\\\\').replace('"', '\\"')
+
+def print_stats(interval):
+    '''
+    the stats subcommand of emulator.py, counters of each rule with the rates over interval seconds
+    '''
+    sampler = Sampler(size=2)
+    sampler.sample()
+    time.sleep(interval)
+    sampler.sample()
+    print('%-6s %-9s %-6s %12s %10s %8s %10s %8s %10s %8s' % (
+        'handle', 'direction', 'qdisc', 'bytes', 'packets', 'drops', 'overlimits', 'backlog', 'kbit/s', 'pps'))
+    for d, qdiscs in sampler.rules:
+        print('%s %s' % (d['handle'], em.Filter.from_dict(d['emfilter']).matches()))
+        for kind, _, ring in qdiscs:
+            if not len(ring):
+                print('%-6s %-9s %-6s %s' % ('', d['direction'], kind, 'missing'))
+                continue
+            c = dict(zip(FIELDS, ring.latest()[1]))
+            print('%-6s %-9s %-6s %12d %10d %8d %10d %8d %10.1f %8.1f' % (
+                '', d['direction'], kind, c['bytes'], c['packets'], c['drops'], c['overlimits'],
+                c['backlog'], ring.rate('bytes') * 8 / 1000, ring.rate('packets')))
+    return True
+
+def main():
+    arg_parser = argparse.ArgumentParser()
+    arg_parser.add_argument('--rate', '-r',
+        type=float,
+        help='samples per second',
+        default=10
+    )
+    arg_parser.add_argument('--size', '-n',
+        type=int,
+        help='samples kept per rule and qdisc',
+        default=RING_SIZE
+    )
+    arg_parser.add_argument('--port', '-p',
+        type=int,
+        help='port of the metrics endpoint',
+        default=METRICS_PORT
+    )
+    arg_parser.add_argument('--address', '-a',
+        help='address of the metrics endpoint',
+        default='127.0.0.1'
+    )
+    args = arg_parser.parse_args()
+
+    em.gConfig = em.load_config(em.CONFIG_PATH)
+    sampler = Sampler(args.size)
+
+    class MetricsHandler(BaseHTTPRequestHandler):
+
+        def do_GET(self):
+            if self.path.split('?')[0] not in ('/', '/metrics'):
+                self.send_error(404)
+                return
+            body = sampler.metrics().encode()
+            self.send_response(200)
+            self.send_header('Content-Type', 'text/plain; version=0.0.4')
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, fmt, *args):
+            pass
+
+    server = HTTPServer((args.address, args.port), MetricsHandler)
+    thread = threading.Thread(target=server.serve_forever)
+    thread.daemon = True
+    thread.start()
+    print('piemstats sampling at %g Hz, metrics on http://%s:%d/metrics' % (args.rate, args.address, args.port))
+    sys.stdout.flush()
+
+    stop = threading.Event()
+    signal.signal(signal.SIGTERM, lambda signum, frame: stop.set())
+    signal.signal(signal.SIGINT, lambda signum, frame: stop.set())
+    try:
+        sampler.run(args.rate, stop)
+    finally:
+        server.shutdown()
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,596 @@
+#!/usr/bin/python
+'''
+rtnetlink backend for emulator.py
+
+Encodes the Op objects built by emulator.Rule (ingress/htb/bfifo/netem qdiscs,
+htb classes, u32, flower and cls_bpf filters with mirred redirect, u32 hash
+tables and the filters linking to them, and ifb link up/down) into
+rtnetlink messages and sends them over one AF_NETLINK socket that stays open
+between calls, so no tc/ip process is forked per rule operation.
+
+The messages mirror what iproute2's tc sends for the same command line, so the
+resulting kernel state is the same as the shell backend. Operations it cannot
+encode (netem "loss sls", which needs the patched tc to load the pattern file)
+are left to the shell backend, see Netlink.supports().
+
+Netlink.dump_qdiscs() reads the statistics of all the qdiscs in one dump, for
+piemstats.py.
+
+Ipset adds and deletes the elements of the ipsets of fw.sh over nfnetlink, for
+blocker.py.
+'''
+import os
+import socket
+import struct
+
+NETLINK_ROUTE = 0
+NETLINK_NETFILTER = 12
+SOL_NETLINK = 270
+NETLINK_CAP_ACK = 10
+NETLINK_EXT_ACK = 11
+
+NLMSG_ERROR = 2
+NLMSG_DONE = 3
+
+NLM_F_REQUEST = 0x1
+NLM_F_ACK = 0x4
+NLM_F_DUMP = 0x300
+NLM_F_EXCL = 0x200
+NLM_F_CREATE = 0x400
+NLM_F_CAPPED = 0x100
+NLM_F_ACK_TLVS = 0x200
+NLMSGERR_ATTR_MSG = 1
+NLA_F_NESTED = 0x8000
+NLA_F_NET_BYTEORDER = 0x4000
+# bytes and messages sent per write, a write over the socket send buffer (212992 bytes by
+# default) fails with EMSGSIZE, and the acks of a write, which take several hundred bytes
+# of the receive buffer each, fail with ENOBUFS when they don't fit in it
+SEND_CHUNK = 1 << 16
+SEND_MESSAGES = 128
+# seconds to wait for the kernel on a receive, past it the acks still missing are taken
+# as lost and their ops as failed rather than hanging the caller
+ACK_TIMEOUT = 5.0
+
+RTM_NEWLINK = 16
+RTM_NEWQDISC = 36
+RTM_DELQDISC = 37
+RTM_GETQDISC = 38
+RTM_NEWTCLASS = 40
+RTM_DELTCLASS = 41
+RTM_NEWTFILTER = 44
+RTM_DELTFILTER = 45
+
+IFF_UP = 0x1
+ETH_P_IP = 0x0800
+
+TC_H_ROOT = 0xffffffff
+TC_H_INGRESS = 0xfffffff1
+
+TCA_KIND = 1
+TCA_OPTIONS = 2
+TCA_STATS = 3
+TCA_STATS2 = 7
+NLA_TYPE_MASK = 0x3fff
+
+TCA_STATS_BASIC = 1
+TCA_STATS_QUEUE = 3
+QDISC_STATS_FIELDS = ('bytes', 'packets', 'drops', 'overlimits', 'requeues', 'backlog', 'qlen')
+
+TCA_HTB_PARMS = 1
+TCA_HTB_INIT = 2
+TCA_HTB_RATE64 = 6
+TCA_HTB_CEIL64 = 7
+
+TCA_NETEM_LOSS = 5
+TCA_NETEM_LATENCY64 = 10
+TCA_NETEM_JITTER64 = 11
+NETEM_LOSS_GE = 2
+
+TCA_U32_CLASSID = 1
+TCA_U32_HASH = 2
+TCA_U32_LINK = 3
+TCA_U32_DIVISOR = 4
+TCA_U32_SEL = 5
+TCA_U32_ACT = 7
+TC_U32_TERMINAL = 1
+
+TCA_FLOWER_CLASSID = 1
+TCA_FLOWER_ACT = 3
+TCA_FLOWER_KEY_ETH_TYPE = 8
+TCA_FLOWER_KEY_IP_PROTO = 9
+TCA_FLOWER_KEY_IP_TOS = 73
+TCA_FLOWER_KEY_IP_TOS_MASK = 74
+# (key, mask) attributes of the address keys, the port keys by ip protocol
+FLOWER_IP_KEYS = {'src_ip': (10, 11), 'dst_ip': (12, 13)}
+FLOWER_PORT_KEYS = {
+    (6, 'src_port'): 18, (6, 'dst_port'): 19,
+    (17, 'src_port'): 20, (17, 'dst_port'): 21
+}
+
+TCA_BPF_ACT = 1
+TCA_BPF_CLASSID = 3
+TCA_BPF_OPS_LEN = 4
+TCA_BPF_OPS = 5
+
+TCA_ACT_KIND = 1
+TCA_ACT_OPTIONS = 2
+TCA_MIRRED_PARMS = 2
+TC_ACT_STOLEN = 4
+TCA_EGRESS_REDIR = 1
+
+NFNL_SUBSYS_IPSET = 6
+NFNETLINK_V0 = 0
+IPSET_PROTOCOL = 7
+IPSET_CMDS = {'add': 9, 'del': 10, 'test': 11}
+IPSET_ATTR_PROTOCOL = 1
+IPSET_ATTR_SETNAME = 2
+IPSET_ATTR_DATA = 7
+IPSET_ATTR_IP = 1
+IPSET_ATTR_CIDR = 3
+IPSET_ATTR_PORT = 4
+IPSET_ATTR_PROTO = 7
+IPSET_ATTR_IPADDR_IPV4 = 1
+IPSET_ERRORS = {
+    2: 'the set does not exist, see fw.sh init',
+    4097: 'kernel and userspace ipset protocols differ',
+    4102: 'the element does not fit the type of the set',
+    4103: 'element not in the set',
+    4104: 'invalid prefix length'
+}
+
+TC_LINKLAYER_ETHERNET = 1
+TIME_UNITS_PER_SEC = 1000000
+HTB_MTU = 1600
+NETEM_LIMIT = 1000
+UINT32_MAX = 0xffffffff
+
+def _attr(atype, payload):
+    length = 4 + len(payload)
+    return struct.pack('HH', length, atype) + payload + b'\0' * (-length & 3)
+
+def _str_attr(atype, value):
+    return _attr(atype, value.encode() + b'\0')
+
+def _u32_attr(atype, value):
+    return _attr(atype, struct.pack('I', value))
+
+def _u64_attr(atype, value):
+    return _attr(atype, struct.pack('Q', value))
+
+def _percent(value):
+    return int(round(float(value) / 100.0 * UINT32_MAX))
+
+_NLA = struct.Struct('HH')
+_STATS_BASIC = struct.Struct('=QI')
+_STATS_QUEUE = struct.Struct('5I')
+_TC_STATS = struct.Struct('=Q7I')
+
+def parse_attrs(data, start=0, end=None):
+    '''
+    {type: (start, end)} of the payloads of a run of netlink attributes in data
+    '''
+    end = len(data) if end is None else end
+    attrs = {}
+    pos = start
+    while pos + 4 <= end:
+        alen, atype = _NLA.unpack_from(data, pos)
+        if alen < 4:
+            break
+        attrs[atype & NLA_TYPE_MASK] = (pos + 4, pos + alen)
+        pos += (alen + 3) & ~3
+    return attrs
+
+def _unpack(layout, data, span):
+    '''
+    a struct attribute, zero filled when the kernel sent a shorter one
+    '''
+    if span is None:
+        return layout.unpack(b'\0' * layout.size)
+    if span[1] - span[0] >= layout.size:
+        return layout.unpack_from(data, span[0])
+    return layout.unpack(data[span[0]:span[1]].ljust(layout.size, b'\0'))
+
+def _qdisc_stats(data, attrs):
+    '''
+    the counters "tc -s qdisc show" prints in the order of QDISC_STATS_FIELDS, from
+    TCA_STATS2 or the older TCA_STATS
+    '''
+    if TCA_STATS2 in attrs:
+        nested = parse_attrs(data, *attrs[TCA_STATS2])
+        nbytes, packets = _unpack(_STATS_BASIC, data, nested.get(TCA_STATS_BASIC))
+        qlen, backlog, drops, requeues, overlimits = _unpack(_STATS_QUEUE, data, nested.get(TCA_STATS_QUEUE))
+    else:
+        nbytes, packets, drops, overlimits, _, _, qlen, backlog = _unpack(_TC_STATS, data, attrs.get(TCA_STATS))
+        requeues = 0
+    return (nbytes, packets, drops, overlimits, requeues, backlog, qlen)
+
+def parse_handle(handle):
+    '''
+    tc style 'major:minor' handle, both parts are hex
+    '''
+    if handle == 'root':
+        return TC_H_ROOT
+    if handle == 'ingress':
+        return TC_H_INGRESS
+    major, _, minor = str(handle).partition(':')
+    return (int(major or '0', 16) << 16) | int(minor or '0', 16)
+
+def parse_u32_handle(handle):
+    '''
+    u32 filter handle 'htid:hash:node', all parts are hex
+    '''
+    parts = (str(handle).split(':') + ['', ''])[:3]
+    htid, hash_, node = [int(p or '0', 16) for p in parts]
+    return (htid << 20) | (hash_ << 12) | node
+
+def ifindex(dev):
+    if hasattr(socket, 'if_nametoindex'):
+        try:
+            return socket.if_nametoindex(dev)
+        except (OSError, socket.error):
+            raise LookupError('Cannot find device "%s"' % dev)
+    try:
+        with open('/sys/class/net/%s/ifindex' % dev) as f:
+            return int(f.read())
+    except IOError:
+        raise LookupError('Cannot find device "%s"' % dev)
+
+class _PSched(object):
+
+    '''
+    time/tick conversion the same way iproute2's tc_core does, from /proc/net/psched
+    '''
+
+    def __init__(self):
+        t2us, us2t, clock_res, hz = 1, 1, TIME_UNITS_PER_SEC, 0
+        try:
+            with open('/proc/net/psched') as f:
+                t2us, us2t, clock_res, hz = [int(v, 16) for v in f.read().split()[:4]]
+        except (IOError, ValueError):
+            pass
+        self.tick_in_usec = float(t2us) / us2t * (float(clock_res) / TIME_UNITS_PER_SEC)
+        self.hz = hz if clock_res == 1000000 and hz else 100
+
+    def xmittime(self, rate, size):
+        return int(int(TIME_UNITS_PER_SEC * (float(size) / rate)) * self.tick_in_usec)
+
+class Netlink(object):
+
+    def __init__(self, protocol=NETLINK_ROUTE):
+        self.sock = socket.socket(socket.AF_NETLINK, socket.SOCK_RAW, protocol)
+        self.sock.bind((0, 0))
+        for opt in (NETLINK_CAP_ACK, NETLINK_EXT_ACK):
+            try:
+                self.sock.setsockopt(SOL_NETLINK, opt, 1)
+            except (OSError, socket.error):
+                pass
+        self.sock.settimeout(ACK_TIMEOUT)
+        # set when acks went missing, the replies on the socket can't be trusted after it
+        self.stale = False
+        self.seq = 0
+        self.psched = _PSched()
+
+    def close(self):
+        self.sock.close()
+
+    def supports(self, op):
+        if op.tool == 'ip':
+            return op.__class__.__name__ == 'LinkOp'
+        kind = op.__class__.__name__
+        if kind == 'QdiscOp':
+            if op.kind == 'netem':
+                return op.opts['loss'][0] != 'sls'
+            return op.verb == 'del' or op.kind in ('htb', 'bfifo') or op.parent == 'ingress'
+        return kind in ('ClassOp', 'FilterOp', 'FlowerOp', 'BpfOp', 'HashTableOp', 'HashLinkOp')
+
+    # message encoding
+
+    def _msg(self, mtype, flags, body):
+        self.seq += 1
+        return self.seq, struct.pack('IHHII', 16 + len(body), mtype, flags | NLM_F_REQUEST | NLM_F_ACK,
+                                     self.seq, 0) + body
+
+    def _tcmsg(self, dev, handle, parent, info=0):
+        return struct.pack('BxxxiIII', socket.AF_UNSPEC, ifindex(dev), handle, parent, info)
+
+    def _verb_flags(self, verb):
+        if verb == 'add':
+            return NLM_F_CREATE | NLM_F_EXCL
+        return 0
+
+    def _ratespec(self, rate):
+        return struct.pack('BBHhHI', 0, TC_LINKLAYER_ETHERNET, 0, -1, 0, min(rate, UINT32_MAX))
+
+    def _encode_link(self, op):
+        flags = IFF_UP if op.up else 0
+        body = struct.pack('BxHiII', socket.AF_UNSPEC, 0, ifindex(op.dev), flags, IFF_UP)
+        return self._msg(RTM_NEWLINK, 0, body)
+
+    def _encode_qdisc(self, op):
+        handle = parse_handle(op.handle) if op.handle is not None else 0
+        if op.parent == 'ingress':
+            handle = 0xffff0000
+        body = self._tcmsg(op.dev, handle, parse_handle(op.parent))
+        if op.verb == 'del':
+            return self._msg(RTM_DELQDISC, 0, body)
+
+        if op.parent == 'ingress':
+            body += _str_attr(TCA_KIND, 'ingress')
+        elif op.kind == 'htb':
+            glob = struct.pack('IIIII', 3, 10, op.opts['default'], 0, 0)
+            body += _str_attr(TCA_KIND, 'htb') + _attr(TCA_OPTIONS, _attr(TCA_HTB_INIT, glob))
+        elif op.kind == 'bfifo':
+            body += _str_attr(TCA_KIND, 'bfifo') + _attr(TCA_OPTIONS, struct.pack('I', int(op.opts['limit'])))
+        elif op.kind == 'netem':
+            body += _str_attr(TCA_KIND, 'netem') + _attr(TCA_OPTIONS, self._netem_opts(op.opts))
+        return self._msg(RTM_NEWQDISC, self._verb_flags(op.verb), body)
+
+    def _netem_opts(self, opts):
+        latency = int(opts['delay'] * 1000000)
+        jitter = int(opts['jitter'] * 1000000)
+        loss = opts['loss']
+        random_loss = _percent(loss[1]) if loss[0] == 'random' else 0
+        qopt = struct.pack('IIIIII', min(latency >> 6, UINT32_MAX), NETEM_LIMIT, random_loss, 0, 0,
+                           min(jitter >> 6, UINT32_MAX))
+        attrs = _u64_attr(TCA_NETEM_LATENCY64, latency) + _u64_attr(TCA_NETEM_JITTER64, jitter)
+        if loss[0] == 'gemodel':
+            gemodel = struct.pack('IIII', _percent(loss[1]), _percent(loss[2]), 0, 0)
+            attrs += _attr(TCA_NETEM_LOSS, _attr(NETEM_LOSS_GE, gemodel))
+        return qopt + attrs
+
+    def _encode_class(self, op):
+        body = self._tcmsg(op.dev, parse_handle(op.classid), parse_handle(op.parent))
+        if op.verb == 'del':
+            return self._msg(RTM_DELTCLASS, 0, body)
+
+        rate = int(op.rate) * 1000 // 8
+        buf = self.psched.xmittime(rate, rate // self.psched.hz + HTB_MTU)
+        parms = self._ratespec(rate) + self._ratespec(rate) + struct.pack('IIIII', buf, buf, 0, 0, 0)
+        opts = _attr(TCA_HTB_PARMS, parms)
+        if rate > UINT32_MAX:
+            opts += _u64_attr(TCA_HTB_RATE64, rate) + _u64_attr(TCA_HTB_CEIL64, rate)
+        body += _str_attr(TCA_KIND, 'htb') + _attr(TCA_OPTIONS, opts)
+        return self._msg(RTM_NEWTCLASS, self._verb_flags(op.verb), body)
+
+    def _u32_sel(self, keys, flags=0, hmask=0, hoff=0):
+        sel = struct.pack('BBBxHHhh', flags, 0, len(keys), 0, 0, 0, hoff) + struct.pack('>I', hmask)
+        for value, mask, off in keys:
+            sel += struct.pack('>II', mask, value) + struct.pack('ii', off, 0)
+        return sel
+
+    def _filter_header(self, op, handle, kind='u32'):
+        info = (op.prio << 16) | socket.htons(ETH_P_IP)
+        body = self._tcmsg(op.dev, handle, parse_handle(op.parent), info)
+        return body + _str_attr(TCA_KIND, kind)
+
+    def _encode_hash_table(self, op):
+        body = self._filter_header(op, op.table << 20)
+        if op.verb == 'del':
+            return self._msg(RTM_DELTFILTER, 0, body)
+        body += _attr(TCA_OPTIONS, _u32_attr(TCA_U32_DIVISOR, op.divisor))
+        return self._msg(RTM_NEWTFILTER, self._verb_flags(op.verb), body)
+
+    def _encode_hash_link(self, op):
+        body = self._filter_header(op, parse_u32_handle(op.handle))
+        if op.verb == 'del':
+            return self._msg(RTM_DELTFILTER, 0, body)
+        opts = _u32_attr(TCA_U32_HASH, parse_u32_handle('800:')) + \
+            _u32_attr(TCA_U32_LINK, op.table << 20) + \
+            _attr(TCA_U32_SEL, self._u32_sel([(0, 0, 0)], hmask=0 if op.offset is None else 0xff,
+                                             hoff=op.offset or 0))
+        body += _attr(TCA_OPTIONS, opts)
+        return self._msg(RTM_NEWTFILTER, self._verb_flags(op.verb), body)
+
+    def _encode_filter(self, op):
+        body = self._filter_header(op, parse_u32_handle(op.handle))
+        if op.verb == 'del':
+            return self._msg(RTM_DELTFILTER, 0, body)
+
+        sel = self._u32_sel(op.emfilter.u32_keys(), flags=TC_U32_TERMINAL)
+        opts = _u32_attr(TCA_U32_CLASSID, parse_handle(op.flowid)) + _attr(TCA_U32_SEL, sel)
+        if op.ht is not None:
+            opts += _u32_attr(TCA_U32_HASH, parse_u32_handle(op.ht))
+        if op.redirect is not None:
+            opts += self._redirect(TCA_U32_ACT, op.redirect)
+        body += _attr(TCA_OPTIONS, opts)
+        return self._msg(RTM_NEWTFILTER, self._verb_flags(op.verb), body)
+
+    def _redirect(self, atype, dev):
+        mirred = struct.pack('IIiiiiI', 0, 0, TC_ACT_STOLEN, 0, 0, TCA_EGRESS_REDIR, ifindex(dev))
+        action = _str_attr(TCA_ACT_KIND, 'mirred') + _attr(TCA_ACT_OPTIONS, _attr(TCA_MIRRED_PARMS, mirred))
+        return _attr(atype, _attr(1, action))
+
+    def _encode_flower(self, op):
+        body = self._filter_header(op, op.handle, 'flower')
+        if op.verb == 'del':
+            return self._msg(RTM_DELTFILTER, 0, body)
+
+        opts = _u32_attr(TCA_FLOWER_CLASSID, parse_handle(op.flowid)) + \
+            _attr(TCA_FLOWER_KEY_ETH_TYPE, struct.pack('>H', ETH_P_IP))
+        keys = op.emfilter.flower_keys()
+        proto = dict((key, value) for key, value, _ in keys).get('ip_proto')
+        for key, value, mask in keys:
+            if key in FLOWER_IP_KEYS:
+                key_attr, mask_attr = FLOWER_IP_KEYS[key]
+                opts += _attr(key_attr, struct.pack('>I', value)) + _attr(mask_attr, struct.pack('>I', mask))
+            elif key == 'ip_proto':
+                opts += _attr(TCA_FLOWER_KEY_IP_PROTO, struct.pack('B', value))
+            elif key == 'ip_tos':
+                opts += _attr(TCA_FLOWER_KEY_IP_TOS, struct.pack('B', value)) + \
+                    _attr(TCA_FLOWER_KEY_IP_TOS_MASK, struct.pack('B', mask))
+            else:
+                opts += _attr(FLOWER_PORT_KEYS[(proto, key)], struct.pack('>H', value))
+        if op.redirect is not None:
+            opts += self._redirect(TCA_FLOWER_ACT, op.redirect)
+        body += _attr(TCA_OPTIONS, opts)
+        return self._msg(RTM_NEWTFILTER, self._verb_flags(op.verb), body)
+
+    def _encode_bpf(self, op):
+        body = self._filter_header(op, op.handle, 'bpf')
+        if op.verb == 'del':
+            return self._msg(RTM_DELTFILTER, 0, body)
+
+        program = op.emfilter.bpf_program()
+        opts = _u32_attr(TCA_BPF_CLASSID, parse_handle(op.flowid)) + \
+            _attr(TCA_BPF_OPS_LEN, struct.pack('H', len(program))) + \
+            _attr(TCA_BPF_OPS, b''.join(struct.pack('HBBI', *insn) for insn in program))
+        if op.redirect is not None:
+            opts += self._redirect(TCA_BPF_ACT, op.redirect)
+        body += _attr(TCA_OPTIONS, opts)
+        return self._msg(RTM_NEWTFILTER, self._verb_flags(op.verb), body)
+
+    def encode(self, op):
+        kind = op.__class__.__name__
+        if kind == 'LinkOp':
+            return self._encode_link(op)
+        elif kind == 'QdiscOp':
+            return self._encode_qdisc(op)
+        elif kind == 'ClassOp':
+            return self._encode_class(op)
+        elif kind == 'HashTableOp':
+            return self._encode_hash_table(op)
+        elif kind == 'HashLinkOp':
+            return self._encode_hash_link(op)
+        elif kind == 'FlowerOp':
+            return self._encode_flower(op)
+        elif kind == 'BpfOp':
+            return self._encode_bpf(op)
+        return self._encode_filter(op)
+
+    # transport
+
+    def _parse_ack(self, data, flags):
+        code = struct.unpack('i', data[:4])[0]
+        message = 'RTNETLINK answers: %s' % os.strerror(-code) if code else ''
+        if flags & NLM_F_ACK_TLVS:
+            orig_len = struct.unpack('I', data[4:8])[0]
+            pos = 4 + (16 if flags & NLM_F_CAPPED else orig_len)
+            while pos + 4 <= len(data):
+                alen, atype = struct.unpack('HH', data[pos:pos + 4])
+                if alen < 4:
+                    break
+                if atype == NLMSGERR_ATTR_MSG:
+                    message = 'Error: %s.' % data[pos + 4:pos + alen].rstrip(b'\0').decode()
+                pos += (alen + 3) & ~3
+        return code, message
+
+    def dump_qdiscs(self, wanted=None):
+        '''
+        {(ifindex, parent): (kind, stats)} of all the qdiscs, or of the keys in wanted,
+        parent as parse_handle() returns it, stats has the counters of "tc -s qdisc show"
+        in the order of QDISC_STATS_FIELDS
+        '''
+        self.seq += 1
+        seq = self.seq
+        body = struct.pack('BxxxiIII', socket.AF_UNSPEC, 0, 0, 0, 0)
+        self.sock.sendall(struct.pack('IHHII', 16 + len(body), RTM_GETQDISC, NLM_F_REQUEST | NLM_F_DUMP,
+                                      seq, 0) + body)
+        qdiscs = {}
+        while True:
+            data = self.sock.recv(65536)
+            pos = 0
+            while pos + 16 <= len(data):
+                length, mtype, flags, mseq, _ = struct.unpack('IHHII', data[pos:pos + 16])
+                if mseq == seq:
+                    if mtype == NLMSG_DONE:
+                        return qdiscs
+                    if mtype == NLMSG_ERROR:
+                        code, message = self._parse_ack(data[pos + 16:pos + length], flags)
+                        raise OSError(-code, message)
+                    if mtype == RTM_NEWQDISC:
+                        _, index, _, parent, _ = struct.unpack_from('BxxxiIII', data, pos + 16)
+                        key = (index, parent)
+                        if wanted is None or key in wanted:
+                            attrs = parse_attrs(data, pos + 36, pos + length)
+                            kind = data[slice(*attrs.get(TCA_KIND, (0, 0)))].rstrip(b'\0').decode()
+                            qdiscs[key] = (kind, _qdisc_stats(data, attrs))
+                pos += (length + 3) & ~3
+
+    def run(self, ops):
+        '''
+        sends the ops in writes of up to SEND_CHUNK bytes and SEND_MESSAGES messages, and
+        collects the per-message acks of each write before the next one, returns
+        [(op, message)] for the operations that failed. When acks don't come within
+        ACK_TIMEOUT, their ops and the ones not sent yet fail and the socket is stale
+        '''
+        errors = []
+        pending = {}
+        payload = b''
+        for index, op in enumerate(ops):
+            try:
+                seq, msg = self.encode(op)
+            except LookupError as e:
+                errors.append((op, str(e)))
+                continue
+            if len(pending) == SEND_MESSAGES or (pending and len(payload) + len(msg) > SEND_CHUNK):
+                if not self._send(payload, pending, errors):
+                    errors.extend((rest, 'not sent, acks of the ops before it lost') for rest in ops[index:])
+                    return errors
+                pending, payload = {}, b''
+            pending[seq] = op
+            payload += msg
+        if pending:
+            self._send(payload, pending, errors)
+        return errors
+
+    def _send(self, payload, pending, errors):
+        '''
+        writes payload and collects the acks of pending, False when some of them didn't come
+        '''
+        self.sock.sendall(payload)
+        while pending:
+            try:
+                data = self.sock.recv(65536)
+            except socket.timeout:
+                self.stale = True
+                for seq in sorted(pending):
+                    errors.append((pending[seq], 'no ack within %.1f s' % ACK_TIMEOUT))
+                pending.clear()
+                return False
+            pos = 0
+            while pos + 16 <= len(data):
+                length, mtype, flags, seq, _ = struct.unpack('IHHII', data[pos:pos + 16])
+                if mtype == NLMSG_ERROR and seq in pending:
+                    op = pending.pop(seq)
+                    code, message = self._parse_ack(data[pos + 16:pos + length], flags)
+                    if code != 0:
+                        errors.append((op, message))
+                pos += (length + 3) & ~3
+        return True
+
+class Ipset(Netlink):
+
+    '''
+    the element operations of ipset, an element being an address with its prefix length,
+    and the ip protocol number and port for the sets with ports. Adds and deletes never
+    fail on an element which is already in, or not in, the set, like "ipset -exist"
+    '''
+
+    def __init__(self):
+        Netlink.__init__(self, NETLINK_NETFILTER)
+
+    def supports(self, op):
+        return op.__class__.__name__ == 'SetOp'
+
+    def encode(self, op):
+        addr, _, prefix = op.ip.partition('/')
+        data = _attr(IPSET_ATTR_IP | NLA_F_NESTED,
+                     _attr(IPSET_ATTR_IPADDR_IPV4 | NLA_F_NET_BYTEORDER, socket.inet_aton(addr)))
+        data += _attr(IPSET_ATTR_CIDR, struct.pack('B', int(prefix) if prefix else 32))
+        if op.port is not None:
+            data += _attr(IPSET_ATTR_PORT | NLA_F_NET_BYTEORDER, struct.pack('>H', op.port))
+            data += _attr(IPSET_ATTR_PROTO, struct.pack('B', op.proto))
+        body = struct.pack('BBH', socket.AF_INET, NFNETLINK_V0, 0)
+        body += _attr(IPSET_ATTR_PROTOCOL, struct.pack('B', IPSET_PROTOCOL))
+        body += _str_attr(IPSET_ATTR_SETNAME, op.setname)
+        body += _attr(IPSET_ATTR_DATA | NLA_F_NESTED, data)
+        # without NLM_F_EXCL the kernel ignores elements already in or not in the set
+        return self._msg((NFNL_SUBSYS_IPSET << 8) | IPSET_CMDS[op.verb], 0, body)
+
+    def _parse_ack(self, data, flags):
+        code, message = Netlink._parse_ack(self, data, flags)
+        if -code in IPSET_ERRORS:
+            message = 'ipset: %s' % IPSET_ERRORS[-code]
+        elif code:
+            message = message.replace('RTNETLINK answers', 'ipset')
+        return code, message
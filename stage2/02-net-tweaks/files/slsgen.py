@@ -0,0 +1,304 @@
+#!/usr/bin/python
+'''
+generates the loss patterns of sls rules and keeps them in a cache
+
+An sls rule loses packet i of a flow when token i of its pattern, looped over, is 1.
+The pattern is /usr/lib/tc/NAME.patt, 0 and 1 tokens separated by white space, #
+starting a comment. Patterns are built from the Gilbert-Elliott parameters of netem,
+from a loss ratio and burst length the way emulator.py turns them into gemodel, or
+from a recorded loss sequence:
+
+    $ sudo slsgen.py loss --loss 5 --burst 3
+    piem-3f0c9a1d2b7e4a55
+    $ sudo emulator.py add --ip 192.168.1.5 --direction uplink --sls piem-3f0c9a1d2b7e4a55
+
+A pattern is named after a hash of everything its content comes from, generated with
+a fixed seed, so asking for the same one again finds the file in place. The cached
+patterns are kept under --max-size, evicting the least recently used ones first, never
+one a rule of piem.rules uses. dynem.py configurations can give the parameters instead
+of a name, "sls": {"loss": 5, "burst": 3}, and get the pattern from the cache.
+
+The states of a pattern are drawn as runs of geometric lengths and the text is
+encoded as one byte array, so a pattern of a million packets takes a few milliseconds.
+'''
+import argparse
+import hashlib
+import json
+import os
+import re
+import sys
+import numpy as np
+import emulator as em
+
+SLS_DIR = '/usr/lib/tc'
+CACHE_PREFIX = 'piem-'
+PATTERN_LENGTH = 100000
+PATTERN_SEED = 0
+# bytes of cached patterns kept
+CACHE_SIZE = 64 << 20
+# tokens per line of a pattern file
+LINE_TOKENS = 64
+# bumped when the same parameters would give another pattern
+GENERATOR_VERSION = 1
+
+COMMENT = re.compile(br'#[^\n]*')
+INVALID, SPACE, ZERO, ONE = range(4)
+CHAR_KINDS = np.zeros(256, dtype=np.uint8)
+CHAR_KINDS[[ord(c) for c in ' \t\r\n']] = SPACE
+CHAR_KINDS[ord('0')] = ZERO
+CHAR_KINDS[ord('1')] = ONE
+
+def ge_states(rng, n, p, r, bad=False):
+    '''
+    states of n packets under the Gilbert-Elliott model of netem, p the probability to go
+    bad and r to go good at each packet, starting in the bad state if bad. The states come
+    as runs of geometric lengths, the current run going on from where it was. Returns the
+    bool array of bad states and the state of the last packet
+    '''
+    out = np.empty(n, dtype=bool)
+    pos = 0
+    while pos < n:
+        left = n - pos
+        # chances to leave the current state and the other one
+        current, other = (r, p) if bad else (p, r)
+        mean = sum(1.0 / q for q in (p, r) if q > 0) or left
+        k = int(min(left, left / mean)) + 8
+        runs = np.empty(2 * k, dtype=np.int64)
+        for i, q in ((0, current), (1, other)):
+            runs[i::2] = rng.geometric(min(q, 1.0), k) if q > 0 else left + 1
+        runs[0] -= 1
+        states = np.empty(2 * k, dtype=bool)
+        states[0::2] = bad
+        states[1::2] = not bad
+        seq = np.repeat(states, np.minimum(runs, left))[:left]
+        out[pos:pos + len(seq)] = seq
+        pos += len(seq)
+        if len(seq):
+            bad = bool(seq[-1])
+    return out, bad
+
+def gilbert_elliott(n, p, r, bad_loss=100, good_loss=0, seed=PATTERN_SEED):
+    '''
+    n packets of the four parameter model of "loss gemodel p r 1-h 1-k", all in %
+    '''
+    rng = np.random.RandomState(seed)
+    states, _ = ge_states(rng, n, p / 100.0, r / 100.0)
+    lost = states.copy()
+    if bad_loss < 100:
+        lost &= rng.random_sample(n) * 100 < bad_loss
+    if good_loss > 0:
+        lost |= ~states & (rng.random_sample(n) * 100 < good_loss)
+    return lost
+
+def loss_burst(n, loss, burst, seed=PATTERN_SEED):
+    '''
+    n packets of the loss ratio in % and mean burst length emulator.py gives a rule
+    '''
+    rule = em.Rule(None, 0, loss, 0, 0, 0, 'uplink', burst)
+    params = rule._get_loss_params()
+    if params[0] == 'random':
+        return np.random.RandomState(seed).random_sample(n) * 100 < loss
+    return gilbert_elliott(n, params[1], params[2], seed=seed)
+
+def parse_pattern(data):
+    '''
+    bool array of the tokens of a pattern, or of a recorded loss sequence, in bytes
+    '''
+    kinds = CHAR_KINDS[np.frombuffer(COMMENT.sub(b'', data), dtype=np.uint8)]
+    if (kinds == INVALID).any():
+        raise ValueError('not a sequence of 0 and 1')
+    bits = kinds >= ZERO
+    # tokens are single characters, "01" would be a token of two
+    if (bits[1:] & bits[:-1]).any():
+        raise ValueError('tokens must be separated by white space')
+    tokens = kinds[bits]
+    if not len(tokens):
+        raise ValueError('no tokens')
+    return tokens == ONE
+
+def read_pattern(name, directory=SLS_DIR):
+    '''
+    the loss pattern NAME.patt as a bool array, True for a lost packet
+    '''
+    with open(os.path.join(directory, name + '.patt'), 'rb') as f:
+        try:
+            return parse_pattern(f.read())
+        except ValueError as e:
+            raise ValueError('%s.patt: %s' % (name, e))
+
+def encode(lost, header=None):
+    '''
+    the text of a pattern, LINE_TOKENS tokens per line
+    '''
+    n = len(lost)
+    buf = np.empty(2 * n, dtype=np.uint8)
+    buf[0::2] = np.where(lost, ord('1'), ord('0'))
+    buf[1::2] = ord(' ')
+    buf[2 * LINE_TOKENS - 1::2 * LINE_TOKENS] = ord('\n')
+    buf[-1] = ord('\n')
+    text = buf.tobytes()
+    if header:
+        text = ('# %s\n' % header).encode() + text
+    return text
+
+def spec_key(spec):
+    '''
+    the parameters of a pattern with the defaults filled in, what its name is hashed from
+    '''
+    spec = dict(spec)
+    spec.setdefault('length', PATTERN_LENGTH)
+    spec.setdefault('seed', PATTERN_SEED)
+    if 'file' in spec:
+        # a recording goes by its content, not by where it was read from
+        with open(spec.pop('file'), 'rb') as f:
+            spec['recording'] = hashlib.sha1(f.read()).hexdigest()
+        spec.pop('length')
+        spec.pop('seed')
+    elif 'p' in spec and 'r' in spec:
+        spec.setdefault('bad_loss', 100)
+        spec.setdefault('good_loss', 0)
+    elif 'loss' not in spec or 'burst' not in spec:
+        raise ValueError('sls parameters need p and r, loss and burst, or a file: %s' % json.dumps(spec))
+    spec['version'] = GENERATOR_VERSION
+    return spec
+
+def generate(spec):
+    '''
+    the pattern of the parameters, a file of tokens, p and r, or loss and burst
+    '''
+    if 'file' in spec:
+        with open(spec['file'], 'rb') as f:
+            return parse_pattern(f.read())
+    n = int(spec.get('length', PATTERN_LENGTH))
+    if n <= 0:
+        raise ValueError('pattern length must be positive')
+    seed = spec.get('seed', PATTERN_SEED)
+    if 'p' in spec:
+        return gilbert_elliott(n, spec['p'], spec['r'], spec.get('bad_loss', 100), spec.get('good_loss', 0), seed)
+    return loss_burst(n, spec['loss'], spec['burst'], seed)
+
+class PatternCache(object):
+
+    '''
+    the generated patterns in directory, named CACHE_PREFIX and a hash of their parameters
+    '''
+
+    def __init__(self, directory=SLS_DIR, max_size=CACHE_SIZE):
+        self.directory = directory
+        self.max_size = max_size
+
+    def path(self, name):
+        return os.path.join(self.directory, name + '.patt')
+
+    def name(self, spec):
+        key = json.dumps(spec_key(spec), sort_keys=True)
+        return CACHE_PREFIX + hashlib.sha1(key.encode()).hexdigest()[:16]
+
+    def get(self, spec):
+        '''
+        name of the pattern of spec, generated unless it's in the cache already, which
+        then counts as used now
+        '''
+        name = self.name(spec)
+        path = self.path(name)
+        if os.path.exists(path):
+            os.utime(path, None)
+            return name
+        text = encode(generate(spec), json.dumps(spec, sort_keys=True))
+        tmp = '%s.%d.tmp' % (path, os.getpid())
+        with open(tmp, 'wb') as f:
+            f.write(text)
+        os.rename(tmp, path)
+        self.evict(keep=name)
+        return name
+
+    def entries(self):
+        '''
+        [(last used, size, name)] of the cached patterns, least recently used first
+        '''
+        entries = []
+        for f in os.listdir(self.directory):
+            if f.startswith(CACHE_PREFIX) and f.endswith('.patt'):
+                st = os.stat(os.path.join(self.directory, f))
+                entries.append((st.st_mtime, st.st_size, f[:-len('.patt')]))
+        return sorted(entries)
+
+    def evict(self, keep=None):
+        '''
+        removes the least recently used patterns until the cache fits in max_size, the
+        patterns of the saved rules stay, returns the names removed
+        '''
+        entries = self.entries()
+        total = sum(size for _, size, _ in entries)
+        in_use = set([keep]) | rules_patterns()
+        removed = []
+        for _, size, name in entries:
+            if total <= self.max_size:
+                break
+            if name in in_use:
+                continue
+            os.remove(self.path(name))
+            total -= size
+            removed.append(name)
+        return removed
+
+def rules_patterns():
+    try:
+        with open(em.RULE_PATH, 'r') as f:
+            return set(r['sls'] for r in json.load(f) if r.get('sls'))
+    except (IOError, ValueError):
+        return set()
+
+def main():
+    arg_parser = argparse.ArgumentParser()
+    arg_parser.add_argument('--dir', help='directory of the patterns', default=SLS_DIR)
+    arg_parser.add_argument('--max-size',
+        type=float,
+        help='MB of cached patterns kept',
+        default=CACHE_SIZE >> 20
+    )
+    subparsers = arg_parser.add_subparsers(dest='cmd', help='pattern source')
+    subparsers.required = True
+    ge_parser = subparsers.add_parser('ge', help='Gilbert-Elliott parameters as for "loss gemodel p r 1-h 1-k"')
+    ge_parser.add_argument('--p', '-p', type=float, required=True, help='chance to go bad in %%')
+    ge_parser.add_argument('--r', '-r', type=float, required=True, help='chance to go good in %%')
+    ge_parser.add_argument('--bad-loss', type=float, default=100, help='loss in the bad state in %%, 1-h')
+    ge_parser.add_argument('--good-loss', type=float, default=0, help='loss in the good state in %%, 1-k')
+    loss_parser = subparsers.add_parser('loss', help='loss ratio and burst length, like add --loss --burst')
+    loss_parser.add_argument('--loss', '-l', type=float, required=True, help='loss ratio in percentage')
+    loss_parser.add_argument('--burst', '-b', type=float, required=True, help='mean loss burst length in packets')
+    for p in (ge_parser, loss_parser):
+        p.add_argument('--length', '-n', type=int, default=PATTERN_LENGTH, help='packets in the pattern')
+        p.add_argument('--seed', type=int, default=PATTERN_SEED, help='seed of the random states')
+    record_parser = subparsers.add_parser('record', help='recorded loss sequence, 0 and 1 tokens')
+    record_parser.add_argument('file')
+    subparsers.add_parser('list', help='cached patterns')
+    subparsers.add_parser('prune', help='evict patterns until the cache fits in --max-size')
+    args = arg_parser.parse_args()
+
+    cache = PatternCache(args.dir, int(args.max_size * (1 << 20)))
+    try:
+        if args.cmd == 'list':
+            for _, size, name in cache.entries():
+                with open(cache.path(name), 'r') as f:
+                    header = f.readline()
+                print('%s %10d %s' % (name, size, header[1:].strip() if header.startswith('#') else ''))
+        elif args.cmd == 'prune':
+            for name in cache.evict():
+                print('removed %s' % name)
+        else:
+            if args.cmd == 'ge':
+                spec = {'p': args.p, 'r': args.r, 'bad_loss': args.bad_loss, 'good_loss': args.good_loss}
+            elif args.cmd == 'loss':
+                spec = {'loss': args.loss, 'burst': args.burst}
+            else:
+                spec = {'file': os.path.abspath(args.file)}
+            if args.cmd != 'record':
+                spec.update(length=args.length, seed=args.seed)
+            print(cache.get(spec))
+    except (IOError, OSError, ValueError) as e:
+        print('error, %s' % e)
+        sys.exit(1)
+
+if __name__ == "__main__":
+    main()
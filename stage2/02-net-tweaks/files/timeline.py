@@ -0,0 +1,205 @@
+#!/usr/bin/python
+'''
+compact binary timeline of network dynamics, played by dynem.py through mmap
+
+A timeline holds one loop of the dynamics of a rule as fixed-width records, each
+the full parameters the rule takes from its offset on:
+
+    header  8s magic "PIEMTL01", u32 length of the json, u32 records, u32 period in ms
+    json    the rule of the configuration without "dynamics", utf-8, padded to 4 bytes
+    records u32 offset in ms, u32 bw in kbit, f32 loss in %, u32 delay in ms,
+            u32 jitter in ms, u32 qdelay in ms, f32 burst in packets (0 for none)
+
+all little endian. The period is the length of the loop, the records are sorted by
+offset. Convert a dynem.py configuration with:
+
+    $ timeline.py day_dynamic_trace.json day.tl
+    $ dynem.py -f day.tl
+
+A configuration with generators is written for --length seconds, its steps looped
+after that.
+'''
+import argparse
+import json
+import mmap
+import os
+import struct
+import sys
+
+MAGIC = b'PIEMTL01'
+HEADER = struct.Struct('<8sIII')
+RECORD = struct.Struct('<IIfIIIf')
+FIELDS = ('offset', 'bw', 'loss', 'delay', 'jitter', 'qdelay', 'burst')
+# configuration keys left out of the header, the records take their place
+RULE_ONLY = ('dynamics', 'generators', 'step', 'seed')
+
+# the defaults dynem.py gives the parameters missing from a configuration
+DEFAULTS = {'bw': 8000, 'loss': 0, 'qdelay': 100, 'jitter': 0, 'delay': 10, 'burst': None}
+
+def is_timeline(path):
+    try:
+        with open(path, 'rb') as f:
+            return f.read(len(MAGIC)) == MAGIC
+    except IOError:
+        return False
+
+class TimelineWriter(object):
+
+    '''
+    writes records as they come, the header is completed on close, so the memory used
+    doesn't depend on the length of the timeline. The records go to a file next to path,
+    renamed over it by close, so a failed write never leaves a partial timeline there.
+    Used in a with block, or with discard() after it, the file is removed unless closed
+    '''
+
+    def __init__(self, path, rule):
+        self.path = path
+        self.tmp_path = '%s.tmp.%d' % (path, os.getpid())
+        self.f = open(self.tmp_path, 'wb')
+        self.rule = json.dumps(dict((k, v) for k, v in rule.items() if k not in RULE_ONLY)).encode()
+        self.rule += b' ' * (-len(self.rule) % 4)
+        self.count = 0
+        self.last = 0
+        self.f.write(HEADER.pack(MAGIC, len(self.rule), 0, 0))
+        self.f.write(self.rule)
+
+    def add(self, offset, params):
+        '''
+        params has the names of FIELDS, None burst for no burst
+        '''
+        if offset < self.last:
+            raise ValueError('timeline goes back in time at %d ms' % offset)
+        self.last = offset
+        self.f.write(RECORD.pack(offset, int(params['bw']), float(params['loss']), int(params['delay']),
+                                 int(params['jitter']), int(params['qdelay']), float(params['burst'] or 0)))
+        self.count += 1
+
+    def close(self, period):
+        if period < self.last:
+            raise ValueError('period %d ms ends before the last record at %d ms' % (period, self.last))
+        self.f.seek(0)
+        self.f.write(HEADER.pack(MAGIC, len(self.rule), self.count, period))
+        self.f.close()
+        os.rename(self.tmp_path, self.path)
+
+    def discard(self):
+        '''
+        removes the file being written, nothing once closed
+        '''
+        if not self.f.closed:
+            self.f.close()
+        if os.path.exists(self.tmp_path):
+            os.remove(self.tmp_path)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, etype, e, tb):
+        self.discard()
+        return False
+
+class TimelineFile(object):
+
+    '''
+    a timeline mapped in memory, records are decoded one at a time when read
+    '''
+
+    def __init__(self, path):
+        with open(path, 'rb') as f:
+            self.mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        magic, length, self.count, self.period = HEADER.unpack_from(self.mm, 0)
+        if magic != MAGIC:
+            raise ValueError('%s is not a timeline' % path)
+        self.config = json.loads(self.mm[HEADER.size:HEADER.size + length].decode())
+        self.start = HEADER.size + length
+        if len(self.mm) < self.start + self.count * RECORD.size:
+            raise ValueError('%s is truncated' % path)
+
+    def __len__(self):
+        return self.count
+
+    def record(self, i):
+        '''
+        (offset, bw, loss, delay, jitter, qdelay, burst) of record i, loss and burst
+        rounded back from float32, None burst for no burst
+        '''
+        offset, bw, loss, delay, jitter, qdelay, burst = RECORD.unpack_from(self.mm, self.start + i * RECORD.size)
+        return offset, bw, round(loss, 3), delay, jitter, qdelay, round(burst, 3) or None
+
+    def __iter__(self):
+        for i in range(self.count):
+            yield self.record(i)
+
+    def close(self):
+        self.mm.close()
+
+def to_ms(seconds):
+    return int(round(float(seconds) * 1000))
+
+def convert(config, path):
+    '''
+    writes one loop of the dynamics of a dynem.py configuration as a timeline, the same
+    steps dynem.py compiles from it, returns the number of records
+    '''
+    base = dict((k, config.get(k, v)) for k, v in DEFAULTS.items())
+    base_sls = config.get('sls', None)
+    dynamics = config['dynamics']
+    with TimelineWriter(path, config) as writer:
+        offset = 0
+        for idx, dyn in enumerate(dynamics):
+            if dyn.get('sls', base_sls) != base_sls:
+                raise ValueError('dynamics step %d changes the sls pattern, a timeline only has the one of the rule' % idx)
+            if dyn.get('blocked', config.get('blocked', False)) != config.get('blocked', False):
+                raise ValueError('dynamics step %d changes "blocked", a timeline only has the one of the rule' % idx)
+            offset += to_ms(dyn['interval'])
+            writer.add(offset, dict((k, dyn.get(k, v)) for k, v in base.items()))
+            offset += to_ms(dyn['duration'])
+            # back to the base parameters when there is a gap before the next step
+            if to_ms(dynamics[(idx + 1) % len(dynamics)]['interval']) != 0:
+                writer.add(offset, base)
+        writer.close(offset)
+    return writer.count
+
+def generate(config, path, length):
+    '''
+    writes length seconds of the steps of a configuration with generators as one loop of
+    a timeline, returns the number of records
+    '''
+    import dyngen
+    end = to_ms(length)
+    if end <= 0:
+        raise ValueError('length must be positive')
+    burst = config.get('burst', DEFAULTS['burst'])
+    with TimelineWriter(path, config) as writer:
+        for offset, params in dyngen.Generator(config).steps(end):
+            writer.add(offset, dict(params, burst=burst))
+        writer.close(end)
+    return writer.count
+
+def main():
+    arg_parser = argparse.ArgumentParser()
+    arg_parser.add_argument('config', help='dynem.py configuration file')
+    arg_parser.add_argument('timeline', help='timeline file to write')
+    arg_parser.add_argument('--length', '-l', type=float, help='seconds of a configuration with generators to write')
+    args = arg_parser.parse_args()
+
+    with open(args.config, 'r') as f:
+        config = json.load(f)
+    if config.get('generators') and args.length is None:
+        print('error, %s has generators, give the --length to write' % args.config)
+        sys.exit(1)
+    if not config.get('dynamics') and not config.get('generators'):
+        print('error, no dynamics in %s' % args.config)
+        sys.exit(1)
+    try:
+        if config.get('generators'):
+            count = generate(config, args.timeline, args.length)
+        else:
+            count = convert(config, args.timeline)
+    except (KeyError, TypeError, ValueError) as e:
+        print('error, %s' % e)
+        sys.exit(1)
+    print('%s: %d records, %d bytes' % (args.timeline, count, os.path.getsize(args.timeline)))
+
+if __name__ == "__main__":
+    main()